@@ -1,17 +1,33 @@
+import asyncio
+import hashlib
+import inspect
 import json
 import logging
+import os
+import time
 import decimal
 import datetime
 import uuid
-from typing import Any, Dict, List, Optional, Sequence, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, START, StateGraph
 
 
+from analytics import budget_result, budget_results, summarise_result
 from client import mllOpenIA
-from utils import get_db_connection
+from cache import llm_cache, semantic_sql_cache
+from catalog import CatalogEntry, TableCatalog
+from columnar import columnar_store
+from kpi_templates import TemplateMatch, kpi_templates
+from utils import (
+    afetch_bounded, aguard_query_cost, async_readonly_connection, data_versions, describe_db_error,
+    fetch_bounded, guard_query_cost, readonly_connection,
+)
 from prompts import prompt_multi_query, prompt_single_query
+from views import materialized_views
 
 dict_tables = {
   "tables": [
@@ -56,6 +72,31 @@ dict_tables = {
   ]
 }
 
+# Vistas materializadas gestionadas (MATERIALIZED_VIEWS=true): el LLM las ve como tablas más
+dict_tables["tables"].extend(materialized_views.table_definitions())
+
+# El snapshot columnar tipa las columnas con las mismas definiciones
+columnar_store.set_table_definitions(dict_tables["tables"])
+
+# Catálogo compartido por todos los grafos del proceso (ver catalog.TableCatalog),
+# invalidado cuando cambia la huella de datos de cada tabla
+table_catalog = TableCatalog(dict_tables["tables"], version_probe=data_versions.versions,
+                             aversion_probe=data_versions.aversions,
+                             snapshot_probe=columnar_store.probe, asnapshot_probe=columnar_store.aprobe)
+
+# Nodos cuyo texto generado se emite token a token cuando arun recibe on_token
+STREAMED_NODES = ("data_analyst",)
+# Caracteres de data_analysis incluidos en el aviso de progreso del nodo
+PROGRESS_TEXT_LIMIT = 2000
+
+class PlannerDecision(BaseModel):
+    """Respuesta estructurada del planificador fusionado (AGENT_PLANNER=fused)"""
+    analysis: str
+    verdict: Literal["CLEAR", "AMBIGUOUS", "INSUFFICIENT_DATA"]
+    clarification: Optional[str] = None
+    tables: List[str] = []
+    complexity: Literal["SINGLE", "MULTIPLE"]
+
 class FlowState(BaseModel):
     """Estado del flujo de procesamiento de consultas"""
     input: List[str] = []
@@ -74,6 +115,24 @@ class FlowState(BaseModel):
     validated_tables: Dict[str, Dict[str, Any]] = {}  # Almacena muestras y metadatos de tablas validadas
     table_samples: Dict[str, List[Dict[str, Any]]] = {}  # Muestras de datos de cada tabla
     table_validation_errors: List[str] = []  # Errores encontrados durante la validación
+    catalog_info: Dict[str, Dict[str, Any]] = {}  # Antigüedad y duración del refresco del catálogo por tabla
+    
+    # Decisiones del planificador fusionado (vacías con el planificador en cadena)
+    planned_tables: List[str] = []
+    planned_complexity: Optional[str] = None
+    
+    # Coincidencia de la caché semántica (SQL reutilizado sin pasar por el LLM)
+    semantic_match: Optional[Dict[str, Any]] = None
+    
+    # Plantilla KPI elegida por sql_agent en lugar del LLM (consulta preparada + parámetros)
+    template_match: Optional[Dict[str, Any]] = None
+    
+    # Estadísticas calculadas localmente sobre los resultados (analytics.summarise_result);
+    # el analista recibe estas estadísticas y las filas completas quedan fuera del prompt
+    result_stats: Optional[Dict[str, Any]] = None
+    # Filas y columnas de cada resultado que caben en el presupuesto de tokens del analista
+    # (analytics.budget_results), por query_index (0 = consulta simple)
+    result_budget: Optional[Dict[int, Dict[str, Any]]] = None
     
     # Control de flujo
     is_sql_valid: bool = False
@@ -110,38 +169,105 @@ class AnalystIAGraph:
     Agente mejorado para procesar consultas de base de datos con múltiples especialistas
     """
     
-    def __init__(self, agent_prompt):
+    # Filas que se traen de la base de datos por consulta (el resto solo se cuenta)
+    SINGLE_QUERY_ROW_LIMIT = 300
+    MULTI_QUERY_ROW_LIMIT = 50
+    
+    PLANNERS = ("chain", "parallel", "fused")
+    
+    # Campos que escribe cada rama del planificador paralelo (no pueden solaparse)
+    AMBIGUITY_FIELDS = ("is_ambiguous", "insufficient_data", "clarification_needed")
+    TABLE_FIELDS = ("validated_tables", "table_samples", "table_validation_errors", "catalog_info")
+    
+    def __init__(self, agent_prompt, catalog: Optional[TableCatalog] = None, planner: Optional[str] = None,
+                 name: Optional[str] = None):
         self.agent_prompt = agent_prompt
-        # Configurar el modelo de lenguaje
-        self.llm = mllOpenIA('gpt-4.1-mini')
+        # Espacio de nombres del especialista en la caché semántica
+        self.name = name or hashlib.sha1(agent_prompt.encode()).hexdigest()[:12]
+        self.catalog = catalog or table_catalog
+        self.semantic_cache = semantic_sql_cache if semantic_sql_cache.enabled else None
+        self.templates = kpi_templates
+        self.columnar = columnar_store
+        # chain: coordinador, ambigüedad, tablas y complejidad en llamadas separadas al LLM
+        # parallel: como chain, pero ambigüedad y tablas corren en ramas paralelas
+        # fused: una sola llamada estructurada que decide todo lo anterior
+        self.planner = (planner or os.environ.get("AGENT_PLANNER", "chain")).lower()
+        if self.planner not in self.PLANNERS:
+            raise ValueError(f"AGENT_PLANNER desconocido: {self.planner} (opciones: {', '.join(self.PLANNERS)})")
+        # Máximo de consultas de multi_query_processor ejecutadas a la vez (cada una usa una conexión del pool)
+        self.query_parallelism = max(1, int(os.environ.get("MULTI_QUERY_PARALLELISM", "4")))
+        # Post-proceso con NumPy entre sql_evaluator y data_analyst (deltas, outliers, tendencias)
+        self.result_analytics = os.environ.get("RESULT_ANALYTICS", "true").lower() in ("1", "true", "yes")
+        # Tokens del prompt del analista dedicados a filas de resultados (repartidos entre consultas)
+        self.result_token_budget = int(os.environ.get("RESULT_TOKEN_BUDGET", "3000"))
+        # Configurar el modelo de lenguaje (con caché de respuestas si LLM_CACHE está activa)
+        self.llm = llm_cache.wrap(mllOpenIA('gpt-4.1-mini'), 'gpt-4.1-mini', list(self.catalog.table_definitions))
         sg = StateGraph(FlowState)
 
-        # Definir nodos
+        # Definir nodos (cada nodo con E/S expone una variante síncrona y otra asíncrona)
         sg.add_node('ingest', self.ingest)
-        sg.add_node('agent_coordinator', self.agent_coordinator)
-        sg.add_node('ambiguity_detector', self.ambiguity_detector)
+        if self.semantic_cache:
+            sg.add_node('semantic_lookup', self._node('semantic_lookup'))
+        if self.planner == 'fused':
+            sg.add_node('fused_planner', self._node('fused_planner'))
+        else:
+            sg.add_node('agent_coordinator', self._node('agent_coordinator'))
+        if self.planner == 'parallel':
+            sg.add_node('ambiguity_detector', self._branch_node('ambiguity_detector', self.AMBIGUITY_FIELDS))
+            sg.add_node('table_validator', self._branch_node('table_validator', self.TABLE_FIELDS))
+            sg.add_node('preparation_join', self.preparation_join)
+        else:
+            if self.planner == 'chain':
+                sg.add_node('ambiguity_detector', self._node('ambiguity_detector'))
+            sg.add_node('table_validator', self._node('table_validator'))
         sg.add_node('clarification_handler', self.clarification_handler)
-        sg.add_node('table_validator', self.table_validator)
-        sg.add_node('sql_agent', self.sql_agent)
-        sg.add_node('sql_process', self.sql_process)
-        sg.add_node('multi_query_processor', self.multi_query_processor)
+        sg.add_node('sql_agent', self._node('sql_agent'))
+        sg.add_node('sql_process', self._node('sql_process'))
+        sg.add_node('multi_query_processor', self._node('multi_query_processor'))
         sg.add_node('sql_evaluator', self.sql_evaluator)
-        sg.add_node('data_analyst', self.data_analyst)
+        if self.result_analytics:
+            sg.add_node('result_analytics', self.result_analytics_node)
+        sg.add_node('data_analyst', self._node('data_analyst'))
         
 
         # Definir edges
         sg.add_edge(START, 'ingest')
-        sg.add_edge('ingest', 'agent_coordinator')
-        sg.add_edge('agent_coordinator', 'ambiguity_detector')
-        
-        # Edge ambigüedades
-        sg.add_conditional_edges(
-            'ambiguity_detector',
-            lambda st: 'clarification_handler' if st.is_ambiguous or st.insufficient_data else 'table_validator',
-        )
-        
-        # Conectar el validador de tablas al agente SQL
-        sg.add_edge('table_validator', 'sql_agent')
+        planning_node = 'fused_planner' if self.planner == 'fused' else 'agent_coordinator'
+        if self.semantic_cache:
+            # Pregunta casi idéntica a una ya resuelta: ejecutar directamente su SQL
+            sg.add_edge('ingest', 'semantic_lookup')
+            sg.add_conditional_edges(
+                'semantic_lookup',
+                lambda st: planning_node if not st.semantic_match
+                else 'multi_query_processor' if st.requires_multiple_queries else 'sql_process',
+            )
+        else:
+            sg.add_edge('ingest', planning_node)
+        
+        if self.planner == 'parallel':
+            # Fan-out: ambigüedad y selección/validación de tablas a la vez; se unen antes de sql_agent
+            sg.add_edge('agent_coordinator', 'ambiguity_detector')
+            sg.add_edge('agent_coordinator', 'table_validator')
+            sg.add_edge(['ambiguity_detector', 'table_validator'], 'preparation_join')
+            sg.add_conditional_edges(
+                'preparation_join',
+                lambda st: 'clarification_handler' if st.is_ambiguous or st.insufficient_data else 'sql_agent',
+            )
+        else:
+            if self.planner == 'fused':
+                ambiguity_node = 'fused_planner'
+            else:
+                sg.add_edge('agent_coordinator', 'ambiguity_detector')
+                ambiguity_node = 'ambiguity_detector'
+            
+            # Edge ambigüedades
+            sg.add_conditional_edges(
+                ambiguity_node,
+                lambda st: 'clarification_handler' if st.is_ambiguous or st.insufficient_data else 'table_validator',
+            )
+            
+            # Conectar el validador de tablas al agente SQL
+            sg.add_edge('table_validator', 'sql_agent')
         
         # Decidir si usar procesamiento simple o múltiple
         sg.add_conditional_edges(
@@ -153,15 +279,42 @@ class AnalystIAGraph:
         sg.add_edge('multi_query_processor', 'sql_evaluator')
         
         # Edge condicional basado en validación SQL
+        analysis_node = 'result_analytics' if self.result_analytics else 'data_analyst'
         sg.add_conditional_edges(
             'sql_evaluator',
-            lambda st: 'sql_agent' if st.needs_retry and st.retry_count < st.max_retries else 'data_analyst'
+            lambda st: 'sql_agent' if st.needs_retry and st.retry_count < st.max_retries else analysis_node
         )
+        if self.result_analytics:
+            sg.add_edge('result_analytics', 'data_analyst')
         sg.add_edge('data_analyst', END)
         sg.add_edge('clarification_handler', END)
 
         self.graph = sg.compile()
 
+    def _node(self, name: str) -> RunnableLambda:
+        """
+        Empaqueta un nodo con su variante síncrona (`name`) y asíncrona (`a<name>`),
+        de modo que el mismo grafo sirve tanto para graph.invoke como para graph.ainvoke.
+        """
+        return RunnableLambda(getattr(self, name), afunc=getattr(self, f"a{name}"), name=name)
+
+    def _branch_node(self, name: str, fields: Sequence[str]) -> RunnableLambda:
+        """
+        Nodo de una rama paralela: devuelve solo los campos que escribe, ya que
+        LangGraph no admite dos actualizaciones del mismo campo en un mismo paso.
+        """
+        func, afunc = getattr(self, name), getattr(self, f"a{name}")
+
+        def run(state: FlowState) -> Dict[str, Any]:
+            state = func(state)
+            return {field: getattr(state, field) for field in fields}
+
+        async def arun(state: FlowState) -> Dict[str, Any]:
+            state = await afunc(state)
+            return {field: getattr(state, field) for field in fields}
+
+        return RunnableLambda(run, afunc=arun, name=name)
+
     # ----------------------------- Nodos -----------------------------------
     
     def ingest(self, state: FlowState) -> FlowState:
@@ -184,6 +337,13 @@ class AnalystIAGraph:
         state.validated_tables = {}
         state.table_samples = {}
         state.table_validation_errors = []
+        state.catalog_info = {}
+        state.planned_tables = []
+        state.planned_complexity = None
+        state.semantic_match = None
+        state.template_match = None
+        state.result_stats = None
+        state.result_budget = None
         state.retry_count = 0
         state.error_messages = []
         
@@ -196,12 +356,91 @@ class AnalystIAGraph:
                 
         return state
 
+    def semantic_lookup(self, state: FlowState) -> FlowState:
+        """Busca una pregunta casi idéntica ya resuelta por este especialista y reutiliza su SQL"""
+        try:
+            match = self.semantic_cache.lookup(self.name, self._extract_content_from_messages(state.messages))
+            if match:
+                for table_name in match["tables"]:
+                    self._validate_single_table(state, table_name)
+                self._apply_semantic_match(state, match)
+        except Exception as e:
+            logging.error(f"Error en semantic_lookup: {str(e)}")
+            state.semantic_match = None
+            
+        return state
+
+    async def asemantic_lookup(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de semantic_lookup"""
+        try:
+            match = await asyncio.to_thread(
+                self.semantic_cache.lookup, self.name, self._extract_content_from_messages(state.messages)
+            )
+            if match:
+                for table_name in match["tables"]:
+                    await self._avalidate_single_table(state, table_name)
+                self._apply_semantic_match(state, match)
+        except Exception as e:
+            logging.error(f"Error en semantic_lookup: {str(e)}")
+            state.semantic_match = None
+            
+        return state
+
+    @staticmethod
+    def _apply_semantic_match(state: FlowState, match: Dict[str, Any]) -> None:
+        state.agent_analysis = match["agent_analysis"]
+        state.sql_query = match["sql_query"]
+        state.sql_queries = match["sql_queries"]
+        state.requires_multiple_queries = match["requires_multiple_queries"]
+        state.semantic_match = {"similarity": match["similarity"], "matched_question": match["matched_question"]}
+
+    def _remember_sql(self, final_state: Dict[str, Any]) -> None:
+        """Guarda en la caché semántica el SQL de una respuesta generada y ejecutada con éxito"""
+        if not self.semantic_cache or final_state.get('semantic_match') or not final_state.get('is_sql_valid'):
+            return
+        sql_query = final_state.get('sql_query')
+        if not sql_query or sql_query == "NO_SQL_NEEDED" or sql_query.startswith("ERROR"):
+            return
+        try:
+            self.semantic_cache.remember(
+                self.name,
+                self._extract_content_from_messages(final_state.get('messages', [])),
+                sql_query,
+                final_state.get('sql_queries', []),
+                final_state.get('requires_multiple_queries', False),
+                [t for t, v in final_state.get('validated_tables', {}).items() if v.get("exists")],
+                final_state.get('agent_analysis'),
+            )
+        except Exception as e:
+            logging.error(f"Error guardando en la caché semántica: {str(e)}")
+
     def agent_coordinator(self, state: FlowState) -> FlowState:
         """Agente coordinador que analiza la intención del usuario"""
-        
+        try:
+            response = self.llm.invoke(self._coordinator_prompt(state)).content
+            state.agent_analysis = response
+        except Exception as e:
+            logging.error(f"Error en agent_coordinator: {str(e)}")
+            state.agent_analysis = f"Error en análisis: {str(e)}"
+            
+        return state
+
+    async def aagent_coordinator(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de agent_coordinator"""
+        try:
+            response = (await self.llm.ainvoke(self._coordinator_prompt(state))).content
+            state.agent_analysis = response
+        except Exception as e:
+            logging.error(f"Error en agent_coordinator: {str(e)}")
+            state.agent_analysis = f"Error en análisis: {str(e)}"
+            
+        return state
+
+    def _coordinator_prompt(self, state: FlowState) -> str:
+        """Construye el prompt del agente coordinador"""
         messages_content = self._extract_content_from_messages(state.messages)
         
-        prompt = f"""
+        return f"""
         Eres el agente coordinador principal. Analiza la siguiente consulta del usuario:
         
         {self.agent_prompt}
@@ -215,63 +454,96 @@ class AnalystIAGraph:
         Responde con un análisis claro y estructurado de la solicitud.
         """
         
+    def fused_planner(self, state: FlowState) -> FlowState:
+        """
+        Planificador fusionado: análisis, veredicto de ambigüedad, tablas relevantes y
+        SINGLE/MULTIPLE en una sola llamada al LLM validada contra PlannerDecision.
+        """
         try:
-            response = self.llm.invoke(prompt).content
-            state.agent_analysis = response
+            response = self.llm.invoke(self._planner_prompt(state)).content
+            self._apply_planner_decision(state, response)
         except Exception as e:
-            logging.error(f"Error en agent_coordinator: {str(e)}")
-            state.agent_analysis = f"Error en análisis: {str(e)}"
+            logging.error(f"Error en fused_planner: {str(e)}")
+            self._apply_planner_fallback(state, e)
             
         return state
-        
-    def table_validator(self, state: FlowState) -> FlowState:
-        """
-        Validador de tablas que ejecuta queries de muestra para verificar la estructura y datos
-        antes de generar las consultas SQL principales.
-        """
+
+    async def afused_planner(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de fused_planner"""
+        try:
+            response = (await self.llm.ainvoke(self._planner_prompt(state))).content
+            self._apply_planner_decision(state, response)
+        except Exception as e:
+            logging.error(f"Error en fused_planner: {str(e)}")
+            self._apply_planner_fallback(state, e)
+            
+        return state
+
+    def _planner_prompt(self, state: FlowState) -> str:
+        """Construye el prompt del planificador fusionado"""
         messages_content = self._extract_content_from_messages(state.messages)
         
-        # Primero, analizar qué tablas podrían ser relevantes para la consulta
-        prompt = f"""
-        Identifica las tablas que podrían ser relevantes para responder la siguiente consulta:
+        return f"""
+        Eres el agente coordinador principal y planificador de la consulta.
         
-        Consulta del usuario: {messages_content}
-        Análisis previo: {state.agent_analysis}
+        {self.agent_prompt}
         
-        La base de datos tiene estas tablas:
+        Consulta del usuario:
+        {messages_content}
+        
+        La base de datos tiene esta estructura:
         {json.dumps(dict_tables)}
         
-        Responde con un objeto JSON que contenga un array de nombres de tablas:
-        {{
-            "tables": ["nombre_tabla1", "nombre_tabla2", ...]
-        }}
+        En una sola respuesta decide:
+        1. analysis: análisis claro y estructurado de la solicitud.
+        2. verdict: CLEAR si se puede responder; AMBIGUOUS si necesita aclaración del usuario;
+           INSUFFICIENT_DATA si hace referencia a datos que NO están en las tablas.
+        3. clarification: pregunta de aclaración o explicación de los datos faltantes (null si CLEAR).
+        4. tables: nombres de las tablas relevantes para responder.
+        5. complexity: MULTIPLE si requiere comparaciones entre grupos o varios cortes, mezcla agregados
+           con detalle, métricas derivadas reutilizadas, varias ventanas temporales, validaciones previas
+           o unión de fuentes con lógicas distintas; SINGLE si basta una sola query de un solo grano.
+           Ante ambigüedad material sobre datos o filtros, elige MULTIPLE.
+        
+        Responde ÚNICAMENTE con un objeto JSON que cumpla este JSON Schema:
+        {json.dumps(PlannerDecision.model_json_schema())}
+        """
+
+    def _apply_planner_decision(self, state: FlowState, response: str) -> None:
+        """Valida la respuesta del planificador y la reparte en los campos del estado"""
+        import re
+        json_match = re.search(r'\{[\s\S]*\}', response)
+        decision = PlannerDecision.model_validate_json(json_match.group(0) if json_match else response)
+        
+        state.agent_analysis = decision.analysis
+        if decision.verdict == "CLEAR":
+            self._apply_ambiguity_response(state, "CLEAR")
+        else:
+            self._apply_ambiguity_response(state, f"{decision.verdict}: {decision.clarification or ''}")
+        state.planned_tables = decision.tables
+        state.planned_complexity = decision.complexity
+
+    def _apply_planner_fallback(self, state: FlowState, error: Exception) -> None:
+        """Respuesta inválida: continuar como CLEAR y dejar tablas y complejidad a los nodos siguientes"""
+        reason = "respuesta fuera del esquema" if isinstance(error, (ValidationError, ValueError)) else str(error)
+        state.agent_analysis = f"Error en planificación: {reason}"
+        self._apply_ambiguity_response(state, "CLEAR")
+        state.planned_tables = []
+        state.planned_complexity = None
+
+    def table_validator(self, state: FlowState) -> FlowState:
+        """
+        Validador de tablas que ejecuta queries de muestra para verificar la estructura y datos
+        antes de generar las consultas SQL principales.
         """
-        
         try:
-            response = self.llm.invoke(prompt).content.strip()
-            
-            # Extraer lista de tablas del JSON
-            tables_to_validate = []
-            
-            # Buscar y extraer el JSON
-            import re
-            json_match = re.search(r'\{[\s\S]*\}', response)
-            if json_match:
-                try:
-                    tables_json = json.loads(json_match.group(0))
-                    if isinstance(tables_json, dict) and "tables" in tables_json:
-                        tables_to_validate = tables_json["tables"]
-                except json.JSONDecodeError:
-                    # Fallback: buscar nombres de tablas en la respuesta
-                    for table_info in dict_tables.get("tables", []):
-                        table_name = table_info.get("name")
-                        if table_name and table_name in response:
-                            tables_to_validate.append(table_name)
-            
-            # Si no se encontraron tablas, usar todas las disponibles
-            if not tables_to_validate:
-                tables_to_validate = [table_info.get("name") for table_info in dict_tables.get("tables", [])]
-                
+            # Con el planificador fusionado las tablas ya vienen decididas
+            if state.planned_tables:
+                tables_to_validate = state.planned_tables
+            else:
+                response = self.llm.invoke(self._table_validator_prompt(state)).content.strip()
+                tables_to_validate = self._parse_tables_to_validate(response)
+            
             # Validar cada tabla identificada
             for table_name in tables_to_validate:
                 self._validate_single_table(state, table_name)
@@ -285,95 +557,152 @@ class AnalystIAGraph:
             state.table_validation_errors.append(f"Error general: {str(e)}")
             
         return state
+
+    async def atable_validator(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de table_validator"""
+        try:
+            if state.planned_tables:
+                tables_to_validate = state.planned_tables
+            else:
+                response = (await self.llm.ainvoke(self._table_validator_prompt(state))).content.strip()
+                tables_to_validate = self._parse_tables_to_validate(response)
+            
+            for table_name in tables_to_validate:
+                await self._avalidate_single_table(state, table_name)
+                
+            if state.table_validation_errors:
+                logging.warning(f"Errores en validación de tablas: {state.table_validation_errors}")
+                
+        except Exception as e:
+            logging.error(f"Error en table_validator: {str(e)}")
+            state.table_validation_errors.append(f"Error general: {str(e)}")
+            
+        return state
+
+    def _table_validator_prompt(self, state: FlowState) -> str:
+        """Construye el prompt que identifica las tablas relevantes para la consulta"""
+        messages_content = self._extract_content_from_messages(state.messages)
         
-    def _validate_single_table(self, state: FlowState, table_name: str) -> None:
-        """
-        Valida una tabla específica ejecutando consultas de muestra
-        y almacenando los resultados en el estado.
+        return f"""
+        Identifica las tablas que podrían ser relevantes para responder la siguiente consulta:
+        
+        Consulta del usuario: {messages_content}
+        Análisis previo: {state.agent_analysis}
+        
+        La base de datos tiene estas tablas:
+        {json.dumps(dict_tables)}
+        
+        Responde con un objeto JSON que contenga un array de nombres de tablas:
+        {{
+            "tables": ["nombre_tabla1", "nombre_tabla2", ...]
+        }}
         """
-        # Verificar si la tabla está definida en dict_tables
-        table_definition = None
+
+    def _parse_tables_to_validate(self, response: str) -> List[str]:
+        """Extrae la lista de tablas de la respuesta del LLM (todas si no se reconoce ninguna)"""
+        tables_to_validate = []
+        
+        # Buscar y extraer el JSON
+        import re
+        json_match = re.search(r'\{[\s\S]*\}', response)
+        if json_match:
+            try:
+                tables_json = json.loads(json_match.group(0))
+                if isinstance(tables_json, dict) and "tables" in tables_json:
+                    tables_to_validate = tables_json["tables"]
+            except json.JSONDecodeError:
+                # Fallback: buscar nombres de tablas en la respuesta
+                for table_info in dict_tables.get("tables", []):
+                    table_name = table_info.get("name")
+                    if table_name and table_name in response:
+                        tables_to_validate.append(table_name)
+        
+        # Si no se encontraron tablas, usar todas las disponibles
+        if not tables_to_validate:
+            tables_to_validate = [table_info.get("name") for table_info in dict_tables.get("tables", [])]
+            
+        return tables_to_validate
+
+    def _get_table_definition(self, state: FlowState, table_name: str) -> Optional[Dict[str, Any]]:
+        """Busca la tabla en dict_tables y registra el error si no está definida"""
         for table_info in dict_tables.get("tables", []):
             if table_info.get("name") == table_name:
-                table_definition = table_info
-                break
+                return table_info
                 
+        state.table_validation_errors.append(f"Tabla '{table_name}' no encontrada en la definición")
+        return None
+
+    def _record_table_validation(self, state: FlowState, table_name: str, entry: CatalogEntry) -> None:
+        """Copia en el estado la información cacheada de una tabla"""
+        state.validated_tables[table_name] = dict(entry.validated)
+        state.table_samples[table_name] = entry.samples
+        state.catalog_info[table_name] = entry.info()
+
+    def _record_table_error(self, state: FlowState, table_name: str, table_definition: Dict[str, Any],
+                            error: Exception) -> None:
+        """Registra en el estado el fallo al validar una tabla"""
+        error_msg = f"Error validando tabla '{table_name}': {str(error)}"
+        state.table_validation_errors.append(error_msg)
+        state.validated_tables[table_name] = {
+            "exists": False,
+            "error": str(error),
+            "definition": table_definition
+        }
+        logging.error(error_msg)
+        
+    def _validate_single_table(self, state: FlowState, table_name: str) -> None:
+        """
+        Valida una tabla específica a partir del catálogo cacheado
+        (solo consulta la base de datos si la tabla aún no está en caché).
+        """
+        table_definition = self._get_table_definition(state, table_name)
         if not table_definition:
-            state.table_validation_errors.append(f"Tabla '{table_name}' no encontrada en la definición")
             return
             
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Consulta 1: Obtener muestra de datos (máximo 10 filas)
-            sample_query = f"SELECT * FROM {table_name} LIMIT 10"
-            cursor.execute(sample_query)
-            sample_rows = cursor.fetchall()
-            
-            # Convertir a lista de diccionarios
-            sample_data = [dict(row) for row in sample_rows]
-            
-            # Consulta 2: Contar registros totales
-            count_query = f"SELECT COUNT(*) as total_rows FROM {table_name}"
-            cursor.execute(count_query)
-            count_result = cursor.fetchone()
-            total_rows = count_result["total_rows"] if count_result else 0
-            
-            # Consulta 3: Para cada columna numérica, obtener estadísticas básicas
-            column_stats = {}
-            for column_info in table_definition.get("columns", []):
-                column_name = column_info.get("name")
-                column_type = column_info.get("type", "").lower()
-                
-                if column_type in ["integer", "double precision", "numeric", "decimal", "float"]:
-                    try:
-                        stats_query = f"""
-                        SELECT 
-                            COUNT(*) AS count,
-                            COUNT(*) FILTER(WHERE {column_name} IS NULL) AS null_count,
-                            AVG({column_name}) AS avg,
-                            MIN({column_name}) AS min,
-                            MAX({column_name}) AS max
-                        FROM {table_name}
-                        """
-                        cursor.execute(stats_query)
-                        stats = cursor.fetchone()
-                        if stats:
-                            column_stats[column_name] = dict(stats)
-                    except Exception as e:
-                        logging.warning(f"Error al obtener estadísticas para {column_name}: {str(e)}")
-                        column_stats[column_name] = {"error": str(e)}
-                
-            # Guardar toda la información validada
-            state.validated_tables[table_name] = {
-                "exists": True,
-                "definition": table_definition,
-                "total_rows": total_rows,
-                "column_stats": column_stats
-            }
-            
-            state.table_samples[table_name] = sample_data
-            
-            cursor.close()
-            conn.close()
+            self._record_table_validation(state, table_name, self.catalog.get_or_load(table_name))
+        except Exception as e:
+            self._record_table_error(state, table_name, table_definition, e)
+
+    async def _avalidate_single_table(self, state: FlowState, table_name: str) -> None:
+        """Versión asíncrona de _validate_single_table"""
+        table_definition = self._get_table_definition(state, table_name)
+        if not table_definition:
+            return
             
+        try:
+            self._record_table_validation(state, table_name, await self.catalog.aget_or_load(table_name))
         except Exception as e:
-            error_msg = f"Error validando tabla '{table_name}': {str(e)}"
-            state.table_validation_errors.append(error_msg)
-            state.validated_tables[table_name] = {
-                "exists": False,
-                "error": str(e),
-                "definition": table_definition
-            }
-            logging.error(error_msg)
+            self._record_table_error(state, table_name, table_definition, e)
 
     def ambiguity_detector(self, state: FlowState) -> FlowState:
         """Detecta si la consulta es ambigua o falta información"""
-        
+        try:
+            response = self.llm.invoke(self._ambiguity_prompt(state)).content.strip()
+            self._apply_ambiguity_response(state, response)
+        except Exception as e:
+            logging.error(f"Error en ambiguity_detector: {str(e)}")
+            # En caso de error, asumir que está claro para continuar
+            self._apply_ambiguity_response(state, "CLEAR")
+            
+        return state
+
+    async def aambiguity_detector(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de ambiguity_detector"""
+        try:
+            response = (await self.llm.ainvoke(self._ambiguity_prompt(state))).content.strip()
+            self._apply_ambiguity_response(state, response)
+        except Exception as e:
+            logging.error(f"Error en ambiguity_detector: {str(e)}")
+            self._apply_ambiguity_response(state, "CLEAR")
+            
+        return state
+
+    def _ambiguity_prompt(self, state: FlowState) -> str:
+        """Construye el prompt del detector de ambigüedades"""
         messages_content = self._extract_content_from_messages(state.messages)
         
-        prompt = f"""
+        return f"""
         Analiza la siguiente consulta de usuario para determinar si es ambigua o falta información importante.
         
         Consulta del usuario: {messages_content}
@@ -403,40 +732,29 @@ class AnalystIAGraph:
         - "Muestra datos" → AMBIGUOUS: ¿Quieres ver todos los registros o aplicar algún filtro?
         - "Registros con valor máximo" → INSUFFICIENT_DATA: No se especifica la columna a evaluar.
         - "Lista registros del campo categoría 'A'" → CLEAR"""
-        
-        try:
-            response = self.llm.invoke(prompt).content.strip()
+
+    def _apply_ambiguity_response(self, state: FlowState, response: str) -> None:
+        """Interpreta el veredicto CLEAR / AMBIGUOUS / INSUFFICIENT_DATA"""
+        if response.startswith("AMBIGUOUS:"):
+            state.is_ambiguous = True
+            state.insufficient_data = False
+            state.clarification_needed = response.replace("AMBIGUOUS:", "").strip()
             
-            if response.startswith("CLEAR"):
-                state.is_ambiguous = False
-                state.insufficient_data = False
-                state.clarification_needed = None
-                
-            elif response.startswith("AMBIGUOUS:"):
-                state.is_ambiguous = True
-                state.insufficient_data = False
-                state.clarification_needed = response.replace("AMBIGUOUS:", "").strip()
-                
-            elif response.startswith("INSUFFICIENT_DATA:"):
-                state.is_ambiguous = False
-                state.insufficient_data = True
-                state.clarification_needed = response.replace("INSUFFICIENT_DATA:", "").strip()
-                
-            else:
-                # Fallback: asumir que está claro si no reconoce el formato
-                state.is_ambiguous = False
-                state.insufficient_data = False
-                state.clarification_needed = None
-                
-        except Exception as e:
-            logging.error(f"Error en ambiguity_detector: {str(e)}")
-            # En caso de error, asumir que está claro para continuar
+        elif response.startswith("INSUFFICIENT_DATA:"):
+            state.is_ambiguous = False
+            state.insufficient_data = True
+            state.clarification_needed = response.replace("INSUFFICIENT_DATA:", "").strip()
+            
+        else:
+            # CLEAR, o fallback: asumir que está claro si no reconoce el formato
             state.is_ambiguous = False
             state.insufficient_data = False
             state.clarification_needed = None
-            
-        return state
     
+    def preparation_join(self, state: FlowState) -> FlowState:
+        """Punto de unión de las ramas de ambigüedad y tablas (planificador paralelo)"""
+        return state
+
     def clarification_handler(self, state: FlowState) -> FlowState:
         """Maneja casos donde se necesita aclaración o faltan datos"""
         
@@ -501,9 +819,83 @@ class AnalystIAGraph:
         """Agente especializado en generar consultas SQL (simple o múltiples)"""
         
         messages_content = self._extract_content_from_messages(state.messages)
+        started = time.perf_counter()
+        
+        # Pregunta que encaja en una plantilla KPI: sin LLM (solo en el primer intento)
+        if state.retry_count == 0 and self._apply_template(state, self.templates.match(messages_content), started):
+            return state
+        state.template_match = None
+        
+        try:
+            # Primero, determinar si se necesitan múltiples queries (salvo que ya lo decidiera el planificador)
+            complexity_response = state.planned_complexity or self.llm.invoke(self._complexity_prompt(state, messages_content)).content.strip()
+            
+            if complexity_response.startswith("MULTIPLE"):
+                state.requires_multiple_queries = True
+                return self._generate_multiple_queries(state, messages_content)
+            else:
+                state.requires_multiple_queries = False
+                return self._generate_single_query(state, messages_content)
+                
+        except Exception as e:
+            logging.error(f"Error en sql_agent: {str(e)}")
+            state.sql_query = f"ERROR: {str(e)}"
+            state.requires_multiple_queries = False
+            
+        finally:
+            self._record_sql_latency(False, started)
+            
+        return state
+
+    async def asql_agent(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de sql_agent"""
+        
+        messages_content = self._extract_content_from_messages(state.messages)
+        started = time.perf_counter()
         
-        # Primero, determinar si se necesitan múltiples queries
-        complexity_prompt= f"""
+        if state.retry_count == 0 and self.templates.enabled:
+            match = await asyncio.to_thread(self.templates.match, messages_content)
+            if self._apply_template(state, match, started):
+                return state
+        state.template_match = None
+        
+        try:
+            complexity_response = state.planned_complexity or (await self.llm.ainvoke(self._complexity_prompt(state, messages_content))).content.strip()
+            
+            if complexity_response.startswith("MULTIPLE"):
+                state.requires_multiple_queries = True
+                return await self._agenerate_multiple_queries(state, messages_content)
+            else:
+                state.requires_multiple_queries = False
+                return await self._agenerate_single_query(state, messages_content)
+                
+        except Exception as e:
+            logging.error(f"Error en sql_agent: {str(e)}")
+            state.sql_query = f"ERROR: {str(e)}"
+            state.requires_multiple_queries = False
+            
+        finally:
+            self._record_sql_latency(False, started)
+            
+        return state
+
+    def _apply_template(self, state: FlowState, match: Optional[TemplateMatch], started: float) -> bool:
+        """Usa la plantilla KPI como SQL de la consulta. Devuelve False si no hubo coincidencia"""
+        if match is None:
+            return False
+        state.requires_multiple_queries = False
+        state.sql_query = match.rendered()
+        state.template_match = {**match.info(), "query": match.query, "statement_params": match.statement_params()}
+        self._record_sql_latency(True, started)
+        return True
+
+    def _record_sql_latency(self, via_template: bool, started: float) -> None:
+        if self.templates.enabled:
+            self.templates.record_latency(via_template, (time.perf_counter() - started) * 1000)
+
+    def _complexity_prompt(self, state: FlowState, messages_content: str) -> str:
+        """Construye el prompt que clasifica la consulta como SINGLE o MULTIPLE"""
+        return f"""
         fAnaliza si la siguiente consulta requiere múltiples queries SQL para responder completamente.
         Entrada:
         - Consulta: {messages_content}
@@ -551,28 +943,9 @@ class AnalystIAGraph:
         - “Estadísticas de contratación por año y departamento” → MULTIPLE
         - “Calcular promedio de ‘Perfect Order’ imputando mediana por zona y compararlo entre ‘Wealthy’ y ‘Non Wealthy’” → MULTIPLE
         """
-        
-        try:
-            complexity_response = self.llm.invoke(complexity_prompt).content.strip()
-            
-            if complexity_response.startswith("MULTIPLE"):
-                state.requires_multiple_queries = True
-                return self._generate_multiple_queries(state, messages_content)
-            else:
-                state.requires_multiple_queries = False
-                return self._generate_single_query(state, messages_content)
-                
-        except Exception as e:
-            logging.error(f"Error en sql_agent: {str(e)}")
-            state.sql_query = f"ERROR: {str(e)}"
-            state.requires_multiple_queries = False
-            
-        return state
 
-    def _generate_single_query(self, state: FlowState, messages_content: str) -> FlowState:
-        """Genera una sola consulta SQL"""
-        
-        # Preparar información de tablas validadas
+    def _validated_tables_info(self, state: FlowState) -> Dict[str, Any]:
+        """Prepara la información de tablas validadas para los prompts de generación SQL"""
         validated_tables_info = {}
         for table_name, validation_data in state.validated_tables.items():
             if validation_data.get("exists", False):
@@ -585,6 +958,10 @@ class AnalystIAGraph:
                     "sample_data": sample_snippet,
                     "column_stats": validation_data.get("column_stats", {})
                 }
+        return validated_tables_info
+
+    def _single_query_prompt(self, state: FlowState, messages_content: str) -> str:
+        """Construye el prompt de generación de una sola consulta SQL"""
         
         # Construir la sección de errores anteriores si existen
         previous_errors = ""
@@ -597,43 +974,19 @@ class AnalystIAGraph:
             if state.sql_query and not state.sql_query.startswith("ERROR") and not state.sql_query == "NO_SQL_NEEDED":
                 previous_errors += f"\nConsulta anterior que falló:\n{state.sql_query}\n"
         
-        prompt = f"""
+        return f"""
         Consulta: {messages_content}
         Análisis previo: {state.agent_analysis}
         Intento: {state.retry_count + 1} de {state.max_retries}
         
         INFORMACIÓN DE TABLAS VALIDADAS:
-        {json.dumps(validated_tables_info, indent=2)}
+        {json.dumps(self._validated_tables_info(state), indent=2, default=str)}
         {previous_errors}
         {prompt_single_query}
         """
-        
-        try:
-            response = self.llm.invoke(prompt).content.strip()
-            response = self._clean_sql_response(response)
-            state.sql_query = response
-        except Exception as e:
-            logging.error(f"Error generando query simple: {str(e)}")
-            state.sql_query = f"ERROR: {str(e)}"
-            
-        return state
 
-    def _generate_multiple_queries(self, state: FlowState, messages_content: str) -> FlowState:
-        """Genera múltiples consultas SQL para análisis complejo"""
-        
-        # Preparar información de tablas validadas
-        validated_tables_info = {}
-        for table_name, validation_data in state.validated_tables.items():
-            if validation_data.get("exists", False):
-                sample_data = state.table_samples.get(table_name, [])
-                sample_snippet = sample_data[:3] if sample_data else []
-                
-                validated_tables_info[table_name] = {
-                    "definition": validation_data.get("definition", {}),
-                    "total_rows": validation_data.get("total_rows", 0),
-                    "sample_data": sample_snippet,
-                    "column_stats": validation_data.get("column_stats", {})
-                }
+    def _multi_query_prompt(self, state: FlowState, messages_content: str) -> str:
+        """Construye el prompt de generación de múltiples consultas SQL"""
         
         # Construir la sección de errores anteriores si existen
         previous_errors = ""
@@ -648,27 +1001,57 @@ class AnalystIAGraph:
                 for i, query in enumerate(state.sql_queries):
                     previous_errors += f"QUERY_{i+1}: {query}\n"
         
-        prompt = f"""
+        return f"""
         Consulta: {messages_content}
         Análisis previo: {state.agent_analysis}
         Intento: {state.retry_count + 1} de {state.max_retries}
         
         INFORMACIÓN DE TABLAS VALIDADAS:
-        {json.dumps(validated_tables_info, indent=2)}
+        {json.dumps(self._validated_tables_info(state), indent=2, default=str)}
         {previous_errors}
         {prompt_multi_query}
         """
-        
+
+    def _generate_single_query(self, state: FlowState, messages_content: str) -> FlowState:
+        """Genera una sola consulta SQL"""
         try:
-            response = self.llm.invoke(prompt).content.strip()
-            queries = self._parse_multiple_queries(response)
+            response = self.llm.invoke(self._single_query_prompt(state, messages_content)).content.strip()
+            state.sql_query = self._clean_sql_response(response)
+        except Exception as e:
+            logging.error(f"Error generando query simple: {str(e)}")
+            state.sql_query = f"ERROR: {str(e)}"
             
-            if queries:
-                state.sql_queries = queries
-                state.sql_query = f"MULTIPLE_QUERIES: {len(queries)} queries generated"
-            else:
-                # Fallback a query simple
-                state.requires_multiple_queries = False
+        return state
+
+    async def _agenerate_single_query(self, state: FlowState, messages_content: str) -> FlowState:
+        """Versión asíncrona de _generate_single_query"""
+        try:
+            response = (await self.llm.ainvoke(self._single_query_prompt(state, messages_content))).content.strip()
+            state.sql_query = self._clean_sql_response(response)
+        except Exception as e:
+            logging.error(f"Error generando query simple: {str(e)}")
+            state.sql_query = f"ERROR: {str(e)}"
+            
+        return state
+
+    def _apply_multiple_queries(self, state: FlowState, response: str) -> bool:
+        """Guarda las queries parseadas; devuelve False si hay que caer a query simple"""
+        queries = self._parse_multiple_queries(response)
+        
+        if queries:
+            state.sql_queries = queries
+            state.sql_query = f"MULTIPLE_QUERIES: {len(queries)} queries generated"
+            return True
+            
+        # Fallback a query simple
+        state.requires_multiple_queries = False
+        return False
+
+    def _generate_multiple_queries(self, state: FlowState, messages_content: str) -> FlowState:
+        """Genera múltiples consultas SQL para análisis complejo"""
+        try:
+            response = self.llm.invoke(self._multi_query_prompt(state, messages_content)).content.strip()
+            if not self._apply_multiple_queries(state, response):
                 return self._generate_single_query(state, messages_content)
                 
         except Exception as e:
@@ -678,62 +1061,263 @@ class AnalystIAGraph:
             
         return state
 
+    async def _agenerate_multiple_queries(self, state: FlowState, messages_content: str) -> FlowState:
+        """Versión asíncrona de _generate_multiple_queries"""
+        try:
+            response = (await self.llm.ainvoke(self._multi_query_prompt(state, messages_content))).content.strip()
+            if not self._apply_multiple_queries(state, response):
+                return await self._agenerate_single_query(state, messages_content)
+                
+        except Exception as e:
+            logging.error(f"Error generando queries múltiples: {str(e)}")
+            state.sql_query = f"ERROR: {str(e)}"
+            state.requires_multiple_queries = False
+            
+        return state
+
     def sql_process(self, state: FlowState) -> FlowState:
         """Ejecuta la consulta SQL generada"""
         
-        if not state.sql_query or state.sql_query.startswith("ERROR") or state.sql_query == "NO_SQL_NEEDED":
-            state.sql_results = {
-                "query": state.sql_query or "NO_QUERY",
-                "total_rows": 0,
-                "returned_rows": 0,
-                "data": [],
-                "truncated": False
-            }
+        if not self._has_executable_query(state):
+            state.sql_results = self._empty_sql_results(state)
             return state
             
+        if self._run_template_in_memory(state):
+            return state
+
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Ejecutar la consulta
-            cursor.execute(state.sql_query)
-            rows = cursor.fetchall()
-            
-            # Convertir a lista de diccionarios para serialización
-            all_results = [dict(row) for row in rows] if rows else []
+            # Validar el plan estimado y ejecutar la consulta trayendo solo el presupuesto de filas
+            with readonly_connection() as conn:
+                if state.template_match:
+                    # Plantilla KPI: consulta preparada y acotada por la propia plantilla
+                    template = state.template_match
+                    rows = conn.execute(template["query"], template["statement_params"], prepare=True).fetchall()
+                    total_rows, exact, plan = len(rows), True, None
+                else:
+                    query, plan = guard_query_cost(conn, state.sql_query)
+                    rows, total_rows, exact = fetch_bounded(conn, query, self.SINGLE_QUERY_ROW_LIMIT)
+                
+            state.sql_results = self._build_sql_results(state.sql_query, rows, total_rows, exact, plan)
             
-            # Limitar a máximo 300 filas para retorno, pero mantener info completa
-            limited_results = all_results[:300] if len(all_results) > 60 else all_results
+        except Exception as e:
+            logging.error(f"Error ejecutando SQL: {str(e)}")
+            state.sql_results = self._sql_error_results(state.sql_query, e)
             
-            # Crear estructura consistente
-            state.sql_results = {
-                "query": state.sql_query,
-                "total_rows": len(all_results),
-                "returned_rows": len(limited_results),
-                "data": limited_results,
-                "truncated": len(all_results) > 60
-            }
+        return state
+
+    async def asql_process(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de sql_process"""
+        
+        if not self._has_executable_query(state):
+            state.sql_results = self._empty_sql_results(state)
+            return state
             
-            cursor.close()
-            conn.close()
+        if await self._arun_template_in_memory(state):
+            return state
+
+        try:
+            async with async_readonly_connection() as conn:
+                if state.template_match:
+                    template = state.template_match
+                    rows = await (await conn.execute(template["query"], template["statement_params"], prepare=True)).fetchall()
+                    total_rows, exact, plan = len(rows), True, None
+                else:
+                    query, plan = await aguard_query_cost(conn, state.sql_query)
+                    rows, total_rows, exact = await afetch_bounded(conn, query, self.SINGLE_QUERY_ROW_LIMIT)
+                
+            state.sql_results = self._build_sql_results(state.sql_query, rows, total_rows, exact, plan)
             
         except Exception as e:
             logging.error(f"Error ejecutando SQL: {str(e)}")
-            state.sql_results = {
-                "query": state.sql_query,
-                "error": f"Error al ejecutar consulta: {str(e)}",
-                "total_rows": 0,
-                "returned_rows": 0,
-                "data": [],
-                "truncated": False
-            }
+            state.sql_results = self._sql_error_results(state.sql_query, e)
             
         return state
 
+    def _run_template_in_memory(self, state: FlowState) -> bool:
+        """Resuelve la plantilla KPI sobre el snapshot columnar (sin ir a PostgreSQL) si está al día"""
+        if not state.template_match:
+            return False
+        try:
+            rows = self.columnar.execute_template(state.template_match)
+        except Exception as e:
+            logging.error(f"Error ejecutando la plantilla en el snapshot columnar: {str(e)}")
+            return False
+        return self._store_template_rows(state, rows)
+
+    async def _arun_template_in_memory(self, state: FlowState) -> bool:
+        """Versión asíncrona de _run_template_in_memory"""
+        if not state.template_match:
+            return False
+        try:
+            rows = await self.columnar.aexecute_template(state.template_match)
+        except Exception as e:
+            logging.error(f"Error ejecutando la plantilla en el snapshot columnar: {str(e)}")
+            return False
+        return self._store_template_rows(state, rows)
+
+    def _store_template_rows(self, state: FlowState, rows: Optional[List[Dict[str, Any]]]) -> bool:
+        if rows is None:
+            return False
+        state.template_match = {**state.template_match, "engine": "columnar"}
+        state.sql_results = self._build_sql_results(state.sql_query, rows, len(rows), True)
+        return True
+
+    @staticmethod
+    def _has_executable_query(state: FlowState) -> bool:
+        return bool(state.sql_query) and not state.sql_query.startswith("ERROR") and state.sql_query != "NO_SQL_NEEDED"
+
+    @staticmethod
+    def _empty_sql_results(state: FlowState) -> Dict[str, Any]:
+        return {
+            "query": state.sql_query or "NO_QUERY",
+            "total_rows": 0,
+            "returned_rows": 0,
+            "data": [],
+            "truncated": False
+        }
+
+    @staticmethod
+    def _build_sql_results(query: str, rows: List[Dict[str, Any]], total_rows: int, exact: bool,
+                           plan: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Crea la estructura de resultados de una consulta simple"""
+        return {
+            "query": query,
+            "total_rows": total_rows,
+            # Si el cost guard agregó LIMIT el total queda acotado por ese LIMIT
+            "total_rows_exact": exact and (plan or {}).get("action") != "limited",
+            "returned_rows": len(rows),
+            "data": rows,
+            "truncated": total_rows > len(rows),
+            "plan": plan
+        }
+
+    @staticmethod
+    def _sql_error_results(query: str, error: Exception) -> Dict[str, Any]:
+        return {
+            "query": query,
+            "error": f"Error al ejecutar consulta: {str(error)}",
+            **describe_db_error(error),
+            "total_rows": 0,
+            "returned_rows": 0,
+            "data": [],
+            "truncated": False
+        }
+
     def multi_query_processor(self, state: FlowState) -> FlowState:
-        """Procesa múltiples consultas SQL secuencialmente"""
+        """Procesa múltiples consultas SQL en paralelo (hasta MULTI_QUERY_PARALLELISM a la vez)"""
         
         if not state.sql_queries:
+            self._apply_multi_query_results(state, [])
+            return state
+            
+        # Las consultas son independientes: cada hilo toma su propia conexión del pool.
+        # executor.map conserva el orden original de las consultas.
+        with ThreadPoolExecutor(max_workers=min(self.query_parallelism, len(state.sql_queries))) as executor:
+            all_results = list(executor.map(self._run_single_query, range(len(state.sql_queries)), state.sql_queries))
+            
+        self._apply_multi_query_results(state, all_results)
+        return state
+
+    async def amulti_query_processor(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de multi_query_processor"""
+        
+        if not state.sql_queries:
+            self._apply_multi_query_results(state, [])
+            return state
+            
+        semaphore = asyncio.Semaphore(self.query_parallelism)
+        
+        async def run_limited(i: int, query: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self._arun_single_query(i, query)
+                
+        # gather conserva el orden original de las consultas
+        all_results = await asyncio.gather(*(run_limited(i, query) for i, query in enumerate(state.sql_queries)))
+        self._apply_multi_query_results(state, list(all_results))
+        return state
+
+    def _run_single_query(self, i: int, query: str) -> Dict[str, Any]:
+        """Ejecuta una de las consultas de multi_query_processor"""
+        # Limpiar la query individual
+        clean_query = self._clean_sql_response(query)
+        if not clean_query or clean_query.startswith("ERROR"):
+            return self._invalid_query_result(i, query, clean_query)
+            
+        try:
+            with readonly_connection() as conn:
+                guarded_query, plan = guard_query_cost(conn, clean_query)
+                rows, total_rows, exact = fetch_bounded(conn, guarded_query, self.MULTI_QUERY_ROW_LIMIT)
+                
+            return self._query_result(i, clean_query, rows, total_rows, exact, plan)
+            
+        except Exception as e:
+            logging.error(f"Error ejecutando query {i+1}: {str(e)}")
+            return self._query_error_result(i, query, e)
+
+    async def _arun_single_query(self, i: int, query: str) -> Dict[str, Any]:
+        """Versión asíncrona de _run_single_query"""
+        clean_query = self._clean_sql_response(query)
+        if not clean_query or clean_query.startswith("ERROR"):
+            return self._invalid_query_result(i, query, clean_query)
+            
+        try:
+            async with async_readonly_connection() as conn:
+                guarded_query, plan = await aguard_query_cost(conn, clean_query)
+                rows, total_rows, exact = await afetch_bounded(conn, guarded_query, self.MULTI_QUERY_ROW_LIMIT)
+                
+            return self._query_result(i, clean_query, rows, total_rows, exact, plan)
+            
+        except Exception as e:
+            logging.error(f"Error ejecutando query {i+1}: {str(e)}")
+            return self._query_error_result(i, query, e)
+
+    @staticmethod
+    def _query_result(i: int, query: str, rows: List[Dict[str, Any]], total_rows: int, exact: bool,
+                      plan: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return {
+            "query_index": i + 1,
+            "query": query,
+            "total_rows": total_rows,
+            "total_rows_exact": exact and (plan or {}).get("action") != "limited",
+            "returned_rows": len(rows),
+            "data": rows,
+            "truncated": total_rows > len(rows),
+            "plan": plan,
+            "success": True
+        }
+
+    @staticmethod
+    def _invalid_query_result(i: int, query: str, clean_query: str) -> Dict[str, Any]:
+        return {
+            "query_index": i + 1,
+            "query": query,
+            "error": f"Query inválida: {clean_query}",
+            "total_rows": 0,
+            "returned_rows": 0,
+            "data": [],
+            "truncated": False,
+            "success": False
+        }
+
+    @staticmethod
+    def _query_error_result(i: int, query: str, error: Exception) -> Dict[str, Any]:
+        return {
+            "query_index": i + 1,
+            "query": query,
+            "error": f"Error ejecutando consulta: {str(error)}",
+            **describe_db_error(error),
+            "total_rows": 0,
+            "returned_rows": 0,
+            "data": [],
+            "truncated": False,
+            "success": False
+        }
+
+    def _apply_multi_query_results(self, state: FlowState, all_results: List[Dict[str, Any]]) -> None:
+        """Consolida los resultados de múltiples queries en el estado"""
+        state.all_sql_results = all_results
+        
+        if not all_results:
             state.sql_results = {
                 "query": "NO_QUERIES",
                 "total_queries": 0,
@@ -743,70 +1327,10 @@ class AnalystIAGraph:
                 "queries_detail": [],
                 "summary": "No se generaron consultas"
             }
-            state.all_sql_results = []
-            return state
-            
-        all_results = []
-        total_rows_across_queries = 0
-        
-        for i, query in enumerate(state.sql_queries):
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # Limpiar la query individual
-                clean_query = self._clean_sql_response(query)
-                
-                if clean_query and not clean_query.startswith("ERROR"):
-                    cursor.execute(clean_query)
-                    rows = cursor.fetchall()
-                    all_query_results = [dict(row) for row in rows] if rows else []
-                    
-                    # Limitar a máximo 50 filas por query
-                    limited_results = all_query_results[:50] if len(all_query_results) > 50 else all_query_results
-                    total_rows_across_queries += len(all_query_results)
-                    
-                    all_results.append({
-                        "query_index": i + 1,
-                        "query": clean_query,
-                        "total_rows": len(all_query_results),
-                        "returned_rows": len(limited_results),
-                        "data": limited_results,
-                        "truncated": len(all_query_results) > 60,
-                        "success": True
-                    })
-                else:
-                    all_results.append({
-                        "query_index": i + 1,
-                        "query": query,
-                        "error": f"Query inválida: {clean_query}",
-                        "total_rows": 0,
-                        "returned_rows": 0,
-                        "data": [],
-                        "truncated": False,
-                        "success": False
-                    })
-                
-                cursor.close()
-                conn.close()
-                
-            except Exception as e:
-                logging.error(f"Error ejecutando query {i+1}: {str(e)}")
-                all_results.append({
-                    "query_index": i + 1,
-                    "query": query,
-                    "error": f"Error ejecutando consulta: {str(e)}",
-                    "total_rows": 0,
-                    "returned_rows": 0,
-                    "data": [],
-                    "truncated": False,
-                    "success": False
-                })
-        
-        # Consolidar todos los resultados
-        state.all_sql_results = all_results
+            return
         
         # Para compatibilidad, poner el resumen en sql_results
+        total_rows_across_queries = sum(r.get("total_rows", 0) for r in all_results)
         successful_queries = sum(1 for r in all_results if r.get("success", False))
         total_returned_rows = sum(r.get("returned_rows", 0) for r in all_results)
         
@@ -819,8 +1343,6 @@ class AnalystIAGraph:
             "queries_detail": all_results,
             "summary": f"Ejecutadas {len(all_results)} consultas ({successful_queries} exitosas), {total_rows_across_queries} filas encontradas, {total_returned_rows} filas retornadas"
         }
-        
-        return state
 
     def sql_evaluator(self, state: FlowState) -> FlowState:
         """Evalúa la calidad y validez de la consulta SQL"""
@@ -844,7 +1366,7 @@ class AnalystIAGraph:
                 error_msg = state.sql_results.get("error", "Error desconocido")
                 # Incrementar contador de reintentos y verificar límite
                 state.retry_count += 1
-                state.error_messages.append(f"Intento {state.retry_count}: {error_msg}")
+                state.error_messages.append(f"Intento {state.retry_count}: {error_msg}{self._error_hint(state.sql_results)}")
                 
                 if state.retry_count >= state.max_retries:
                     # Alcanzó límite de reintentos - continuar al siguiente paso pero marcar como fallido
@@ -853,6 +1375,8 @@ class AnalystIAGraph:
                     state.query_evaluation = {
                         "valid": False, 
                         "reason": f"Error después de {state.retry_count} intentos: {error_msg}",
+                        "error_type": state.sql_results.get("error_type"),
+                        "plan": state.sql_results.get("plan"),
                         "errors": state.error_messages,
                         "continue_anyway": True  # Continuar al siguiente paso
                     }
@@ -863,6 +1387,8 @@ class AnalystIAGraph:
                     state.query_evaluation = {
                         "valid": False, 
                         "reason": f"Error en ejecución: {error_msg}",
+                        "error_type": state.sql_results.get("error_type"),
+                        "plan": state.sql_results.get("plan"),
                         "errors": state.error_messages,
                         "attempt": state.retry_count,
                         "max_attempts": state.max_retries
@@ -878,7 +1404,11 @@ class AnalystIAGraph:
                     # Verificar si hay suficientes consultas exitosas
                     if successful_queries < total_queries * 0.5:  # Si menos del 50% fueron exitosas
                         state.retry_count += 1
-                        state.error_messages.append(f"Intento {state.retry_count}: Solo {successful_queries} de {total_queries} consultas fueron exitosas")
+                        failed_details = "".join(
+                            f"\n  - Query {r['query_index']}: {r.get('error')}{self._error_hint(r)}"
+                            for r in state.all_sql_results if not r.get("success", False)
+                        )
+                        state.error_messages.append(f"Intento {state.retry_count}: Solo {successful_queries} de {total_queries} consultas fueron exitosas{failed_details}")
                         
                         if state.retry_count >= state.max_retries:
                             state.is_sql_valid = False
@@ -905,7 +1435,8 @@ class AnalystIAGraph:
                             "valid": True,
                             "reason": f"Múltiples consultas ejecutadas: {successful_queries}/{total_queries} exitosas",
                             "total_rows_found": state.sql_results.get("total_rows_found", 0),
-                            "total_rows_returned": state.sql_results.get("total_rows_returned", 0)
+                            "total_rows_returned": state.sql_results.get("total_rows_returned", 0),
+                            "plans": [r.get("plan") for r in state.all_sql_results]
                         }
                 else:
                     # Consulta simple exitosa
@@ -914,7 +1445,8 @@ class AnalystIAGraph:
                         "reason": "Consulta ejecutada exitosamente",
                         "total_rows": state.sql_results.get("total_rows", 0),
                         "returned_rows": state.sql_results.get("returned_rows", 0),
-                        "truncated": state.sql_results.get("truncated", False)
+                        "truncated": state.sql_results.get("truncated", False),
+                        "plan": state.sql_results.get("plan")
                     }
         else:
             # Formato legacy - lista
@@ -939,6 +1471,7 @@ class AnalystIAGraph:
                     state.query_evaluation = {
                         "valid": False, 
                         "reason": f"Error en ejecución: {error_msg}",
+                        "error_type": state.sql_results.get("error_type"),
                         "errors": state.error_messages,
                         "attempt": state.retry_count,
                         "max_attempts": state.max_retries
@@ -955,8 +1488,83 @@ class AnalystIAGraph:
             
         return state
 
+    @staticmethod
+    def _error_hint(result: Dict[str, Any]) -> str:
+        """Indicación para el reintento de sql_agent según el tipo de error estructurado"""
+        error_type = result.get("error_type")
+        if error_type == "timeout":
+            return (f" [TIMEOUT: la consulta superó {result.get('timeout_ms')} ms; reduce su costo: filtra antes de agregar, "
+                    "evita productos cartesianos y subconsultas correlacionadas, agrega LIMIT]")
+        if error_type == "lock_timeout":
+            return f" [LOCK_TIMEOUT: no se obtuvo un bloqueo en {result.get('timeout_ms')} ms; usa solo SELECT sin FOR UPDATE]"
+        if error_type == "read_only":
+            return " [READ_ONLY: solo se permiten consultas SELECT de lectura]"
+        if error_type == "too_expensive":
+            return (" [TOO_EXPENSIVE: el plan estimado supera los umbrales; filtra por país/ciudad/métrica, "
+                    "agrega antes de unir tablas y limita el número de filas devueltas]")
+        return ""
+
+    def result_analytics_node(self, state: FlowState) -> FlowState:
+        """Calcula en local (NumPy) las estadísticas de los resultados que verá el analista"""
+        try:
+            if state.requires_multiple_queries and state.all_sql_results:
+                state.result_stats = {
+                    "queries": {
+                        result["query_index"]: summarise_result(result.get("data", []))
+                        for result in state.all_sql_results
+                        if result.get("success", False) and "error" not in result
+                    }
+                }
+            elif isinstance(state.sql_results, dict) and "error" not in state.sql_results and state.sql_results.get("data"):
+                state.result_stats = summarise_result(state.sql_results["data"])
+        except Exception as e:
+            logging.error(f"Error calculando estadísticas de resultados: {str(e)}")
+            state.result_stats = None
+        return state
+
+    def _budget_results(self, state: FlowState) -> None:
+        """Elige las filas/columnas de cada resultado que entran en el prompt del analista"""
+        if state.requires_multiple_queries and state.all_sql_results:
+            results = {
+                r["query_index"]: (r.get("data", []), r.get("total_rows"))
+                for r in state.all_sql_results if r.get("success", False) and "error" not in r
+            }
+        elif isinstance(state.sql_results, dict) and "error" not in state.sql_results:
+            results = {0: (state.sql_results.get("data", []), state.sql_results.get("total_rows"))}
+        else:
+            results = {}
+        try:
+            state.result_budget = budget_results(results, self.result_token_budget) if results else None
+        except Exception as e:
+            logging.error(f"Error aplicando el presupuesto de tokens: {str(e)}")
+            state.result_budget = None
+
     def data_analyst(self, state: FlowState) -> FlowState:
         """Analiza los resultados y genera insights"""
+        self._budget_results(state)
+        try:
+            response = self.llm.invoke(self._analyst_prompt(state)).content
+            state.data_analysis = response
+        except Exception as e:
+            logging.error(f"Error en data_analyst: {str(e)}")
+            state.data_analysis = f"Error en análisis: {str(e)}"
+            
+        return state
+
+    async def adata_analyst(self, state: FlowState) -> FlowState:
+        """Versión asíncrona de data_analyst"""
+        self._budget_results(state)
+        try:
+            response = (await self.llm.ainvoke(self._analyst_prompt(state))).content
+            state.data_analysis = response
+        except Exception as e:
+            logging.error(f"Error en data_analyst: {str(e)}")
+            state.data_analysis = f"Error en análisis: {str(e)}"
+            
+        return state
+
+    def _analyst_prompt(self, state: FlowState) -> str:
+        """Construye el prompt del analista según el tipo de resultado"""
         
         messages_content = self._extract_content_from_messages(state.messages)
         
@@ -970,7 +1578,7 @@ class AnalystIAGraph:
                 }
         
         if state.sql_query == "NO_SQL_NEEDED":
-            prompt = f"""
+            return f"""
             La consulta del usuario no requiere acceso a base de datos. 
             Consulta original: {messages_content}
             Análisis previo: {state.agent_analysis}
@@ -979,7 +1587,7 @@ class AnalystIAGraph:
             """
         elif state.requires_multiple_queries and state.all_sql_results:
             # Análisis de múltiples queries
-            prompt = f"""
+            return f"""
             Analiza los resultados de múltiples consultas SQL y genera un análisis integral:
             
             Consulta original: {messages_content}
@@ -989,7 +1597,7 @@ class AnalystIAGraph:
             {json.dumps(validated_tables_summary)}
             
             Resultados detallados:
-            {self._format_multiple_results_for_analysis(state.all_sql_results)}
+            {self._format_multiple_results_for_analysis(state.all_sql_results, state.result_stats, state.result_budget)}
             
             Proporciona:
             1. **Resumen ejecutivo** de todos los hallazgos
@@ -1003,7 +1611,7 @@ class AnalystIAGraph:
             """
         else:
             # Análisis de query simple
-            prompt = f"""
+            return f"""
             Analiza los siguientes resultados de la consulta SQL y genera insights útiles:
             
             Consulta original: {messages_content}
@@ -1012,7 +1620,7 @@ class AnalystIAGraph:
             Información de tablas validadas:
             {json.dumps(validated_tables_summary)}
             
-            Resultados: {state.sql_results}
+            {self._format_single_result_for_analysis(state)}
             
             Proporciona:
             1. Un resumen claro de los resultados
@@ -1023,15 +1631,6 @@ class AnalystIAGraph:
             Responde de manera clara y profesional.
             Utiliza la información de la estructura y datos de muestra de las tablas para enriquecer tu análisis.
             """
-        
-        try:
-            response = self.llm.invoke(prompt).content
-            state.data_analysis = response
-        except Exception as e:
-            logging.error(f"Error en data_analyst: {str(e)}")
-            state.data_analysis = f"Error en análisis: {str(e)}"
-            
-        return state
 
     
     def _extract_content_from_messages(self, messages: List[Dict[str, str]]) -> str:
@@ -1093,9 +1692,51 @@ class AnalystIAGraph:
         
         return queries
 
-    def _format_multiple_results_for_analysis(self, all_results: List[Dict[str, Any]]) -> str:
+    @staticmethod
+    def _stats_for_prompt(stats: Dict[str, Any]) -> str:
+        return ("Estadísticas calculadas localmente sobre todas las filas (usa estos valores, no los recalcules): "
+                f"{json.dumps(stats, ensure_ascii=False, default=str)}")
+
+    @staticmethod
+    def _budgeted_rows_for_prompt(budget: Dict[str, Any], returned_rows: int, total_rows: Optional[int] = None) -> str:
+        """Filas incluidas según el presupuesto de tokens y qué se dejó fuera"""
+        total_rows = returned_rows if total_rows is None else total_rows
+        if not returned_rows and not total_rows:
+            return "Sin datos encontrados"
+        text = f"Filas incluidas: {len(budget['rows'])} de {returned_rows} traídas ({total_rows} encontradas)"
+        if budget["rows"]:
+            text += f": {json.dumps(budget['rows'], ensure_ascii=False, default=str)}"
+        else:
+            text += "; ninguna fila cabe en el presupuesto de tokens, usar las estadísticas"
+        if budget["constant_columns"]:
+            text += f"\nColumnas con el mismo valor en todas las filas: {json.dumps(budget['constant_columns'], ensure_ascii=False, default=str)}"
+        dropped = {k: v for k, v in budget["dropped"].items() if v}
+        if dropped:
+            text += f"\nOmitido por presupuesto de tokens: {json.dumps(dropped, ensure_ascii=False)}"
+        return text
+
+    def _format_single_result_for_analysis(self, state: FlowState) -> str:
+        """Resultados de la consulta simple: estadísticas locales y filas dentro del presupuesto"""
+        if not isinstance(state.sql_results, dict):
+            return f"Resultados: {state.sql_results}"
+        results = state.sql_results
+        if "error" in results:
+            return f"Error en la consulta: {results['error']}"
+        budget = (state.result_budget or {}).get(0)
+        if budget is None:
+            budget = budget_result(results.get("data", []), self.result_token_budget, results.get("total_rows"))
+        parts = [f"Filas encontradas: {results.get('total_rows', 0)}, filas traídas: {results.get('returned_rows', 0)}"]
+        if state.result_stats:
+            parts.append(self._stats_for_prompt(state.result_stats))
+        parts.append(self._budgeted_rows_for_prompt(budget, results.get('returned_rows', 0), results.get('total_rows')))
+        return "\n            ".join(parts)
+
+    def _format_multiple_results_for_analysis(self, all_results: List[Dict[str, Any]],
+                                              result_stats: Optional[Dict[str, Any]] = None,
+                                              result_budget: Optional[Dict[int, Dict[str, Any]]] = None) -> str:
         """Formatea los resultados de múltiples queries para análisis"""
         formatted = []
+        query_stats = (result_stats or {}).get("queries", {})
         
         for result in all_results:
             query_info = f"Query {result['query_index']}: {result['query']}"
@@ -1106,24 +1747,21 @@ class AnalystIAGraph:
             else:
                 total_rows = result.get('total_rows', 0)
                 returned_rows = result.get('returned_rows', 0)
-                truncated = result.get('truncated', False)
-                data_sample = result.get('data', [])
                 
                 # Información de estado
-                status_info = f"Estado: Exitoso\nFilas encontradas: {total_rows}\nFilas retornadas: {returned_rows}"
-                if truncated:
-                    status_info += " (datos truncados a 50 filas)"
+                status_info = f"Estado: Exitoso\nFilas encontradas: {total_rows}\nFilas traídas: {returned_rows}"
                 
-                # Muestra de datos
-                if data_sample:
-                    if len(data_sample) <= 3:
-                        preview = f"Datos completos: {data_sample}"
-                    else:
-                        preview = f"Muestra de datos (primeros 3 de {len(data_sample)}): {data_sample[:3]}"
-                else:
-                    preview = "Sin datos encontrados"
+                # Estadísticas locales y filas que caben en el presupuesto de tokens
+                details = []
+                if result['query_index'] in query_stats:
+                    details.append(self._stats_for_prompt(query_stats[result['query_index']]))
+                budget = (result_budget or {}).get(result['query_index'])
+                if budget is not None:
+                    details.append(self._budgeted_rows_for_prompt(budget, returned_rows, total_rows))
+                elif not result.get('data'):
+                    details.append("Sin datos encontrados")
                 
-                formatted.append(f"{query_info}\n{status_info}\n{preview}\n")
+                formatted.append(f"{query_info}\n{status_info}\n" + "\n".join(details) + "\n")
         
         return "\n".join(formatted)
 
@@ -1183,6 +1821,107 @@ class AnalystIAGraph:
         return obj
             
         
+    @staticmethod
+    def _initial_state(segments: Union[str, List[Any]]) -> FlowState:
+        """Prepara el estado inicial a partir de los mensajes recibidos"""
+        if isinstance(segments, str):
+            return FlowState(input=[segments])
+        elif isinstance(segments, list) and all(isinstance(s, str) for s in segments):
+            return FlowState(input=segments)
+        else:
+            return FlowState(messages=segments)
+
+    def _build_result(self, final_state: Dict[str, Any]) -> Dict[str, Any]:
+        """Convierte el estado final del grafo en el diccionario de resultado"""
+        # El final_state es un diccionario, no un objeto FlowState
+        # Acceder a los valores usando claves de diccionario
+        return {
+            'agent_analysis': final_state.get('agent_analysis'),
+            'is_ambiguous': final_state.get('is_ambiguous', False),
+            'insufficient_data': final_state.get('insufficient_data', False),
+            'clarification_needed': final_state.get('clarification_needed'),
+            'requires_multiple_queries': final_state.get('requires_multiple_queries', False),
+            'sql_query': final_state.get('sql_query'),
+            'sql_queries': final_state.get('sql_queries', []),
+            'sql_results': self._serialise(final_state.get('sql_results')),
+            'all_sql_results': self._serialise(final_state.get('all_sql_results', [])),
+            'query_evaluation': final_state.get('query_evaluation'),
+            'data_analysis': final_state.get('data_analysis'),
+            'validated_tables': self._serialise(final_state.get('validated_tables', {})),
+            'table_validation_errors': final_state.get('table_validation_errors', []),
+            'catalog': final_state.get('catalog_info', {}),
+            'semantic_match': final_state.get('semantic_match'),
+            'template_match': final_state.get('template_match'),
+            'result_stats': final_state.get('result_stats'),
+            'result_budget': {
+                index: {k: v for k, v in budget.items() if k != "rows"}
+                for index, budget in (final_state.get('result_budget') or {}).items()
+            },
+            'retry_count': final_state.get('retry_count', 0),
+            'error_messages': final_state.get('error_messages', []),
+            'needs_retry': final_state.get('needs_retry', False),
+            'summary': final_state.get('data_analysis') or final_state.get('agent_analysis') or "No se pudo generar resumen"
+        }
+        
+    @staticmethod
+    def progress_payload(state: Dict[str, Any]) -> Dict[str, Any]:
+        """Resultados parciales del estado para avisos de progreso: análisis, SQL y filas"""
+        payload: Dict[str, Any] = {}
+        for key in ("agent_analysis", "clarification_needed", "sql_query"):
+            if state.get(key):
+                payload[key] = state[key]
+        if state.get("sql_queries"):
+            payload["sql_queries"] = state["sql_queries"]
+        results = state.get("sql_results")
+        if isinstance(results, dict):
+            payload["rows"] = {"returned_rows": results.get("returned_rows", 0), "total_rows": results.get("total_rows", 0)}
+            if results.get("error"):
+                payload["sql_error"] = results["error"]
+        if state.get("all_sql_results"):
+            payload["rows"] = [
+                {"query_index": r.get("query_index"), "returned_rows": r.get("returned_rows", 0), "total_rows": r.get("total_rows", 0)}
+                for r in state["all_sql_results"] if isinstance(r, dict)
+            ]
+        # El texto también llega token a token, salvo con respuestas cacheadas o modelos sin streaming
+        analysis = state.get("data_analysis")
+        if analysis:
+            payload["data_analysis"] = analysis[:PROGRESS_TEXT_LIMIT]
+            if len(analysis) > PROGRESS_TEXT_LIMIT:
+                payload["data_analysis_truncated"] = True
+        return payload
+
+    async def _astream_nodes(self, segments: List[Dict[str, str]],
+                             on_node: Optional[Callable[[str, Dict[str, Any]], Any]] = None,
+                             on_token: Optional[Callable[[str, str], Any]] = None) -> Dict[str, Any]:
+        """
+        Recorre el grafo paso a paso avisando de cada nodo terminado; devuelve el estado final.
+        Con `on_token` también emite los fragmentos de texto que genera el LLM en STREAMED_NODES.
+        """
+        final_state: Dict[str, Any] = {}
+        finished: List[str] = []
+        stream_mode = ["updates", "values"] + (["messages"] if on_token else [])
+        async for mode, chunk in self.graph.astream(
+            self._initial_state(segments), config={'recursion_limit': 200}, stream_mode=stream_mode
+        ):
+            if mode == "messages":
+                message, metadata = chunk
+                node = metadata.get("langgraph_node")
+                if node in STREAMED_NODES and isinstance(message.content, str) and message.content:
+                    notified = on_token(node, message.content)
+                    if inspect.isawaitable(notified):
+                        await notified
+                continue
+            if mode == "updates":
+                finished.extend(chunk)
+                continue
+            final_state = chunk
+            for node in finished if on_node else []:
+                notified = on_node(node, final_state)
+                if inspect.isawaitable(notified):
+                    await notified
+            finished = []
+        return final_state
+
     def run(self, segments: List[Dict[str, str]]) -> Dict[str, Any]:
         """
         Ejecuta el grafo completo para procesar la consulta del usuario
@@ -1194,46 +1933,43 @@ class AnalystIAGraph:
             Diccionario con el análisis completo y resultados
         """
         try:
-            # Preparar estado inicial
-            if isinstance(segments, str):
-                initial_state = FlowState(input=[segments])
-            elif isinstance(segments, list) and all(isinstance(s, str) for s in segments):
-                initial_state = FlowState(input=segments)
-            else:
-                initial_state = FlowState(messages=segments)
-            
             # Ejecutar el grafo
             final_state = self.graph.invoke(
-                initial_state, config={'recursion_limit': 200}
+                self._initial_state(segments), config={'recursion_limit': 200}
             )
+            self._remember_sql(final_state)
+            return self._build_result(final_state)
             
-            # El final_state es un diccionario, no un objeto FlowState
-            # Acceder a los valores usando claves de diccionario
-            result = {
-                'agent_analysis': final_state.get('agent_analysis'),
-                'is_ambiguous': final_state.get('is_ambiguous', False),
-                'insufficient_data': final_state.get('insufficient_data', False),
-                'clarification_needed': final_state.get('clarification_needed'),
-                'requires_multiple_queries': final_state.get('requires_multiple_queries', False),
-                'sql_query': final_state.get('sql_query'),
-                'sql_queries': final_state.get('sql_queries', []),
-                'sql_results': self._serialise(final_state.get('sql_results')),
-                'all_sql_results': self._serialise(final_state.get('all_sql_results', [])),
-                'query_evaluation': final_state.get('query_evaluation'),
-                'data_analysis': final_state.get('data_analysis'),
-                'validated_tables': self._serialise(final_state.get('validated_tables', {})),
-                'table_validation_errors': final_state.get('table_validation_errors', []),
-                'retry_count': final_state.get('retry_count', 0),
-                'error_messages': final_state.get('error_messages', []),
-                'needs_retry': final_state.get('needs_retry', False),
-                'summary': final_state.get('data_analysis') or final_state.get('agent_analysis') or "No se pudo generar resumen"
+        except Exception as e:
+            logging.error(f"Error en RetellIAGraph.run: {str(e)}")
+            return {
+                'error': f"Error procesando consulta: {str(e)}",
+                'summary': f"Error: {str(e)}"
             }
-            
-            return result
+
+    async def arun(self, segments: List[Dict[str, str]],
+                   on_node: Optional[Callable[[str, Dict[str, Any]], Any]] = None,
+                   on_token: Optional[Callable[[str, str], Any]] = None) -> Dict[str, Any]:
+        """
+        Versión asíncrona de run: recorre el grafo con graph.ainvoke, de modo que
+        las llamadas al LLM y a PostgreSQL no bloquean el event loop del servidor.
+        Si se pasa `on_node`, se llama (o se espera, si es asíncrono) al terminar cada
+        nodo con su nombre y el estado completo tras ese paso; `on_token` recibe el
+        texto de data_analyst a medida que el LLM lo genera.
+        """
+        try:
+            if on_node is None and on_token is None:
+                final_state = await self.graph.ainvoke(
+                    self._initial_state(segments), config={'recursion_limit': 200}
+                )
+            else:
+                final_state = await self._astream_nodes(segments, on_node, on_token)
+            await asyncio.to_thread(self._remember_sql, final_state)
+            return self._build_result(final_state)
             
         except Exception as e:
-            logging.error(f"Error en RetellIAGraph.run: {str(e)}")
+            logging.error(f"Error en AnalystIAGraph.arun: {str(e)}")
             return {
                 'error': f"Error procesando consulta: {str(e)}",
                 'summary': f"Error: {str(e)}"
-            }
\ No newline at end of file
+            }
@@ -0,0 +1,393 @@
+import json
+import math
+import re
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Columnas semanales en formato ancho (l0w_roll, l4w, ...): el número es el desfase en semanas
+WEEK_COLUMN = re.compile(r"^l(\d+)w(?:_roll)?$")
+# Columna de semana en formato largo (views.metrics_weekly, metrics_cube, plantilla de tendencia)
+WEEK_OFFSET_COLUMN = "week_offset"
+
+TOP_K = 5
+OUTLIER_Z = 3.0
+MAX_LABEL_COLUMNS = 4
+MAX_NUMERIC_COLUMNS = 10
+# Un corte de nivel es relevante si explica al menos esta fracción de la varianza de la serie
+BREAKPOINT_MIN_GAIN = 0.5
+
+
+def _num(value: Any) -> Optional[float]:
+    """Número redondeado para el prompt (None si es NULL o no finito)"""
+    if value is None:
+        return None
+    value = float(value)
+    if not math.isfinite(value):
+        return None
+    return round(value, 6)
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float, Decimal, np.number)) and not isinstance(value, bool)
+
+
+def _split_columns(rows: List[Dict[str, Any]]) -> Tuple[List[str], List[str]]:
+    """(numéricas, texto) según los valores no nulos de cada columna"""
+    numeric, text = [], []
+    for column in rows[0]:
+        present = [row.get(column) for row in rows if row.get(column) is not None]
+        (numeric if present and all(_is_number(v) for v in present) else text).append(column)
+    return numeric, text
+
+
+def _array(rows: List[Dict[str, Any]], column: str) -> np.ndarray:
+    return np.array([np.nan if row.get(column) is None else float(row[column]) for row in rows], dtype=np.float64)
+
+
+def _labels(rows: List[Dict[str, Any]], label_columns: List[str]) -> List[str]:
+    return [" / ".join(str(row[c]) for c in label_columns if row.get(c) is not None) or f"fila {i + 1}"
+            for i, row in enumerate(rows)]
+
+
+def describe(values: np.ndarray) -> Dict[str, Any]:
+    """Conteo, nulos, media, desviación y cuantiles de una columna"""
+    present = values[~np.isnan(values)]
+    if not len(present):
+        return {"count": 0, "nulls": int(len(values))}
+    p05, p25, p50, p75, p95 = np.percentile(present, [5, 25, 50, 75, 95])
+    return {
+        "count": int(len(present)),
+        "nulls": int(len(values) - len(present)),
+        "mean": _num(present.mean()),
+        "std": _num(present.std()),
+        "min": _num(present.min()),
+        "p05": _num(p05), "p25": _num(p25), "p50": _num(p50), "p75": _num(p75), "p95": _num(p95),
+        "max": _num(present.max()),
+    }
+
+
+def top_bottom(values: np.ndarray, labels: Sequence[str], k: int = TOP_K) -> Dict[str, List[Dict[str, Any]]]:
+    """Las k filas con mayor y con menor valor (ignorando NULL)"""
+    indexes = np.flatnonzero(~np.isnan(values))
+    order = indexes[np.argsort(values[indexes], kind="stable")]
+    return {
+        "top": [{"label": labels[i], "value": _num(values[i])} for i in order[::-1][:k]],
+        "bottom": [{"label": labels[i], "value": _num(values[i])} for i in order[:k]],
+    }
+
+
+def outliers(values: np.ndarray, labels: Sequence[str], threshold: float = OUTLIER_Z, k: int = TOP_K) -> List[Dict[str, Any]]:
+    """Filas con |z-score| >= threshold, de mayor a menor desviación"""
+    present = ~np.isnan(values)
+    if present.sum() < 3:
+        return []
+    std = values[present].std()
+    if std == 0:
+        return []
+    z = np.where(present, (values - values[present].mean()) / std, 0.0)
+    indexes = np.flatnonzero(np.abs(z) >= threshold)
+    indexes = indexes[np.argsort(-np.abs(z[indexes]), kind="stable")][:k]
+    return [{"label": labels[i], "value": _num(values[i]), "z": _num(z[i])} for i in indexes]
+
+
+def _slopes(matrix: np.ndarray) -> np.ndarray:
+    """Pendiente por fila (unidades por semana) de una matriz en orden cronológico, ignorando NaN"""
+    present = ~np.isnan(matrix)
+    x = np.broadcast_to(np.arange(matrix.shape[1], dtype=np.float64), matrix.shape)
+    counts = present.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = np.where(present, x, 0).sum(axis=1) / counts
+        y_mean = np.where(present, matrix, 0).sum(axis=1) / counts
+        dx = np.where(present, x - x_mean[:, None], 0)
+        dy = np.where(present, matrix - y_mean[:, None], 0)
+        slopes = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+    return np.where(counts >= 2, slopes, np.nan)
+
+
+def level_shift(series: np.ndarray) -> Optional[Dict[str, Any]]:
+    """
+    Cambio de nivel más marcado de una serie cronológica: el corte que minimiza el error
+    cuadrático de dos tramos de media constante. None si no explica suficiente varianza.
+    """
+    weeks_back = np.arange(len(series))[::-1]  # desfase de cada punto de la serie
+    present = ~np.isnan(series)
+    series, weeks_back = series[present], weeks_back[present]
+    n = len(series)
+    if n < 4:
+        return None
+    total_sse = ((series - series.mean()) ** 2).sum()
+    if total_sse == 0:
+        return None
+    cumsum, cumsq = np.cumsum(series), np.cumsum(series ** 2)
+    left_n = np.arange(2, n - 1)  # al menos dos puntos por tramo
+    left_sse = cumsq[left_n - 1] - cumsum[left_n - 1] ** 2 / left_n
+    right_sum, right_sq = cumsum[-1] - cumsum[left_n - 1], cumsq[-1] - cumsq[left_n - 1]
+    right_sse = right_sq - right_sum ** 2 / (n - left_n)
+    best = int(np.argmin(left_sse + right_sse))
+    gain = 1 - (left_sse[best] + right_sse[best]) / total_sse
+    if gain < BREAKPOINT_MIN_GAIN:
+        return None
+    split = int(left_n[best])
+    return {
+        # Desfase (semanas atrás) de la primera semana del nuevo nivel
+        "week_offset": int(weeks_back[split]),
+        "mean_before": _num(series[:split].mean()),
+        "mean_after": _num(series[split:].mean()),
+        "variance_explained": _num(gain),
+    }
+
+
+def series_trend(series: np.ndarray) -> Dict[str, Any]:
+    """Variación semanal, l0w vs l4w, pendiente y cambio de nivel de una serie cronológica"""
+    current = series[-1] if len(series) else np.nan
+    previous = series[-2] if len(series) >= 2 else np.nan
+    four_back = series[-5] if len(series) >= 5 else np.nan
+    slope = _slopes(series[None, :])[0] if len(series) else np.nan
+    return {
+        "series_oldest_to_newest": [_num(v) for v in series],
+        "l0w": _num(current),
+        "wow_delta": _num(current - previous),
+        "wow_delta_pct": _num((current - previous) / abs(previous) * 100) if previous else None,
+        "l0w_vs_l4w_delta": _num(current - four_back),
+        "l0w_vs_l4w_pct": _num((current - four_back) / abs(four_back) * 100) if four_back else None,
+        "slope_per_week": _num(slope),
+        "breakpoint": level_shift(series),
+    }
+
+
+def weekly_analysis(matrix: np.ndarray, labels: Sequence[str], k: int = TOP_K) -> Dict[str, Any]:
+    """
+    Análisis de una matriz filas × semanas con la columna i = desfase i (l0w primero):
+    tendencia de la media, distribución de deltas y filas que más suben/bajan.
+    """
+    chronological = matrix[:, ::-1]
+    with np.errstate(invalid="ignore"):
+        present = ~np.isnan(chronological)
+        means = np.where(present.any(axis=0),
+                         np.where(present, chronological, 0).sum(axis=0) / np.maximum(present.sum(axis=0), 1), np.nan)
+    analysis: Dict[str, Any] = {"weeks": int(matrix.shape[1]), "rows": int(matrix.shape[0]), "trend_of_mean": series_trend(means)}
+    if matrix.shape[0] < 2:
+        return analysis
+    deltas = {"wow_delta": matrix[:, 0] - matrix[:, 1]} if matrix.shape[1] >= 2 else {}
+    if matrix.shape[1] >= 5:
+        deltas["l0w_vs_l4w_delta"] = matrix[:, 0] - matrix[:, 4]
+    deltas["slope_per_week"] = _slopes(chronological)
+    for name, values in deltas.items():
+        analysis[name] = {
+            "distribution": describe(values),
+            **top_bottom(values, labels, k),
+            "outliers": outliers(values, labels, k=k),
+        }
+    return analysis
+
+
+def _wide_weeks(rows: List[Dict[str, Any]], numeric: List[str]) -> Optional[Tuple[List[str], np.ndarray]]:
+    """Columnas lNw(_roll) del resultado como matriz (columna i = desfase i), si hay al menos dos"""
+    offsets = {}
+    for column in numeric:
+        match = WEEK_COLUMN.match(column)
+        if match:
+            offsets[int(match.group(1))] = column
+    if len(offsets) < 2:
+        return None
+    columns = [offsets.get(offset) for offset in range(max(offsets) + 1)]
+    matrix = np.column_stack([_array(rows, c) if c else np.full(len(rows), np.nan) for c in columns])
+    return [c for c in columns if c], matrix
+
+
+def _long_weeks(rows: List[Dict[str, Any]], value_column: str, label_columns: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Pivota filas (etiqueta, week_offset, valor) a matriz etiquetas × semanas (media si hay repetidos)"""
+    labels = _labels(rows, label_columns) if label_columns else ["total"] * len(rows)
+    keys = list(dict.fromkeys(labels))
+    position = {label: i for i, label in enumerate(keys)}
+    offsets = np.array([row.get(WEEK_OFFSET_COLUMN) for row in rows], dtype=np.float64)
+    values = _array(rows, value_column)
+    valid = ~np.isnan(offsets) & ~np.isnan(values) & (offsets >= 0)
+    width = int(offsets[valid].max()) + 1 if valid.any() else 0
+    sums, counts = np.zeros((len(keys), width)), np.zeros((len(keys), width))
+    row_index = np.array([position[label] for label in labels])[valid]
+    np.add.at(sums, (row_index, offsets[valid].astype(int)), values[valid])
+    np.add.at(counts, (row_index, offsets[valid].astype(int)), 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return keys, np.where(counts > 0, sums / counts, np.nan)
+
+
+def summarise_result(rows: List[Dict[str, Any]], k: int = TOP_K) -> Dict[str, Any]:
+    """
+    Estadísticas compactas de un resultado SQL para el prompt del analista: distribución,
+    top/bottom-k y outliers por columna numérica y, si hay datos semanales (columnas lNw
+    o week_offset), variación semana a semana, l0w vs l4w, pendiente y cambio de nivel.
+    """
+    if not rows:
+        return {"rows": 0}
+    numeric, text = _split_columns(rows)
+    label_columns = text[:MAX_LABEL_COLUMNS]
+    labels = _labels(rows, label_columns)
+    summary: Dict[str, Any] = {"rows": len(rows), "label_columns": label_columns, "numeric_columns": numeric}
+
+    wide = _wide_weeks(rows, numeric)
+    week_columns = set(wide[0]) if wide else set()
+    if wide:
+        summary["weekly"] = {"format": "wide", "columns": wide[0], **weekly_analysis(wide[1], labels, k)}
+    elif WEEK_OFFSET_COLUMN in numeric:
+        week_columns = {WEEK_OFFSET_COLUMN}
+        summary["weekly"] = {"format": "long", "by_column": {}}
+        for column in [c for c in numeric if c != WEEK_OFFSET_COLUMN][:MAX_NUMERIC_COLUMNS]:
+            keys, matrix = _long_weeks(rows, column, label_columns)
+            if matrix.shape[1] >= 2:
+                summary["weekly"]["by_column"][column] = weekly_analysis(matrix, keys, k)
+
+    columns = {}
+    for column in [c for c in numeric if c not in week_columns][:MAX_NUMERIC_COLUMNS]:
+        values = _array(rows, column)
+        columns[column] = {"distribution": describe(values), **top_bottom(values, labels, k),
+                           "outliers": outliers(values, labels, k=k)}
+    current_week = next((c for c in week_columns if WEEK_COLUMN.match(c).group(1) == "0"), None) if wide else None
+    if current_week:
+        # De las columnas semanales basta con la distribución de la semana actual
+        columns[current_week] = {"distribution": describe(wide[1][:, 0])}
+    summary["columns"] = columns
+    return summary
+
+
+# ------------------------- Presupuesto de tokens del prompt -------------------------
+
+# Filas mínimas que se intenta mostrar de cada resultado antes de recortar columnas
+MIN_BUDGET_ROWS = 10
+CHARS_PER_TOKEN = 4
+
+_encoding: Any = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokens del texto con tiktoken si está disponible; si no, aproximación por caracteres"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def _to_json(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _ranges(indexes: Sequence[int]) -> str:
+    """Posiciones (base 1) compactadas en rangos: "3-7, 12, 15-40" """
+    parts, start, previous = [], None, None
+    for i in list(indexes) + [None]:
+        if start is not None and (i is None or i != previous + 1):
+            parts.append(f"{start + 1}" if start == previous else f"{start + 1}-{previous + 1}")
+            start = None
+        if i is not None and start is None:
+            start = i
+        previous = i
+    return ", ".join(parts)
+
+
+def representative_rows(rows: List[Dict[str, Any]], count: int, sort_column: Optional[str]) -> List[int]:
+    """
+    Índices (en el orden original) de `count` filas representativas: un tercio con los valores
+    más altos de `sort_column`, un tercio con los más bajos y el resto estratificado entre
+    ambos. Sin columna numérica: las primeras filas y el resto repartido uniformemente.
+    """
+    n = len(rows)
+    if count >= n:
+        return list(range(n))
+    if count <= 0:
+        return []
+    if sort_column is None:
+        head = count // 2
+        rest = np.linspace(head, n - 1, count - head).round().astype(int) if count > head else []
+        return sorted(set(range(head)) | set(int(i) for i in rest))
+    values = _array(rows, sort_column)
+    order = np.argsort(np.where(np.isnan(values), -np.inf, values), kind="stable")[::-1]
+    extremes = count // 3
+    top, bottom, middle = order[:extremes], order[n - extremes:] if extremes else order[:0], order[extremes:n - extremes]
+    strata = count - 2 * extremes
+    picked = middle[np.linspace(0, len(middle) - 1, strata).round().astype(int)] if strata and len(middle) else []
+    return sorted(set(int(i) for i in top) | set(int(i) for i in bottom) | set(int(i) for i in picked))
+
+
+def budget_result(rows: List[Dict[str, Any]], token_budget: int, total_rows: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Elige qué filas y columnas de un resultado caben en `token_budget` tokens e informa
+    exactamente de lo descartado (columnas constantes, columnas recortadas, filas omitidas
+    y filas que no se trajeron de la base de datos).
+    """
+    total_rows = len(rows) if total_rows is None else total_rows
+    dropped: Dict[str, Any] = {"rows_not_fetched": max(0, total_rows - len(rows))}
+    if not rows:
+        return {"rows": [], "columns": [], "constant_columns": {}, "token_estimate": 0, "dropped": dropped}
+
+    columns = list(rows[0])
+    constant = {}
+    if len(rows) > 1:
+        constant = {c: rows[0].get(c) for c in columns if all(row.get(c) == rows[0].get(c) for row in rows)}
+        columns = [c for c in columns if c not in constant] or columns[:1]
+        constant = {c: v for c, v in constant.items() if c not in columns}
+    numeric, text = _split_columns(rows)
+    # Prioridad: etiquetas, numéricas no semanales y semanas de la más reciente a la más
+    # antigua; el resto de texto al final. Se recorta desde el final
+    weeks = sorted((c for c in numeric if c in columns and WEEK_COLUMN.match(c)), key=lambda c: int(WEEK_COLUMN.match(c).group(1)))
+    priority = [c for c in text if c in columns][:MAX_LABEL_COLUMNS]
+    priority += [c for c in numeric if c in columns and c not in weeks] + weeks
+    priority += [c for c in columns if c not in priority]
+    budget = max(0, token_budget - estimate_tokens(_to_json(constant)))
+
+    def row_tokens(kept: List[str]) -> np.ndarray:
+        return np.array([estimate_tokens(_to_json({c: row.get(c) for c in kept})) for row in rows])
+
+    kept = priority
+    tokens = row_tokens(kept)
+    target_rows = min(MIN_BUDGET_ROWS, len(rows))
+    while len(kept) > 2 and tokens.mean() * target_rows > budget:
+        kept = kept[:-1]
+        tokens = row_tokens(kept)
+    kept = [c for c in columns if c in kept]  # orden original de la consulta
+
+    count = int(budget // max(tokens.mean(), 1)) if tokens.sum() > budget else len(rows)
+    sort_column = next((c for c in priority if c in kept and c in numeric and c != WEEK_OFFSET_COLUMN), None)
+    indexes = representative_rows(rows, count, sort_column)
+    # El promedio puede subestimar: se quitan filas del centro hasta respetar el presupuesto
+    while indexes and tokens[indexes].sum() > budget:
+        indexes.pop(len(indexes) // 2)
+    omitted = sorted(set(range(len(rows))) - set(indexes))
+
+    if len(indexes) < len(rows):
+        dropped["rows"] = len(omitted)
+        dropped["row_positions"] = _ranges(omitted)
+        dropped["row_selection"] = (f"top/bottom por {sort_column} + estratificado" if sort_column
+                                    else "primeras filas + muestreo uniforme")
+    if len(kept) < len(columns):
+        dropped["columns"] = [c for c in columns if c not in kept]
+    return {
+        "rows": [{c: row.get(c) for c in kept} for row in (rows[i] for i in indexes)],
+        "columns": kept,
+        "constant_columns": constant,
+        "token_estimate": int(tokens[indexes].sum()) if indexes else 0,
+        "dropped": dropped,
+    }
+
+
+def budget_results(results: Dict[Any, Tuple[List[Dict[str, Any]], Optional[int]]], token_budget: int) -> Dict[Any, Dict[str, Any]]:
+    """
+    Reparte `token_budget` entre varios resultados (clave → (filas, total_rows)): cada uno
+    recibe una parte igual y lo que no usan los pequeños pasa a los grandes.
+    """
+    needs = {key: sum(estimate_tokens(_to_json(row)) for row in rows) for key, (rows, _) in results.items()}
+    shares, remaining = {}, token_budget
+    pending = sorted(results, key=lambda key: needs[key])
+    while pending:
+        share = remaining // len(pending)
+        key = pending.pop(0)
+        shares[key] = min(needs[key], share)
+        remaining -= shares[key]
+    return {key: budget_result(rows, shares[key], total_rows) for key, (rows, total_rows) in results.items()}
@@ -0,0 +1,213 @@
+"""
+Benchmarks de rendimiento del servidor MCP.
+
+Uso:
+    python benchmark.py registry [--iterations N]
+    python benchmark.py stats [--iterations N] [--rows N]
+    python benchmark.py planner [--iterations N] [--question TEXTO]
+"""
+import argparse
+import os
+import statistics
+import time
+from typing import Any, Callable, Dict, List
+
+
+def _time_calls(fn: Callable[[], object], iterations: int) -> List[float]:
+    """Ejecuta fn `iterations` veces y devuelve la latencia de cada llamada en ms"""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _summary(timings: List[float]) -> Dict[str, float]:
+    return {
+        "mean_ms": statistics.mean(timings),
+        "p50_ms": statistics.median(timings),
+        "max_ms": max(timings),
+    }
+
+
+def _print_row(label: str, stats: Dict[str, float]) -> None:
+    print(f"{label:<28} mean={stats['mean_ms']:>10.4f} ms  p50={stats['p50_ms']:>10.4f} ms  max={stats['max_ms']:>10.4f} ms")
+
+
+def bench_registry(args: argparse.Namespace) -> None:
+    """Compara construir AnalystIAGraph por llamada contra reutilizar el registro de main"""
+    iterations = args.iterations
+    # La construcción del modelo no hace llamadas de red, basta con una key ficticia
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    from agent import AnalystIAGraph
+    from main import SPECIALIST_PROMPTS, build_graph_registry, get_graph
+
+    prompt = SPECIALIST_PROMPTS["curador_de_metricas"]
+    rebuild = _summary(_time_calls(lambda: AnalystIAGraph(agent_prompt=prompt), iterations))
+
+    build_graph_registry()
+    cached = _summary(_time_calls(lambda: get_graph("curador_de_metricas"), iterations))
+
+    print(f"Overhead de grafo por llamada ({iterations} iteraciones)")
+    _print_row("AnalystIAGraph() por llamada", rebuild)
+    _print_row("registro (get_graph)", cached)
+    print(f"Latencia ahorrada por llamada: {rebuild['mean_ms'] - cached['mean_ms']:.4f} ms")
+
+
+def _legacy_table_stats(cursor, table_name: str, numeric_columns: List[str]) -> int:
+    """Validación anterior: COUNT(*) más una consulta por columna numérica. Devuelve nº de consultas"""
+    cursor.execute(f"SELECT COUNT(*) as total_rows FROM {table_name}")
+    cursor.fetchone()
+    for column_name in numeric_columns:
+        cursor.execute(f"""
+        SELECT 
+            COUNT(*) AS count,
+            COUNT(*) FILTER(WHERE {column_name} IS NULL) AS null_count,
+            AVG({column_name}) AS avg,
+            MIN({column_name}) AS min,
+            MAX({column_name}) AS max
+        FROM {table_name}
+        """)
+        cursor.fetchone()
+    return 1 + len(numeric_columns)
+
+
+def _seq_scans(cursor, table_name: str) -> int:
+    """Recorridos secuenciales acumulados de la tabla según pg_stat_user_tables"""
+    try:
+        cursor.execute("SELECT pg_stat_force_next_flush()")  # PostgreSQL 15+
+    except Exception:
+        cursor.connection.rollback()
+    cursor.execute("SELECT pg_stat_clear_snapshot()")
+    cursor.execute("SELECT seq_scan FROM pg_stat_user_tables WHERE relname = %s", (table_name,))
+    row = cursor.fetchone()
+    return row["seq_scan"] if row else 0
+
+
+def bench_stats(args: argparse.Namespace) -> None:
+    """
+    Compara las estadísticas del catálogo en un solo recorrido contra el bucle
+    anterior (COUNT(*) + una consulta por columna) sobre una copia de raw_input_metrics
+    con `--rows` filas sintéticas.
+    """
+    from agent import dict_tables
+    from catalog import numeric_columns as get_numeric_columns, parse_table_stats, table_stats_query
+    from utils import db_connection
+
+    table_name = "bench_raw_input_metrics"
+    definition = next(t for t in dict_tables["tables"] if t["name"] == "raw_input_metrics")
+    numeric_columns = get_numeric_columns(definition)
+    week_columns = ", ".join(f"random() AS {c}" for c in numeric_columns)
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        conn.autocommit = True
+        print(f"Creando {table_name} con {args.rows} filas...")
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+        cursor.execute(f"""
+            CREATE UNLOGGED TABLE {table_name} AS
+            SELECT 'CO'::text AS country, 'city_' || (g % 50) AS city, 'zone_' || (g % 900) AS zone,
+                   'Wealthy'::text AS zone_type, 'Prioritized'::text AS zone_prioritization,
+                   'metric_' || (g % 12) AS metric, {week_columns}
+            FROM generate_series(1, {args.rows}) AS g
+        """)
+        cursor.execute(f"ANALYZE {table_name}")
+
+        try:
+            scans_before = _seq_scans(cursor, table_name)
+            legacy_queries = 0
+            legacy_start = time.perf_counter()
+            for _ in range(args.iterations):
+                legacy_queries += _legacy_table_stats(cursor, table_name, numeric_columns)
+            legacy_ms = (time.perf_counter() - legacy_start) * 1000 / args.iterations
+            legacy_scans = _seq_scans(cursor, table_name) - scans_before
+
+            scans_before = _seq_scans(cursor, table_name)
+            single_start = time.perf_counter()
+            for _ in range(args.iterations):
+                cursor.execute(table_stats_query(table_name, numeric_columns))
+                parse_table_stats(cursor.fetchone(), numeric_columns)
+            single_ms = (time.perf_counter() - single_start) * 1000 / args.iterations
+            single_scans = _seq_scans(cursor, table_name) - scans_before
+        finally:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+            conn.autocommit = False
+
+    print(f"Estadísticas de tabla ({args.rows} filas, {len(numeric_columns)} columnas numéricas, {args.iterations} iteraciones)")
+    print(f"{'bucle por columna':<20} consultas={legacy_queries // args.iterations:>3}  seq_scans={legacy_scans / args.iterations:>5.1f}  {legacy_ms:>10.1f} ms")
+    print(f"{'un solo recorrido':<20} consultas={1:>3}  seq_scans={single_scans / args.iterations:>5.1f}  {single_ms:>10.1f} ms")
+    print(f"Aceleración: x{legacy_ms / single_ms:.1f}")
+
+
+def _llm_usage(llm, prompt: str) -> Dict[str, Any]:
+    """Una llamada al LLM con sus tokens de entrada/salida (usage_metadata de langchain)"""
+    response = llm.invoke(prompt)
+    usage = getattr(response, "usage_metadata", None) or {}
+    return {"content": response.content, "input_tokens": usage.get("input_tokens", 0), "output_tokens": usage.get("output_tokens", 0)}
+
+
+def _chain_planning(graph, state) -> List[Dict[str, Any]]:
+    """Llamadas del planificador en cadena: coordinador, ambigüedad, tablas y complejidad"""
+    messages_content = graph._extract_content_from_messages(state.messages)
+    coordinator = _llm_usage(graph.llm, graph._coordinator_prompt(state))
+    state.agent_analysis = coordinator["content"]
+    return [
+        coordinator,
+        _llm_usage(graph.llm, graph._ambiguity_prompt(state)),
+        _llm_usage(graph.llm, graph._table_validator_prompt(state)),
+        _llm_usage(graph.llm, graph._complexity_prompt(state, messages_content)),
+    ]
+
+
+def _fused_planning(graph, state) -> List[Dict[str, Any]]:
+    """Llamada única del planificador fusionado (valida la respuesta contra el esquema)"""
+    call = _llm_usage(graph.llm, graph._planner_prompt(state))
+    graph._apply_planner_decision(state, call["content"])
+    return [call]
+
+
+def bench_planner(args: argparse.Namespace) -> None:
+    """
+    Compara latencia y tokens de la planificación previa al SQL: cuatro llamadas
+    en cadena contra el planificador fusionado. Requiere OPENAI_API_KEY real.
+    """
+    from agent import AnalystIAGraph
+    from main import SPECIALIST_PROMPTS
+
+    messages = [{"role": "user", "content": args.question}]
+    for planner, plan, llm_calls in (("chain", _chain_planning, 4), ("fused", _fused_planning, 1)):
+        graph = AnalystIAGraph(agent_prompt=SPECIALIST_PROMPTS[args.specialist], planner=planner)
+        timings, input_tokens, output_tokens, failures = [], 0, 0, 0
+        for _ in range(args.iterations):
+            state = graph.ingest(graph._initial_state(messages))
+            start = time.perf_counter()
+            try:
+                calls = plan(graph, state)
+            except Exception:
+                failures += 1
+                continue
+            timings.append((time.perf_counter() - start) * 1000)
+            input_tokens += sum(c["input_tokens"] for c in calls)
+            output_tokens += sum(c["output_tokens"] for c in calls)
+        runs = len(timings) or 1
+        _print_row(f"{planner} ({llm_calls} llamadas)", _summary(timings or [0.0]))
+        print(f"{'':<28} tokens entrada={input_tokens / runs:>8.0f}  salida={output_tokens / runs:>6.0f}  respuestas inválidas={failures}")
+
+
+BENCHMARKS = {
+    "registry": bench_registry,
+    "stats": bench_stats,
+    "planner": bench_planner,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks del servidor MCP")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=2_000_000, help="Filas sintéticas para el benchmark stats")
+    parser.add_argument("--question", default="Top 5 zonas con mayor Perfect Orders en Colombia la última semana",
+                        help="Consulta usada por el benchmark planner")
+    parser.add_argument("--specialist", default="curador_de_metricas", help="Especialista usado por el benchmark planner")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
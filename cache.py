@@ -0,0 +1,498 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.messages import AIMessage
+from langchain_core.runnables.config import ensure_config
+
+from utils import data_versions
+
+
+def normalise_prompt(prompt: Any) -> str:
+    """Prompt sin diferencias de espacios/sangría (los prompts del agente son f-strings indentados)"""
+    if isinstance(prompt, str):
+        text = prompt
+    elif isinstance(prompt, list):
+        text = "\n".join(f"{getattr(m, 'type', '')}:{getattr(m, 'content', m)}" for m in prompt)
+    else:
+        text = str(prompt)
+    return " ".join(text.split())
+
+
+def current_node(config: Optional[Dict[str, Any]] = None) -> str:
+    """Nodo del grafo que está llamando al LLM (metadata que LangGraph propaga en el contexto)"""
+    return ensure_config(config).get("metadata", {}).get("langgraph_node") or "unknown"
+
+
+class LLMResponseCache:
+    """
+    Caché de respuestas del LLM en dos niveles: LRU en memoria por proceso y SQLite
+    en disco compartido entre procesos. La clave combina modelo, prompt normalizado
+    y la huella de datos de las tablas, así que una carga nueva invalida las entradas.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, path: Optional[str] = None,
+                 memory_entries: Optional[int] = None, max_entries: Optional[int] = None,
+                 ttl_seconds: Optional[float] = None):
+        self.enabled = enabled if enabled is not None else os.environ.get("LLM_CACHE", "false").lower() in ("1", "true", "yes")
+        self.path = path if path is not None else os.environ.get("LLM_CACHE_PATH", ".cache/llm_responses.sqlite")
+        self.memory_entries = memory_entries if memory_entries is not None else int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "256"))
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "10000"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.environ.get("LLM_CACHE_TTL_SECONDS", "86400"))
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def make_key(model: str, prompt: Any, data_fingerprint: str) -> str:
+        return hashlib.sha256(f"{model}\x00{data_fingerprint}\x00{normalise_prompt(prompt)}".encode()).hexdigest()
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        """Conexión SQLite compartida por los hilos del proceso (None si no hay nivel en disco)"""
+        if not self.path:
+            return None
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY, model TEXT, node TEXT, response TEXT,
+                    created_at REAL, accessed_at REAL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+            self._db = db
+        return self._db
+
+    def _count(self, node: str, outcome: str) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(node, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] >= self.ttl_seconds:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return entry[0]
+
+    def _memory_put(self, key: str, response: str, created_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (response, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str) -> Optional[Tuple[str, float]]:
+        try:
+            with self._lock:
+                db = self._connection()
+                if db is None:
+                    return None
+                row = db.execute(
+                    "SELECT response, created_at FROM llm_cache WHERE key = ? AND created_at > ?",
+                    (key, time.time() - self.ttl_seconds),
+                ).fetchone()
+                if row:
+                    db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                return row
+        except sqlite3.Error as e:
+            logging.warning(f"Caché LLM en disco no disponible: {str(e)}")
+            return None
+
+    def _disk_put(self, key: str, model: str, node: str, response: str, created_at: float) -> None:
+        try:
+            with self._lock:
+                db = self._connection()
+                if db is None:
+                    return
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model, node, response, created_at, created_at),
+                )
+                # Expiradas por TTL y, por tamaño, las de acceso más antiguo
+                db.execute("DELETE FROM llm_cache WHERE created_at <= ?", (created_at - self.ttl_seconds,))
+                db.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"No se pudo guardar en la caché LLM en disco: {str(e)}")
+
+    def get(self, key: str, node: str) -> Optional[str]:
+        response = self._memory_get(key)
+        if response is not None:
+            self._count(node, "memory_hits")
+            return response
+        row = self._disk_get(key)
+        if row is not None:
+            self._memory_put(key, row[0], row[1])
+            self._count(node, "disk_hits")
+            return row[0]
+        self._count(node, "misses")
+        return None
+
+    def put(self, key: str, model: str, node: str, response: str) -> None:
+        created_at = time.time()
+        self._memory_put(key, response, created_at)
+        self._disk_put(key, model, node, response, created_at)
+
+    async def aget(self, key: str, node: str) -> Optional[str]:
+        response = self._memory_get(key)
+        if response is not None:
+            self._count(node, "memory_hits")
+            return response
+        row = await asyncio.to_thread(self._disk_get, key)
+        if row is not None:
+            self._memory_put(key, row[0], row[1])
+            self._count(node, "disk_hits")
+            return row[0]
+        self._count(node, "misses")
+        return None
+
+    async def aput(self, key: str, model: str, node: str, response: str) -> None:
+        created_at = time.time()
+        self._memory_put(key, response, created_at)
+        await asyncio.to_thread(self._disk_put, key, model, node, response, created_at)
+
+    def wrap(self, llm: Any, model: str, tables: List[str]) -> Any:
+        """Envuelve el modelo devuelto por client.mllOpenIA (sin cambios si la caché está desactivada)"""
+        return CachedChatModel(llm, model, self, tables) if self.enabled else llm
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute("DELETE FROM llm_cache")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            nodes = {node: dict(counters) for node, counters in self._counters.items()}
+        for counters in nodes.values():
+            total = sum(counters.values())
+            counters["hit_rate"] = round((counters["memory_hits"] + counters["disk_hits"]) / total, 4) if total else 0.0
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "ttl_seconds": self.ttl_seconds,
+            "memory_entries": len(self._memory),
+            "nodes": nodes,
+        }
+
+
+class CachedChatModel:
+    """Modelo de chat con invoke/ainvoke cacheados; el resto de atributos se delega al modelo"""
+
+    def __init__(self, llm: Any, model: str, cache: LLMResponseCache, tables: List[str]):
+        self.llm = llm
+        self.model = model
+        self.cache = cache
+        self.tables = tables
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.llm, name)
+
+    @staticmethod
+    def _message(content: str, source: str) -> AIMessage:
+        return AIMessage(content=content, response_metadata={"cache": source})
+
+    def _key(self, prompt: Any, data_fingerprint: Optional[str]) -> Optional[str]:
+        return None if data_fingerprint is None else self.cache.make_key(self.model, prompt, data_fingerprint)
+
+    def _fingerprint(self) -> Optional[str]:
+        try:
+            return data_versions.fingerprint(self.tables)
+        except Exception as e:
+            logging.warning(f"Sin huella de datos, se omite la caché LLM: {str(e)}")
+            return None
+
+    async def _afingerprint(self) -> Optional[str]:
+        try:
+            return await data_versions.afingerprint(self.tables)
+        except Exception as e:
+            logging.warning(f"Sin huella de datos, se omite la caché LLM: {str(e)}")
+            return None
+
+    def invoke(self, prompt: Any, config: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Any:
+        node = current_node(config)
+        key = self._key(prompt, self._fingerprint())
+        cached = self.cache.get(key, node) if key else None
+        if cached is not None:
+            return self._message(cached, "hit")
+        response = self.llm.invoke(prompt, config, **kwargs)
+        if key and isinstance(response.content, str):
+            self.cache.put(key, self.model, node, response.content)
+        return response
+
+    async def ainvoke(self, prompt: Any, config: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Any:
+        node = current_node(config)
+        key = self._key(prompt, await self._afingerprint())
+        cached = await self.cache.aget(key, node) if key else None
+        if cached is not None:
+            return self._message(cached, "hit")
+        response = await self.llm.ainvoke(prompt, config, **kwargs)
+        if key and isinstance(response.content, str):
+            await self.cache.aput(key, self.model, node, response.content)
+        return response
+
+
+# Caché compartida por todos los grafos del proceso
+llm_cache = LLMResponseCache()
+
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin tildes, para comparar variantes de la misma pregunta"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def vectorise(text: str, dim: int = 1024) -> np.ndarray:
+    """
+    Vector de hashing (trigramas de caracteres + palabras) normalizado L2. No requiere
+    modelo ni red, y crc32 lo hace estable entre reinicios.
+    """
+    folded = _fold(text)
+    vector = np.zeros(dim, dtype=np.float32)
+    padded = f" {folded} "
+    for i in range(len(padded) - 2):
+        vector[zlib.crc32(padded[i:i + 3].encode()) % dim] += 1.0
+    for word in re.findall(r"\w+", folded):
+        vector[zlib.crc32(f"w:{word}".encode()) % dim] += 2.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Palabras que cambian la redacción pero no el significado de la pregunta
+_FILLER_WORDS = {
+    "a", "actual", "actualmente", "al", "cual", "cuales", "cuantos", "cuantas", "dame", "de", "del", "dime",
+    "el", "en", "es", "esta", "estan", "favor", "hay", "la", "las", "lista", "listar", "los", "me", "mostrar",
+    "muestra", "muestrame", "necesito", "o", "para", "podrias", "por", "puedes", "que", "quiero", "se",
+    "ser", "son", "su", "sus", "top", "un", "una", "ver", "y",
+}
+
+
+def _stem(word: str) -> str:
+    """
+    Raíz mínima para plurales en español: "peores" -> "peor", "ciudades" -> "ciudad",
+    "zonas" -> "zona", "clientes"/"cliente" -> "client"
+    """
+    for suffix in ("s", "e", "s"):
+        if len(word) > 3 and word.endswith(suffix) and not word.isdigit():
+            word = word[:-1]
+    return word
+
+
+def _key_terms(folded: str) -> frozenset:
+    """
+    Términos que deben coincidir para reutilizar SQL: números y raíces de las palabras de
+    contenido. "peor"/"mejor" o "Colombia"/"México" son casi idénticas para el vectorizador
+    pero no son la misma pregunta.
+    """
+    return frozenset(_stem(word) for word in re.findall(r"\w+", folded) if word not in _FILLER_WORDS)
+
+
+def _terms_match(terms: frozenset, other: frozenset, max_extra_terms: int) -> bool:
+    """
+    Mismos números y, como mucho, `max_extra_terms` palabras de más en una de las dos
+    preguntas. Sustituir una palabra por otra ("peor" por "mejor") nunca coincide.
+    """
+    if terms == other:
+        return True
+    if {t for t in terms if t.isdigit()} != {t for t in other if t.isdigit()}:
+        return False
+    smaller, larger = sorted((terms, other), key=len)
+    return len(smaller) >= 2 and smaller < larger and len(larger - smaller) <= max_extra_terms
+
+
+class SemanticSQLCache:
+    """
+    Índice por especialista de preguntas ya respondidas con éxito y su SQL. Una pregunta
+    nueva con los mismos números y palabras de contenido (salvo SEMANTIC_CACHE_MAX_EXTRA_TERMS
+    de más) y similitud coseno >= SEMANTIC_CACHE_THRESHOLD reutiliza ese SQL sin pasar por
+    el LLM. Tamaño acotado por especialista con desalojo LRU y persistencia en SQLite; los
+    aciertos solo actualizan la memoria y su last_used se escribe en lote cada
+    SEMANTIC_CACHE_FLUSH_SECONDS.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, path: Optional[str] = None,
+                 threshold: Optional[float] = None, max_entries: Optional[int] = None,
+                 max_extra_terms: Optional[int] = None, flush_seconds: Optional[float] = None):
+        self.enabled = enabled if enabled is not None else os.environ.get("SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes")
+        self.path = path if path is not None else os.environ.get("SEMANTIC_CACHE_PATH", ".cache/semantic_sql.sqlite")
+        self.threshold = threshold if threshold is not None else float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.7"))
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "500"))
+        self.max_extra_terms = max_extra_terms if max_extra_terms is not None else int(os.environ.get("SEMANTIC_CACHE_MAX_EXTRA_TERMS", "1"))
+        self.flush_seconds = flush_seconds if flush_seconds is not None else float(os.environ.get("SEMANTIC_CACHE_FLUSH_SECONDS", "30"))
+        self._entries: Dict[str, "OrderedDict[str, Dict[str, Any]]"] = {}
+        self._touched: Dict[Tuple[str, str], float] = {}  # last_used pendiente de escribir
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if not self.path:
+            return None
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS semantic_sql (
+                    namespace TEXT, question TEXT, entry TEXT, last_used REAL,
+                    PRIMARY KEY (namespace, question)
+                )
+            """)
+            self._db = db
+        return self._db
+
+    def _load(self) -> None:
+        """Carga perezosa del índice persistido (se llama con el lock tomado)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            db = self._connection()
+            if db is None:
+                return
+            for namespace, question, entry, _ in db.execute("SELECT * FROM semantic_sql ORDER BY last_used"):
+                entry = json.loads(entry)
+                entry["vector"] = vectorise(question)
+                entry["terms"] = _key_terms(question)
+                self._entries.setdefault(namespace, OrderedDict())[question] = entry
+        except (sqlite3.Error, ValueError) as e:
+            logging.warning(f"No se pudo cargar la caché semántica: {str(e)}")
+
+    def _persist(self, namespace: str, question: str, stored: Dict[str, Any], evicted: List[str]) -> None:
+        """Escribe una entrada nueva (se llama sin el lock del índice)"""
+        with self._write_lock:
+            try:
+                db = self._connection()
+                if db is None:
+                    return
+                db.execute("INSERT OR REPLACE INTO semantic_sql VALUES (?, ?, ?, ?)",
+                           (namespace, question, json.dumps(stored, default=str), stored["last_used"]))
+                db.executemany("DELETE FROM semantic_sql WHERE namespace = ? AND question = ?",
+                               [(namespace, old) for old in evicted])
+            except sqlite3.Error as e:
+                logging.warning(f"No se pudo guardar la caché semántica: {str(e)}")
+
+    def flush(self) -> int:
+        """Escribe en SQLite el last_used de los aciertos pendientes. Devuelve cuántos"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._flushed_at = time.monotonic()
+        if not touched:
+            return 0
+        with self._write_lock:
+            try:
+                db = self._connection()
+                if db is not None:
+                    db.executemany("UPDATE semantic_sql SET last_used = ? WHERE namespace = ? AND question = ?",
+                                   [(last_used, namespace, question) for (namespace, question), last_used in touched.items()])
+            except sqlite3.Error as e:
+                logging.warning(f"No se pudo guardar la caché semántica: {str(e)}")
+        return len(touched)
+
+    def lookup(self, namespace: str, question: str) -> Optional[Dict[str, Any]]:
+        """Entrada más similar por encima del umbral, con `similarity` y `matched_question`"""
+        folded = _fold(question)
+        if not folded:
+            return None
+        vector = vectorise(question)
+        with self._lock:
+            self._load()
+            entries = self._entries.get(namespace)
+            terms = _key_terms(folded)
+            candidates = [q for q, entry in entries.items() if _terms_match(terms, entry["terms"], self.max_extra_terms)] if entries else []
+            if not candidates:
+                self.misses += 1
+                return None
+            similarities = np.stack([entries[q]["vector"] for q in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            matched = candidates[best]
+            entry = entries[matched]
+            entry["last_used"] = time.time()
+            entries.move_to_end(matched)
+            self.hits += 1
+            self._touched[(namespace, matched)] = entry["last_used"]
+            flush_due = time.monotonic() - self._flushed_at >= self.flush_seconds
+            result = {k: v for k, v in entry.items() if k not in ("vector", "terms")}
+        if flush_due:
+            self.flush()
+        result.update(similarity=round(float(similarities[best]), 4), matched_question=matched)
+        return result
+
+    def remember(self, namespace: str, question: str, sql_query: Optional[str], sql_queries: List[str],
+                 requires_multiple_queries: bool, tables: List[str], agent_analysis: Optional[str]) -> None:
+        """Registra el SQL de una respuesta exitosa"""
+        folded = _fold(question)
+        if not folded:
+            return
+        entry = {
+            "sql_query": sql_query,
+            "sql_queries": list(sql_queries),
+            "requires_multiple_queries": requires_multiple_queries,
+            "tables": list(tables),
+            "agent_analysis": agent_analysis,
+            "last_used": time.time(),
+        }
+        stored = dict(entry)
+        entry.update(vector=vectorise(folded), terms=_key_terms(folded))
+        with self._lock:
+            self._load()
+            entries = self._entries.setdefault(namespace, OrderedDict())
+            entries[folded] = entry
+            entries.move_to_end(folded)
+            evicted = []
+            while len(entries) > self.max_entries:
+                evicted.append(entries.popitem(last=False)[0])
+            for old in evicted:
+                self._touched.pop((namespace, old), None)
+        self._persist(namespace, folded, stored, evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "pending_writes": len(self._touched),
+            "entries": {namespace: len(entries) for namespace, entries in self._entries.items()},
+        }
+
+
+# Índice semántico compartido por todos los grafos del proceso
+semantic_sql_cache = SemanticSQLCache()
+atexit.register(semantic_sql_cache.flush)
@@ -0,0 +1,270 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils import async_db_connection, db_connection
+
+NUMERIC_TYPES = ["integer", "double precision", "numeric", "decimal", "float"]
+
+
+def numeric_columns(table_definition: Dict[str, Any]) -> List[str]:
+    """Columnas numéricas de la definición de una tabla"""
+    return [
+        column_info.get("name")
+        for column_info in table_definition.get("columns", [])
+        if column_info.get("type", "").lower() in NUMERIC_TYPES
+    ]
+
+
+def table_stats_query(table_name: str, columns: List[str]) -> str:
+    """
+    Consulta que obtiene en un solo recorrido de la tabla el total de filas y,
+    para cada columna numérica, nulos, promedio, mínimo y máximo.
+    """
+    select_parts = ["COUNT(*) AS total_rows"]
+    for column_name in columns:
+        select_parts += [
+            f'COUNT(*) FILTER(WHERE {column_name} IS NULL) AS "{column_name}.null_count"',
+            f'AVG({column_name}) AS "{column_name}.avg"',
+            f'MIN({column_name}) AS "{column_name}.min"',
+            f'MAX({column_name}) AS "{column_name}.max"',
+        ]
+    return f"SELECT {', '.join(select_parts)} FROM {table_name}"
+
+
+def parse_table_stats(stats_row: Optional[Dict[str, Any]], columns: List[str]) -> Tuple[int, Dict[str, Any]]:
+    """Separa la fila de table_stats_query en (total_rows, column_stats)"""
+    if not stats_row:
+        return 0, {}
+    total_rows = stats_row["total_rows"]
+    column_stats = {
+        column_name: {
+            "count": total_rows,
+            "null_count": stats_row[f"{column_name}.null_count"],
+            "avg": stats_row[f"{column_name}.avg"],
+            "min": stats_row[f"{column_name}.min"],
+            "max": stats_row[f"{column_name}.max"],
+        }
+        for column_name in columns
+    }
+    return total_rows, column_stats
+
+
+def _validated_entry(table_definition: Dict[str, Any], total_rows: int, column_stats: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "exists": True,
+        "definition": table_definition,
+        "total_rows": total_rows,
+        "column_stats": column_stats
+    }
+
+
+def probe_table(table_name: str, table_definition: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Ejecuta las consultas de reconocimiento de una tabla. Devuelve (validated, samples)"""
+    columns = numeric_columns(table_definition)
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Consulta 1: Obtener muestra de datos (máximo 10 filas)
+        cursor.execute(f"SELECT * FROM {table_name} LIMIT 10")
+        sample_data = [dict(row) for row in cursor.fetchall()]
+
+        # Consulta 2: total de registros y estadísticas de columnas numéricas en un solo recorrido
+        cursor.execute(table_stats_query(table_name, columns))
+        total_rows, column_stats = parse_table_stats(cursor.fetchone(), columns)
+
+    return _validated_entry(table_definition, total_rows, column_stats), sample_data
+
+
+async def aprobe_table(table_name: str, table_definition: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Versión asíncrona de probe_table"""
+    columns = numeric_columns(table_definition)
+    async with async_db_connection() as conn, conn.cursor() as cursor:
+        await cursor.execute(f"SELECT * FROM {table_name} LIMIT 10")
+        sample_data = [dict(row) for row in await cursor.fetchall()]
+
+        await cursor.execute(table_stats_query(table_name, columns))
+        total_rows, column_stats = parse_table_stats(await cursor.fetchone(), columns)
+
+    return _validated_entry(table_definition, total_rows, column_stats), sample_data
+
+
+class CatalogEntry:
+    """Resultado cacheado del reconocimiento de una tabla"""
+
+    def __init__(self, validated: Dict[str, Any], samples: List[Dict[str, Any]],
+                 refresh_duration_ms: float, data_version: Optional[str] = None):
+        self.validated = validated
+        self.samples = samples
+        self.refreshed_at = time.time()
+        self.refresh_duration_ms = refresh_duration_ms
+        self.data_version = data_version
+
+    @property
+    def age_seconds(self) -> float:
+        return time.time() - self.refreshed_at
+
+    def info(self) -> Dict[str, Any]:
+        """Metadatos de la entrada que se reportan en el resultado"""
+        return {
+            "age_seconds": round(self.age_seconds, 3),
+            "refresh_duration_ms": round(self.refresh_duration_ms, 3),
+            "refreshed_at": self.refreshed_at,
+            "data_version": self.data_version,
+        }
+
+
+class TableCatalog:
+    """
+    Caché por proceso de validated_tables / table_samples de cada tabla.
+
+    Un hilo en segundo plano refresca las entradas cuando superan el TTL o cuando
+    `version_probe` reporta un cambio de versión de los datos, de modo que el
+    table_validator lee la caché sin E/S a la base de datos. Si se pasa `snapshot_probe`
+    (ver columnar.ColumnarStore.probe, y `asnapshot_probe` para el camino asíncrono) el
+    reconocimiento se resuelve en memoria cuando el snapshot está al día.
+    """
+
+    def __init__(self, table_definitions: List[Dict[str, Any]],
+                 ttl_seconds: Optional[float] = None,
+                 check_interval: Optional[float] = None,
+                 version_probe: Optional[Callable[[List[str]], Dict[str, str]]] = None,
+                 aversion_probe: Optional[Callable[[List[str]], Awaitable[Dict[str, str]]]] = None,
+                 snapshot_probe: Optional[Callable[..., Optional[Tuple[int, Dict[str, Any], List[Dict[str, Any]]]]]] = None,
+                 asnapshot_probe: Optional[Callable[..., Awaitable[Optional[Tuple[int, Dict[str, Any], List[Dict[str, Any]]]]]]] = None):
+        self.table_definitions = {t["name"]: t for t in table_definitions}
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.environ.get("CATALOG_TTL_SECONDS", "3600"))
+        self.check_interval = check_interval if check_interval is not None else float(os.environ.get("CATALOG_CHECK_INTERVAL", "60"))
+        self.version_probe = version_probe
+        self.aversion_probe = aversion_probe
+        self.snapshot_probe = snapshot_probe
+        self.asnapshot_probe = asnapshot_probe
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self, table_name: str) -> Optional[CatalogEntry]:
+        return self._entries.get(table_name)
+
+    def _store(self, table_name: str, validated: Dict[str, Any], samples: List[Dict[str, Any]],
+               started: float, data_version: Optional[str]) -> CatalogEntry:
+        entry = CatalogEntry(validated, samples, (time.perf_counter() - started) * 1000, data_version)
+        with self._lock:
+            self._entries[table_name] = entry
+        return entry
+
+    def _current_versions(self, tables: List[str]) -> Dict[str, str]:
+        if self.version_probe is None:
+            return {}
+        try:
+            return self.version_probe(tables)
+        except Exception as e:
+            logging.warning(f"No se pudo consultar la versión de datos: {str(e)}")
+            return {}
+
+    async def _acurrent_versions(self, tables: List[str]) -> Dict[str, str]:
+        if self.aversion_probe is None:
+            return {}
+        try:
+            return await self.aversion_probe(tables)
+        except Exception as e:
+            logging.warning(f"No se pudo consultar la versión de datos: {str(e)}")
+            return {}
+
+    def _probe_snapshot(self, table_name: str, data_version: Optional[str]) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        if self.snapshot_probe is None:
+            return None
+        table_definition = self.table_definitions[table_name]
+        try:
+            probed = self.snapshot_probe(table_name, numeric_columns(table_definition), data_version)
+        except Exception as e:
+            logging.warning(f"No se pudo usar el snapshot de '{table_name}': {str(e)}")
+            return None
+        if probed is None:
+            return None
+        total_rows, column_stats, samples = probed
+        return _validated_entry(table_definition, total_rows, column_stats), samples
+
+    async def _aprobe_snapshot(self, table_name: str, data_version: Optional[str]) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        if self.asnapshot_probe is None:
+            return None
+        table_definition = self.table_definitions[table_name]
+        try:
+            probed = await self.asnapshot_probe(table_name, numeric_columns(table_definition), data_version)
+        except Exception as e:
+            logging.warning(f"No se pudo usar el snapshot de '{table_name}': {str(e)}")
+            return None
+        if probed is None:
+            return None
+        total_rows, column_stats, samples = probed
+        return _validated_entry(table_definition, total_rows, column_stats), samples
+
+    def refresh_table(self, table_name: str, data_version: Optional[str] = None) -> CatalogEntry:
+        """Vuelve a ejecutar el reconocimiento de la tabla y reemplaza su entrada"""
+        started = time.perf_counter()
+        probed = self._probe_snapshot(table_name, data_version)
+        validated, samples = probed or probe_table(table_name, self.table_definitions[table_name])
+        if data_version is None:
+            data_version = self._current_versions([table_name]).get(table_name)
+        return self._store(table_name, validated, samples, started, data_version)
+
+    async def arefresh_table(self, table_name: str) -> CatalogEntry:
+        """Versión asíncrona de refresh_table (carga en frío desde el camino asíncrono)"""
+        started = time.perf_counter()
+        data_version = (await self._acurrent_versions([table_name])).get(table_name)
+        probed = await self._aprobe_snapshot(table_name, data_version)
+        validated, samples = probed or await aprobe_table(table_name, self.table_definitions[table_name])
+        return self._store(table_name, validated, samples, started, data_version)
+
+    def get_or_load(self, table_name: str) -> CatalogEntry:
+        """Entrada cacheada; solo consulta la base de datos en frío"""
+        return self.get(table_name) or self.refresh_table(table_name)
+
+    async def aget_or_load(self, table_name: str) -> CatalogEntry:
+        return self.get(table_name) or await self.arefresh_table(table_name)
+
+    def refresh_stale(self) -> List[str]:
+        """Refresca las tablas vencidas por TTL o con versión de datos distinta. Devuelve cuáles"""
+        tables = list(self.table_definitions)
+        versions = self._current_versions(tables)
+        refreshed = []
+        for table_name in tables:
+            entry = self.get(table_name)
+            version = versions.get(table_name)
+            stale = (
+                entry is None
+                or entry.age_seconds >= self.ttl_seconds
+                or (version is not None and version != entry.data_version)
+            )
+            if stale:
+                try:
+                    self.refresh_table(table_name, version)
+                    refreshed.append(table_name)
+                except Exception as e:
+                    logging.error(f"Error refrescando catálogo de '{table_name}': {str(e)}")
+        return refreshed
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            self.refresh_stale()
+
+    def start(self) -> None:
+        """Carga inicial del catálogo y arranque del refresco en segundo plano"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.refresh_stale()
+        self._thread = threading.Thread(target=self._refresh_loop, name="table-catalog-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "check_interval": self.check_interval,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "tables": {name: entry.info() for name, entry in self._entries.items()},
+        }
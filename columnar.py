@@ -0,0 +1,451 @@
+import logging
+import os
+import re
+import threading
+import time
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from psycopg import sql
+from psycopg.rows import tuple_row
+
+from catalog import numeric_columns
+from utils import data_versions, db_connection
+
+# Columnas semanales (l0w_roll, l3w, ...): el número es el desfase en semanas
+_WEEK_COLUMN = re.compile(r"^l(\d+)w(?:_roll)?$")
+
+
+def _python(value: Any) -> Any:
+    """Escalar de NumPy → tipo de Python serializable (NaN → None)"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+class ColumnarTable:
+    """
+    Snapshot en memoria de una tabla: un array de NumPy por columna. Las columnas de texto
+    van codificadas por diccionario (códigos int32, -1 = NULL) y las semanales forman una
+    matriz float64 filas × semanas (NaN = NULL) de la que las columnas son vistas.
+    El tipo de cada columna sale de `numeric` (columnas numéricas de la definición de la
+    tabla); sin definición se deduce de los valores y una columna toda NULL es de texto.
+    """
+
+    def __init__(self, name: str, column_names: Sequence[str], rows: List[Tuple[Any, ...]], version: Optional[str],
+                 numeric: Optional[Sequence[str]] = None):
+        self.name = name
+        self.column_names = list(column_names)
+        self.version = version
+        self.loaded_at = time.time()
+        self.total_rows = len(rows)
+        self.numeric: Dict[str, np.ndarray] = {}
+        self.codes: Dict[str, np.ndarray] = {}
+        self.dictionaries: Dict[str, np.ndarray] = {}
+        self._code_of: Dict[str, Dict[str, int]] = {}
+
+        values_by_column = list(zip(*rows)) if rows else [() for _ in self.column_names]
+        week_columns = {}
+        for column_name, values in zip(self.column_names, values_by_column):
+            if numeric is not None:
+                is_numeric = column_name in numeric
+            else:
+                present = [v for v in values if v is not None]
+                is_numeric = bool(present) and all(isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in present)
+            if is_numeric:
+                self.numeric[column_name] = np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+                week = _WEEK_COLUMN.match(column_name)
+                if week:
+                    week_columns[int(week.group(1))] = column_name
+            else:
+                self._encode(column_name, values)
+
+        # Matriz de semanas (columna i = desfase i); las columnas numéricas pasan a ser vistas
+        self.week_columns = [week_columns[offset] for offset in sorted(week_columns)]
+        if self.week_columns:
+            self.weeks = np.column_stack([self.numeric[c] for c in self.week_columns])
+            for index, column_name in enumerate(self.week_columns):
+                self.numeric[column_name] = self.weeks[:, index]
+        else:
+            self.weeks = np.empty((self.total_rows, 0), dtype=np.float64)
+
+    def _encode(self, column_name: str, values: Sequence[Any]) -> None:
+        dictionary = sorted({str(v) for v in values if v is not None})
+        code_of = {value: code for code, value in enumerate(dictionary)}
+        self.codes[column_name] = np.array([-1 if v is None else code_of[str(v)] for v in values], dtype=np.int32)
+        self.dictionaries[column_name] = np.array(dictionary, dtype=object)
+        self._code_of[column_name] = code_of
+
+    # ------------------------- Acceso -------------------------
+
+    def column(self, column_name: str) -> np.ndarray:
+        """Valores decodificados de una columna (texto como objetos, NULL como None)"""
+        if column_name in self.numeric:
+            return self.numeric[column_name]
+        codes = self.codes[column_name]
+        decoded = np.empty(len(codes), dtype=object)
+        valid = codes >= 0
+        decoded[valid] = self.dictionaries[column_name][codes[valid]]
+        return decoded
+
+    def mask(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Máscara de filas que cumplen igualdad con cada filtro (None = sin filtro)"""
+        mask = np.ones(self.total_rows, dtype=bool)
+        for column_name, value in filters.items():
+            if value is None:
+                continue
+            if column_name in self.codes:
+                code = self._code_of[column_name].get(str(value))
+                if code is None:
+                    return np.zeros(self.total_rows, dtype=bool)
+                mask &= self.codes[column_name] == code
+            else:
+                mask &= self.numeric[column_name] == float(value)
+        return mask
+
+    def group_codes(self, columns: List[str], mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(claves únicas, índice de grupo por fila) de las filas de la máscara"""
+        stacked = np.column_stack([self.codes[c][mask] for c in columns]) if columns else np.zeros((int(mask.sum()), 0), np.int32)
+        return np.unique(stacked, axis=0, return_inverse=True)
+
+    def decode(self, column_name: str, code: int) -> Optional[str]:
+        return None if code < 0 else self.dictionaries[column_name][code]
+
+    def rows(self, indexes: np.ndarray, columns: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        columns = columns or self.column_names
+        decoded = {c: self.column(c)[indexes] for c in columns}
+        return [{c: _python(decoded[c][i]) for c in columns} for i in range(len(indexes))]
+
+    # ------------------------- Reconocimiento -------------------------
+
+    def sample(self, limit: int = 10) -> List[Dict[str, Any]]:
+        return self.rows(np.arange(min(limit, self.total_rows)))
+
+    def column_stats(self, columns: List[str]) -> Dict[str, Any]:
+        """Nulos, media, mínimo y máximo (mismo formato que catalog.parse_table_stats)"""
+        stats = {}
+        for column_name in columns:
+            values = self.numeric[column_name]
+            present = values[~np.isnan(values)]
+            stats[column_name] = {
+                "count": self.total_rows,
+                "null_count": int(self.total_rows - len(present)),
+                "avg": float(present.mean()) if len(present) else None,
+                "min": float(present.min()) if len(present) else None,
+                "max": float(present.max()) if len(present) else None,
+            }
+        return stats
+
+    def distinct(self, column_name: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Valores distintos con su frecuencia, de más a menos frecuente"""
+        codes = self.codes[column_name]
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.dictionaries[column_name]))
+        order = np.argsort(-counts, kind="stable")[:limit]
+        return [{"value": self.dictionaries[column_name][i], "count": int(counts[i])} for i in order if counts[i]]
+
+    def nbytes(self) -> int:
+        arrays = [self.weeks] + [a for c, a in self.numeric.items() if c not in self.week_columns] + list(self.codes.values())
+        return int(sum(a.nbytes for a in arrays))
+
+
+def _order(values: np.ndarray, direction: str) -> np.ndarray:
+    """Índices ordenados como ORDER BY de PostgreSQL (NULL primero en DESC, al final en ASC)"""
+    keyed = np.where(np.isnan(values), np.inf, values)
+    return np.argsort(-keyed if direction == "DESC" else keyed, kind="stable")
+
+
+def _mean(values: np.ndarray, groups: np.ndarray, size: int) -> np.ndarray:
+    """AVG por grupo ignorando NULL (NaN si el grupo no tiene valores)"""
+    present = ~np.isnan(values)
+    sums = np.bincount(groups[present], weights=values[present], minlength=size)
+    counts = np.bincount(groups[present], minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+class ColumnarStore:
+    """
+    Snapshot columnar de las tablas de hechos (COLUMNAR_SNAPSHOT=true), cargado al arrancar
+    y recargado en segundo plano cuando cambia la versión de datos. Responde en memoria las
+    consultas de reconocimiento (estadísticas, muestras, distintos) y las plantillas KPI
+    sencillas de filtro/agrupación/top N; si el snapshot no está al día devuelve None y
+    el llamador consulta PostgreSQL.
+    """
+
+    def __init__(self, tables: Optional[List[str]] = None, enabled: Optional[bool] = None,
+                 check_interval: Optional[float] = None):
+        self.enabled = enabled if enabled is not None else os.environ.get("COLUMNAR_SNAPSHOT", "false").lower() in ("1", "true", "yes")
+        self.tables = tables or [t.strip() for t in os.environ.get("COLUMNAR_TABLES", "raw_input_metrics,raw_orders").split(",") if t.strip()]
+        self.check_interval = check_interval if check_interval is not None else float(os.environ.get("COLUMNAR_CHECK_INTERVAL", "30"))
+        self._snapshots: Dict[str, ColumnarTable] = {}
+        # Definiciones de dict_tables: fijan qué columnas son numéricas (ver set_table_definitions)
+        self.table_definitions: Dict[str, Dict[str, Any]] = {}
+        self._load_ms: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+
+    # ------------------------- Carga -------------------------
+
+    def set_table_definitions(self, table_definitions: List[Dict[str, Any]]) -> None:
+        self.table_definitions = {t["name"]: t for t in table_definitions}
+
+    def _numeric_columns(self, table_name: str) -> Optional[List[str]]:
+        definition = self.table_definitions.get(table_name)
+        return numeric_columns(definition) if definition is not None else None
+
+    def load_table(self, table_name: str) -> ColumnarTable:
+        """Lee la tabla completa y reemplaza su snapshot"""
+        started = time.perf_counter()
+        version = data_versions.fingerprint([table_name])
+        with db_connection() as conn, conn.cursor(row_factory=tuple_row) as cursor:
+            cursor.execute(sql.SQL("SELECT * FROM {}").format(sql.Identifier(table_name)))
+            column_names = [c.name for c in cursor.description]
+            rows = cursor.fetchall()
+        snapshot = ColumnarTable(table_name, column_names, rows, version, self._numeric_columns(table_name))
+        with self._lock:
+            self._snapshots[table_name] = snapshot
+            self._load_ms[table_name] = (time.perf_counter() - started) * 1000
+        return snapshot
+
+    def refresh_stale(self) -> List[str]:
+        """Recarga los snapshots ausentes o con versión de datos distinta"""
+        refreshed = []
+        for table_name in self.tables:
+            try:
+                snapshot = self._snapshots.get(table_name)
+                if snapshot is None or snapshot.version != data_versions.fingerprint([table_name]):
+                    self.load_table(table_name)
+                    refreshed.append(table_name)
+            except Exception as e:
+                logging.error(f"Error cargando el snapshot columnar de '{table_name}': {str(e)}")
+        return refreshed
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            self.refresh_stale()
+
+    def start(self) -> None:
+        """Carga inicial y refresco en segundo plano (no hace nada si está desactivado)"""
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self.refresh_stale()
+        self._thread = threading.Thread(target=self._refresh_loop, name="columnar-snapshot-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _checked(self, snapshot: Optional[ColumnarTable], current: Optional[str]) -> Optional[ColumnarTable]:
+        """Descarta el snapshot si no coincide con la versión actual y cuenta el acierto o fallo"""
+        if snapshot is not None and current != snapshot.version:
+            snapshot = None
+        with self._lock:
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return snapshot
+
+    def get(self, table_name: str, data_version: Optional[str] = None) -> Optional[ColumnarTable]:
+        """
+        Snapshot de la tabla si está al día con la versión de datos; None si no.
+        `data_version` es la versión de la tabla ya consultada (data_versions.versions).
+        """
+        if not self.enabled:
+            return None
+        snapshot = self._snapshots.get(table_name)
+        current = None
+        if snapshot is not None:
+            try:
+                current = data_versions.combine({table_name: data_version}) if data_version else data_versions.fingerprint([table_name])
+            except Exception as e:
+                logging.warning(f"No se pudo consultar la versión de datos: {str(e)}")
+        return self._checked(snapshot, current)
+
+    async def aget(self, table_name: str, data_version: Optional[str] = None) -> Optional[ColumnarTable]:
+        """Versión asíncrona de get: la versión de datos se consulta sin bloquear el event loop"""
+        if not self.enabled:
+            return None
+        snapshot = self._snapshots.get(table_name)
+        current = None
+        if snapshot is not None:
+            try:
+                current = data_versions.combine({table_name: data_version}) if data_version else await data_versions.afingerprint([table_name])
+            except Exception as e:
+                logging.warning(f"No se pudo consultar la versión de datos: {str(e)}")
+        return self._checked(snapshot, current)
+
+    # ------------------------- Consultas -------------------------
+
+    def probe(self, table_name: str, columns: List[str],
+              data_version: Optional[str] = None) -> Optional[Tuple[int, Dict[str, Any], List[Dict[str, Any]]]]:
+        """(total_rows, column_stats, samples) para el catálogo, o None para ir a PostgreSQL"""
+        return self._probe(self.get(table_name, data_version), columns)
+
+    async def aprobe(self, table_name: str, columns: List[str],
+                     data_version: Optional[str] = None) -> Optional[Tuple[int, Dict[str, Any], List[Dict[str, Any]]]]:
+        return self._probe(await self.aget(table_name, data_version), columns)
+
+    @staticmethod
+    def _probe(snapshot: Optional[ColumnarTable], columns: List[str]) -> Optional[Tuple[int, Dict[str, Any], List[Dict[str, Any]]]]:
+        if snapshot is None:
+            return None
+        return snapshot.total_rows, snapshot.column_stats(columns), snapshot.sample()
+
+    def distinct(self, table_name: str, column_name: str, limit: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        snapshot = self.get(table_name)
+        return snapshot.distinct(column_name, limit) if snapshot is not None else None
+
+    def execute_template(self, template: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """
+        Resultado de una plantilla KPI (state.template_match) calculado sobre el snapshot,
+        con las mismas columnas que su SQL. None si la plantilla no se resuelve en memoria.
+        """
+        if self._template_handler(template) is None:
+            return None
+        return self._run_template(self.get("raw_input_metrics"), template)
+
+    async def aexecute_template(self, template: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """Versión asíncrona de execute_template"""
+        if self._template_handler(template) is None:
+            return None
+        return self._run_template(await self.aget("raw_input_metrics"), template)
+
+    def _template_handler(self, template: Dict[str, Any]) -> Optional[Callable[..., List[Dict[str, Any]]]]:
+        if template["params"].get("source", "raw") != "raw":
+            return None
+        return getattr(self, f"_template_{template['template']}", None)
+
+    def _run_template(self, snapshot: Optional[ColumnarTable], template: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        if snapshot is None:
+            return None
+        params = template["params"]
+        mask = snapshot.mask({"metric": params["metric"], "country": params["country"], "city": params["city"]})
+        return self._template_handler(template)(snapshot, mask, params) if mask.any() else []
+
+    @staticmethod
+    def _template_metric_ranking(snapshot: ColumnarTable, mask: np.ndarray, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        values = snapshot.weeks[:, params["week"]]
+        indexes = np.flatnonzero(mask & ~np.isnan(values))
+        top = indexes[_order(values[indexes], params["direction"])[:params["limit"]]]
+        rows = snapshot.rows(top, ["country", "city", "zone", "zone_type", "zone_prioritization", "metric"])
+        for row, value in zip(rows, values[top]):
+            row["value"] = _python(value)
+        return rows
+
+    @staticmethod
+    def _template_wow_movers(snapshot: ColumnarTable, mask: np.ndarray, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        current, previous = snapshot.weeks[:, 0], snapshot.weeks[:, 1]
+        indexes = np.flatnonzero(mask & ~np.isnan(current) & ~np.isnan(previous))
+        delta = current[indexes] - previous[indexes]
+        order = _order(delta, params["direction"])[:params["limit"]]
+        top = indexes[order]
+        rows = snapshot.rows(top, ["country", "city", "zone", "metric"])
+        for row, i, wow_delta in zip(rows, top, delta[order]):
+            row.update({
+                "previous_value": _python(previous[i]),
+                "current_value": _python(current[i]),
+                "wow_delta": _python(wow_delta),
+                "wow_delta_pct": _python(wow_delta / abs(previous[i]) * 100) if previous[i] != 0 else None,
+            })
+        return rows
+
+    @staticmethod
+    def _template_metric_trend(snapshot: ColumnarTable, mask: np.ndarray, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        weeks = snapshot.weeks[mask, :params["weeks"]]
+        present = ~np.isnan(weeks)
+        counts = present.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averages = np.where(counts > 0, np.where(present, weeks, 0).sum(axis=0) / np.maximum(counts, 1), np.nan)
+        rows, previous = [], None
+        for offset in range(weeks.shape[1] - 1, -1, -1):
+            average = averages[offset]
+            rows.append({
+                "week_offset": offset,
+                "avg_value": _python(average),
+                "zones": int(counts[offset]),
+                "wow_delta": _python(average - previous) if previous is not None else None,
+            })
+            previous = average
+        return rows
+
+    @staticmethod
+    def _grouped(snapshot: ColumnarTable, mask: np.ndarray, columns: List[str]) -> Tuple[np.ndarray, np.ndarray, List[Dict[str, Any]]]:
+        keys, groups = snapshot.group_codes(columns, mask)
+        labels = [{c: snapshot.decode(c, key[i]) for i, c in enumerate(columns)} for key in keys]
+        return keys, groups.ravel(), labels
+
+    def _template_metric_breakdown(self, snapshot: ColumnarTable, mask: np.ndarray, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        keys, groups, labels = self._grouped(snapshot, mask, params["level"])
+        l0w, l1w = snapshot.weeks[mask, 0], snapshot.weeks[mask, 1]
+        size = len(keys)
+        averages = _mean(l0w, groups, size)
+        previous = _mean(l1w, groups, size)
+        counts = np.bincount(groups, minlength=size)
+        rows = []
+        for g in _order(averages, params["direction"]):
+            values = l0w[groups == g]
+            values = values[~np.isnan(values)]
+            rows.append({
+                **labels[g],
+                "zones": int(counts[g]),
+                "avg_l0w": _python(averages[g]),
+                "avg_l1w": _python(previous[g]),
+                "min_l0w": _python(values.min()) if len(values) else None,
+                "max_l0w": _python(values.max()) if len(values) else None,
+            })
+        return rows
+
+    def _template_cohort_comparison(self, snapshot: ColumnarTable, mask: np.ndarray, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        keys, groups, labels = self._grouped(snapshot, mask, [params["cohort"]])
+        l0w, l1w = snapshot.weeks[mask, 0], snapshot.weeks[mask, 1]
+        size = len(keys)
+        averages = _mean(l0w, groups, size)
+        previous = _mean(l1w, groups, size)
+        counts = np.bincount(groups, minlength=size)
+        rows = []
+        for g in _order(averages, "DESC"):
+            values = l0w[groups == g]
+            values = values[~np.isnan(values)]
+            rows.append({
+                "cohort": labels[g][params["cohort"]],
+                "zones": int(counts[g]),
+                "avg_l0w": _python(averages[g]),
+                "avg_l1w": _python(previous[g]),
+                "wow_delta": _python(averages[g] - previous[g]),
+                "median_l0w": _python(np.median(values)) if len(values) else None,
+            })
+        return rows
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "check_interval": self.check_interval,
+                "running": self._thread is not None and self._thread.is_alive(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "tables": {
+                    name: {
+                        "rows": snapshot.total_rows,
+                        "bytes": snapshot.nbytes(),
+                        "loaded_at": snapshot.loaded_at,
+                        "load_ms": round(self._load_ms.get(name, 0.0), 3),
+                        "data_version": snapshot.version,
+                    }
+                    for name, snapshot in self._snapshots.items()
+                },
+            }
+
+
+# Snapshot compartido por el proceso
+columnar_store = ColumnarStore()
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobQueueFull(Exception):
+    """La cola de trabajos alcanzó JOB_QUEUE_SIZE"""
+
+
+class Job:
+    """Análisis en segundo plano: estado, nodo del grafo en curso y resultado"""
+
+    def __init__(self, kind: str, params: Dict[str, Any], runner: Callable[["Job"], Awaitable[Dict[str, Any]]]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.runner = runner
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Nodo actual y nodos terminados, por especialista (un informe ejecuta varios)
+        self.current_node: Dict[str, str] = {}
+        self.completed_nodes: Dict[str, List[str]] = {}
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._done = asyncio.Event()
+
+    def record_node(self, specialist: str, node: str, state: Optional[Dict[str, Any]] = None) -> None:
+        """Progreso: `node` terminó en el grafo de `specialist`"""
+        self.current_node[specialist] = node
+        self.completed_nodes.setdefault(specialist, []).append(node)
+
+    def info(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "last_completed_node": self.current_node,
+            "completed_nodes": self.completed_nodes,
+            "created_at": self.created_at,
+            "queued_seconds": round((self.started_at or now) - self.created_at, 3),
+            "running_seconds": round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    Cola de trabajos en proceso con un pool acotado de workers asyncio (JOB_WORKERS) y
+    resultados guardados durante JOB_RESULT_TTL_SECONDS tras terminar, de modo que el
+    cliente consulta el estado y recoge el resultado sin mantener abierta la llamada SSE.
+    """
+
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None,
+                 result_ttl_seconds: Optional[float] = None):
+        self.workers = workers if workers is not None else max(1, int(os.environ.get("JOB_WORKERS", "4")))
+        self.queue_size = queue_size if queue_size is not None else int(os.environ.get("JOB_QUEUE_SIZE", "100"))
+        self.result_ttl_seconds = result_ttl_seconds if result_ttl_seconds is not None else float(os.environ.get("JOB_RESULT_TTL_SECONDS", "3600"))
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self.counts = {SUCCEEDED: 0, FAILED: 0, CANCELLED: 0, "rejected": 0, "expired": 0}
+
+    def _ensure_workers(self) -> asyncio.Queue:
+        """Crea la cola y los workers en el event loop del servidor la primera vez"""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._worker_tasks = [asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(self.workers)]
+        return self._queue
+
+    def _purge_expired(self) -> None:
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at >= self.result_ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.counts["expired"] += len(expired)
+
+    def submit(self, kind: str, params: Dict[str, Any], runner: Callable[[Job], Awaitable[Dict[str, Any]]]) -> Job:
+        """Encola un trabajo; lanza JobQueueFull si la cola está llena"""
+        self._purge_expired()
+        queue = self._ensure_workers()
+        job = Job(kind, params, runner)
+        try:
+            queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counts["rejected"] += 1
+            raise JobQueueFull(f"Cola de trabajos llena ({self.queue_size})")
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge_expired()
+        return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> Optional[int]:
+        """Trabajos en cola por delante de `job` (None si ya no está en cola)"""
+        if job.status != QUEUED:
+            return None
+        return sum(1 for other in self._jobs.values() if other.status == QUEUED and other.created_at < job.created_at)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancela un trabajo en cola o en ejecución (la consulta en curso se cancela en PostgreSQL)"""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        if job.status == QUEUED:
+            self._finish(job, CANCELLED)
+        elif job._task is not None:
+            job._task.cancel()
+        return job
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Job]:
+        """Espera hasta `timeout` segundos a que el trabajo termine; devuelve el trabajo en su estado actual"""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        try:
+            async with asyncio.timeout(timeout):
+                await job._done.wait()
+        except TimeoutError:
+            pass
+        return job
+
+    def _finish(self, job: Job, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        job.status, job.result, job.error = status, result, error
+        job.finished_at = time.time()
+        job._task = None
+        job._done.set()
+        self.counts[status] += 1
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status != QUEUED:  # cancelado mientras esperaba
+                    continue
+                job.status, job.started_at = RUNNING, time.time()
+                job._task = asyncio.create_task(job.runner(job))
+                try:
+                    result = await job._task
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        # Se está cerrando el worker (y con él el event loop), no lo canceló el cliente
+                        self._finish(job, CANCELLED, error="Servidor detenido")
+                        raise
+                    self._finish(job, CANCELLED, error="Cancelado por el cliente")
+                except Exception as e:
+                    logging.error(f"Error en el trabajo {job.id}: {str(e)}")
+                    self._finish(job, FAILED, error=str(e))
+                else:
+                    self._finish(job, FAILED if "error" in result else SUCCEEDED, result=result, error=result.get("error"))
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        statuses: Dict[str, int] = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "result_ttl_seconds": self.result_ttl_seconds,
+            "jobs": statuses,
+            "totals": dict(self.counts),
+        }
+
+
+# Cola compartida por el proceso
+job_manager = JobManager()
@@ -0,0 +1,400 @@
+import logging
+import os
+import re
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from psycopg import sql
+
+from columnar import columnar_store
+from utils import data_versions, db_connection
+from views import METRICS_CUBE_VIEW, materialized_views
+
+METRICS_TABLE = "raw_input_metrics"
+WEEKS = 9  # columnas l8w_roll .. l0w_roll
+
+# Nombres de país en español/inglés → código usado en la columna country
+COUNTRY_NAMES = {
+    "argentina": "AR", "brasil": "BR", "brazil": "BR", "chile": "CL", "colombia": "CO",
+    "costa rica": "CR", "ecuador": "EC", "mexico": "MX", "peru": "PE", "uruguay": "UY",
+}
+
+
+def fold(text: str) -> str:
+    """Minúsculas y sin tildes"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def week_column(offset: int) -> sql.Identifier:
+    return sql.Identifier(f"l{offset}w_roll")
+
+
+def _weeks_unnest(weeks: int) -> sql.Composed:
+    """VALUES (offset, lNw_roll) para pasar las columnas semanales a filas"""
+    return sql.SQL(", ").join(
+        sql.SQL("({}, m.{})").format(sql.Literal(offset), week_column(offset)) for offset in range(weeks)
+    )
+
+
+_FILTERS = sql.SQL(
+    "m.metric = %(metric)s"
+    " AND (%(country)s::text IS NULL OR m.country = %(country)s)"
+    " AND (%(city)s::text IS NULL OR m.city = %(city)s)"
+)
+
+
+def _ranking(params: Dict[str, Any]) -> sql.Composed:
+    week = week_column(params["week"])
+    return sql.SQL("""
+        SELECT m.country, m.city, m.zone, m.zone_type, m.zone_prioritization, m.metric, m.{week} AS value
+        FROM {table} AS m
+        WHERE {filters} AND m.{week} IS NOT NULL
+        ORDER BY value {direction}
+        LIMIT %(limit)s
+    """).format(week=week, table=sql.Identifier(METRICS_TABLE), filters=_FILTERS,
+                direction=sql.SQL(params["direction"]))
+
+
+def _trend(params: Dict[str, Any]) -> sql.Composed:
+    return sql.SQL("""
+        SELECT w.week_offset, AVG(w.value) AS avg_value, COUNT(w.value) AS zones,
+               AVG(w.value) - LAG(AVG(w.value)) OVER (ORDER BY w.week_offset DESC) AS wow_delta
+        FROM {table} AS m
+        CROSS JOIN LATERAL (VALUES {weeks}) AS w(week_offset, value)
+        WHERE {filters}
+        GROUP BY w.week_offset
+        ORDER BY w.week_offset DESC
+    """).format(table=sql.Identifier(METRICS_TABLE), weeks=_weeks_unnest(params["weeks"]), filters=_FILTERS)
+
+
+def _cohort(params: Dict[str, Any]) -> sql.Composed:
+    return sql.SQL("""
+        SELECT m.{cohort} AS cohort, COUNT(*) AS zones,
+               AVG(m.l0w_roll) AS avg_l0w, AVG(m.l1w_roll) AS avg_l1w,
+               AVG(m.l0w_roll) - AVG(m.l1w_roll) AS wow_delta,
+               PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY m.l0w_roll) AS median_l0w
+        FROM {table} AS m
+        WHERE {filters}
+        GROUP BY m.{cohort}
+        ORDER BY avg_l0w DESC
+    """).format(cohort=sql.Identifier(params["cohort"]), table=sql.Identifier(METRICS_TABLE), filters=_FILTERS)
+
+
+def _movers(params: Dict[str, Any]) -> sql.Composed:
+    return sql.SQL("""
+        SELECT m.country, m.city, m.zone, m.metric, m.l1w_roll AS previous_value, m.l0w_roll AS current_value,
+               m.l0w_roll - m.l1w_roll AS wow_delta,
+               (m.l0w_roll - m.l1w_roll) / NULLIF(ABS(m.l1w_roll), 0) * 100 AS wow_delta_pct
+        FROM {table} AS m
+        WHERE {filters} AND m.l0w_roll IS NOT NULL AND m.l1w_roll IS NOT NULL
+        ORDER BY wow_delta {direction}
+        LIMIT %(limit)s
+    """).format(table=sql.Identifier(METRICS_TABLE), filters=_FILTERS, direction=sql.SQL(params["direction"]))
+
+
+def _breakdown(params: Dict[str, Any]) -> sql.Composed:
+    level = sql.SQL(", ").join(sql.SQL("m.{}").format(sql.Identifier(c)) for c in params["level"])
+    return sql.SQL("""
+        SELECT {level}, COUNT(*) AS zones, AVG(m.l0w_roll) AS avg_l0w, AVG(m.l1w_roll) AS avg_l1w,
+               MIN(m.l0w_roll) AS min_l0w, MAX(m.l0w_roll) AS max_l0w
+        FROM {table} AS m
+        WHERE {filters}
+        GROUP BY {level}
+        ORDER BY avg_l0w {direction}
+    """).format(level=level, table=sql.Identifier(METRICS_TABLE), filters=_FILTERS,
+                direction=sql.SQL(params["direction"]))
+
+
+_CUBE_FILTERS = sql.SQL(
+    "c.metric = %(metric)s"
+    " AND (%(country)s::text IS NULL OR c.country = %(country)s)"
+    " AND (%(city)s::text IS NULL OR c.city = %(city)s)"
+)
+
+
+def _cube_trend(params: Dict[str, Any]) -> sql.Composed:
+    return sql.SQL("""
+        SELECT c.week_offset, c.avg_value, c.zones, c.weighted_avg_value,
+               c.avg_value - LAG(c.avg_value) OVER (ORDER BY c.week_offset DESC) AS wow_delta
+        FROM {cube} AS c
+        WHERE {filters} AND c.week_offset < {weeks}
+          AND c.level = CASE WHEN %(city)s::text IS NOT NULL THEN 'city'
+                             WHEN %(country)s::text IS NOT NULL THEN 'country' ELSE 'global' END
+        ORDER BY c.week_offset DESC
+    """).format(cube=sql.Identifier(METRICS_CUBE_VIEW), filters=_CUBE_FILTERS, weeks=sql.Literal(params["weeks"]))
+
+
+def _cube_breakdown(params: Dict[str, Any]) -> sql.Composed:
+    level = sql.SQL(", ").join(sql.SQL("c.{}").format(sql.Identifier(c)) for c in params["level"])
+    return sql.SQL("""
+        SELECT {level},
+               MAX(c.zones) FILTER (WHERE c.week_offset = 0) AS zones,
+               MAX(c.avg_value) FILTER (WHERE c.week_offset = 0) AS avg_l0w,
+               MAX(c.avg_value) FILTER (WHERE c.week_offset = 1) AS avg_l1w,
+               MAX(c.min_value) FILTER (WHERE c.week_offset = 0) AS min_l0w,
+               MAX(c.max_value) FILTER (WHERE c.week_offset = 0) AS max_l0w,
+               MAX(c.weighted_avg_value) FILTER (WHERE c.week_offset = 0) AS weighted_avg_l0w
+        FROM {cube} AS c
+        WHERE {filters} AND c.level = {cube_level} AND c.week_offset IN (0, 1)
+        GROUP BY {level}
+        ORDER BY avg_l0w {direction}
+    """).format(level=level, cube=sql.Identifier(METRICS_CUBE_VIEW), filters=_CUBE_FILTERS,
+                cube_level=sql.Literal(params["level"][-1]), direction=sql.SQL(params["direction"]))
+
+
+# Plantillas: nombre → constructor del SQL (las partes no parametrizables, como la
+# columna de semana o el sentido del orden, definen variantes que se compilan una vez)
+TEMPLATES: Dict[str, Callable[[Dict[str, Any]], sql.Composed]] = {
+    "metric_ranking": _ranking,
+    "metric_trend": _trend,
+    "cohort_comparison": _cohort,
+    "wow_movers": _movers,
+    "metric_breakdown": _breakdown,
+}
+
+# Variantes que leen del cubo precalculado (views.metrics_cube) en lugar de las filas crudas
+CUBE_TEMPLATES: Dict[str, Callable[[Dict[str, Any]], sql.Composed]] = {
+    "metric_trend": _cube_trend,
+    "metric_breakdown": _cube_breakdown,
+}
+
+# Partes de los parámetros que cambian el texto SQL (el resto va como parámetro del statement)
+_VARIANT_KEYS = ("week", "direction", "weeks", "cohort", "level", "source")
+
+
+class TemplateMatch:
+    """Plantilla elegida para una pregunta con sus parámetros extraídos"""
+
+    def __init__(self, template: str, params: Dict[str, Any], query: str):
+        self.template = template
+        self.params = params
+        self.query = query
+
+    def statement_params(self) -> Dict[str, Any]:
+        return {k: self.params.get(k) for k in ("metric", "country", "city", "limit")}
+
+    def rendered(self) -> str:
+        """SQL con los parámetros como literales, para mostrarlo y para el analista"""
+        literals = {k: sql.Literal(v).as_string(None) for k, v in self.statement_params().items()}
+        return " ".join(re.sub(r"%\((\w+)\)s", lambda m: literals[m.group(1)], self.query).split())
+
+    def info(self) -> Dict[str, Any]:
+        return {"template": self.template, "params": self.params}
+
+
+class KPITemplateLibrary:
+    """
+    Plantillas SQL parametrizadas para los patrones KPI de los especialistas (ranking,
+    tendencia semanal, cohortes, mayores cambios semana a semana y desglose por nivel).
+    El matcher extrae métrica, país, ciudad, top N y semanas con reglas sobre la pregunta;
+    si la pregunta no encaja de forma inequívoca, sql_agent sigue usando el LLM.
+    Con las vistas materializadas activas, tendencia y desglose leen del cubo metrics_cube.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, use_cube: Optional[bool] = None):
+        self.enabled = enabled if enabled is not None else os.environ.get("KPI_TEMPLATES", "false").lower() in ("1", "true", "yes")
+        # El cubo solo existe si las vistas materializadas están activadas
+        self.use_cube = use_cube if use_cube is not None else materialized_views.enabled
+        self._compiled: Dict[Tuple[Any, ...], str] = {}
+        self._vocabulary: Dict[str, Any] = {"metrics": [], "countries": set(), "cities": []}
+        self._vocabulary_version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {name: 0 for name in TEMPLATES}
+        self.misses = 0
+        self.cube_hits = 0
+        self._template_ms: List[float] = []
+        self._llm_ms: List[float] = []
+
+    # ------------------------- Vocabulario -------------------------
+
+    def _load_vocabulary(self) -> None:
+        """Métricas, países y ciudades presentes en los datos (se recarga si cambia la versión)"""
+        table_version = data_versions.versions([METRICS_TABLE]).get(METRICS_TABLE)
+        version = data_versions.combine({METRICS_TABLE: table_version})
+        if version == self._vocabulary_version:
+            return
+        values: Dict[str, List[str]] = {"metric": [], "country": [], "city": []}
+        # get() espera la versión de la tabla (la combina él mismo), no la huella combinada
+        snapshot = columnar_store.get(METRICS_TABLE, table_version)
+        if snapshot is not None:
+            for kind in values:
+                values[kind] = [row["value"] for row in snapshot.distinct(kind)]
+        else:
+            with db_connection() as conn:
+                rows = conn.execute(sql.SQL(
+                    "SELECT DISTINCT 'metric' AS kind, metric AS value FROM {table} "
+                    "UNION SELECT DISTINCT 'country', country FROM {table} "
+                    "UNION SELECT DISTINCT 'city', city FROM {table}"
+                ).format(table=sql.Identifier(METRICS_TABLE))).fetchall()
+            for row in rows:
+                if row["value"]:
+                    values[row["kind"]].append(row["value"])
+        with self._lock:
+            # Las más largas primero para que "Perfect Orders" gane a "Orders"
+            self._vocabulary = {
+                "metrics": sorted(values["metric"], key=len, reverse=True),
+                "countries": set(values["country"]),
+                "cities": sorted(values["city"], key=len, reverse=True),
+            }
+            self._vocabulary_version = version
+
+    @staticmethod
+    def _search(folded_question: str, phrase: str) -> Optional[re.Match]:
+        folded = fold(phrase)
+        # Admite singular/plural de cada palabra ("perfect order" ~ "Perfect Orders")
+        pattern = r"\s+".join(rf"{re.escape(w[:-1] if w.endswith('s') else w)}s?" for w in folded.split())
+        return re.search(rf"(?<!\w){pattern}(?!\w)", folded_question)
+
+    @classmethod
+    def _contains(cls, folded_question: str, phrase: str) -> bool:
+        return cls._search(folded_question, phrase) is not None
+
+    @classmethod
+    def _metrics_in(cls, folded_question: str, metrics: List[str]) -> List[str]:
+        """Métricas nombradas en la pregunta; las más largas tapan a las contenidas en ellas"""
+        found = []
+        for metric in metrics:
+            match = cls._search(folded_question, metric)
+            if match:
+                found.append(metric)
+                folded_question = folded_question[:match.start()] + " " * (match.end() - match.start()) + folded_question[match.end():]
+        return found
+
+    # ------------------------- Matcher -------------------------
+
+    def _extract(self, question: str) -> Optional[Dict[str, Any]]:
+        folded = fold(question)
+        vocabulary = self._vocabulary
+        metrics = self._metrics_in(folded, vocabulary["metrics"])
+        # Dos métricas (trade-offs, cruces "alto X / bajo Y") no caben en una plantilla
+        if len(metrics) != 1:
+            return None
+        metric = metrics[0]
+
+        country = None
+        for name, code in COUNTRY_NAMES.items():
+            if re.search(rf"(?<!\w){name}(?!\w)", folded) and code in vocabulary["countries"]:
+                country = code
+                break
+        if country is None:
+            codes = [c for c in re.findall(r"\b[A-Z]{2}\b", question) if c in vocabulary["countries"]]
+            country = codes[0] if codes else None
+        city = next((c for c in vocabulary["cities"] if self._contains(folded, c)), None)
+
+        top = re.search(r"\b(?:top|primer[oa]s)\s*(\d+)\b", folded) or re.search(r"\b(\d+)\s+(?:zonas|ciudades|paises)\b", folded)
+        weeks = re.search(r"\b(?:ultimas|last)\s+(\d+)\s+(?:semanas|weeks)\b", folded)
+        worst = re.search(r"\b(peor(?:es)?|menor(?:es)?|baj[oa]s?|bottom|caida|cayeron|empeor\w*|bajaron)\b", folded)
+        return {
+            "metric": metric,
+            "country": country,
+            "city": city,
+            "limit": min(int(top.group(1)), 100) if top else 10,
+            "weeks": min(max(int(weeks.group(1)), 2), WEEKS) if weeks else WEEKS,
+            "week": 1 if re.search(r"\bsemana (?:pasada|anterior)\b", folded) else 0,
+            "direction": "ASC" if worst else "DESC",
+            "folded": folded,
+        }
+
+    @staticmethod
+    def _intent(params: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Plantilla que corresponde a la pregunta; None si ninguna o varias encajan"""
+        folded = params.pop("folded")
+        # Contrastes o preguntas compuestas ("mayor X pero menor Y") quedan para el LLM
+        if re.search(r"\b(pero|aunque|mientras|sin embargo)\b", folded):
+            return None
+        conjunctive = re.search(r"\b(y|e|vs|versus|contra)\b", folded) is not None
+        candidates = []
+        if re.search(r"\b(evolucion|tendencia|semana a semana|semanal|ultimas \d+ semanas)\b", folded):
+            candidates.append(("metric_trend", {}))
+        if re.search(r"\b(wealthy|priorit\w*)\b", folded) and re.search(r"\b(vs|versus|compar\w*|entre|diferencia)\b", folded):
+            cohort = "zone_type" if "wealthy" in folded else "zone_prioritization"
+            candidates.append(("cohort_comparison", {"cohort": cohort}))
+        if re.search(r"\b(cambio|variacion|crecimiento|caida|cayeron|subieron|bajaron|mejoraron|empeoraron)\b", folded):
+            candidates.append(("wow_movers", {}))
+        if re.search(r"\bpor (pais|ciudad)\b", folded):
+            level = ["country"] if "por pais" in folded else ["country", "city"]
+            candidates.append(("metric_breakdown", {"level": level}))
+        if not candidates and re.search(r"\bzonas?\b", folded) and re.search(r"\b(top|ranking|mejor(?:es)?|peor(?:es)?|mayor(?:es)?|menor(?:es)?)\b", folded):
+            candidates.append(("metric_ranking", {}))
+        if len(candidates) != 1:
+            return None
+        template, extra = candidates[0]
+        # En la comparación de cohortes "vs"/"y" une las dos cohortes; en el resto, dos preguntas
+        if conjunctive and template != "cohort_comparison":
+            return None
+        params.update(extra)
+        return template, params
+
+    def _source(self, template: str, params: Dict[str, Any]) -> str:
+        """'cube' si la plantilla puede responderse desde el cubo jerárquico, si no 'raw'"""
+        if not self.use_cube or template not in CUBE_TEMPLATES:
+            return "raw"
+        # El desglose por país con filtro de ciudad no tiene nivel equivalente en el cubo
+        if template == "metric_breakdown" and params["city"] and "city" not in params["level"]:
+            return "raw"
+        return "cube"
+
+    def _compile(self, template: str, params: Dict[str, Any]) -> str:
+        """Texto SQL de la variante (compilado una sola vez por combinación de variante)"""
+        key = (template,) + tuple(str(params.get(k)) for k in _VARIANT_KEYS)
+        query = self._compiled.get(key)
+        if query is None:
+            builder = CUBE_TEMPLATES[template] if params.get("source") == "cube" else TEMPLATES[template]
+            query = builder(params).as_string(None)
+            self._compiled[key] = query
+        return query
+
+    def match(self, question: str) -> Optional[TemplateMatch]:
+        """Plantilla y parámetros para la pregunta, o None para seguir con el LLM"""
+        if not self.enabled:
+            return None
+        try:
+            self._load_vocabulary()
+            params = self._extract(question)
+            intent = self._intent(params) if params else None
+        except Exception as e:
+            logging.error(f"Error en el matcher de plantillas KPI: {str(e)}")
+            intent = None
+        if intent is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        template, params = intent
+        params["source"] = self._source(template, params)
+        with self._lock:
+            self.hits[template] += 1
+            if params["source"] == "cube":
+                self.cube_hits += 1
+        return TemplateMatch(template, params, self._compile(template, params))
+
+    # ------------------------- Métricas -------------------------
+
+    def record_latency(self, via_template: bool, elapsed_ms: float) -> None:
+        """Duración de sql_agent por plantilla o por LLM, para estimar la latencia ahorrada"""
+        with self._lock:
+            samples = self._template_ms if via_template else self._llm_ms
+            samples.append(elapsed_ms)
+            del samples[:-500]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            avg_template = sum(self._template_ms) / len(self._template_ms) if self._template_ms else 0.0
+            avg_llm = sum(self._llm_ms) / len(self._llm_ms) if self._llm_ms else None
+            return {
+                "enabled": self.enabled,
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "cube_hits": self.cube_hits,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "avg_template_ms": round(avg_template, 3),
+                "avg_llm_sql_ms": round(avg_llm, 3) if avg_llm is not None else None,
+                "estimated_saved_ms": round(hits * (avg_llm - avg_template), 1) if avg_llm is not None else None,
+            }
+
+
+# Biblioteca compartida por todos los grafos del proceso
+kpi_templates = KPITemplateLibrary()
@@ -1,98 +1,361 @@
 import os
-from typing import Dict, Any
-from fastmcp import FastMCP
+import json
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from fastmcp import Context, FastMCP
 from dotenv import load_dotenv
+from starlette.requests import Request
+from starlette.responses import JSONResponse
 
-from agent import AnalystIAGraph
+# Antes de importar agent: los flags (MATERIALIZED_VIEWS, caches, ...) se leen al importar
+load_dotenv()
+
+
+from agent import AnalystIAGraph, table_catalog
+from cache import llm_cache, semantic_sql_cache
+from jobs import JobQueueFull, job_manager
+from progress import ProgressReporter
+from scheduler import BATCH, INTERACTIVE, Overloaded, admission
+from singleflight import normalise_messages, single_flight
+from columnar import columnar_store
+from kpi_templates import kpi_templates
+from views import materialized_views
+from utils import data_versions, pool_stats
 from prompts import prompt_comparador, prompt_cronista_temporal, prompt_curador_de_metricas, prompt_orquestador_de_agregacion, prompt_trade_offs
 
-load_dotenv()
 app = FastMCP("company-db-sever")
 
-def get_analystIAGraph(messages: str, prompt: str) -> Dict[str, Any]:
+# Prompt de cada especialista expuesto como herramienta MCP
+SPECIALIST_PROMPTS = {
+    "curador_de_metricas": prompt_curador_de_metricas,
+    "comparador": prompt_comparador,
+    "cronista_temporal": prompt_cronista_temporal,
+    "orquestador_de_agregacion": prompt_orquestador_de_agregacion,
+    "trade_offs": prompt_trade_offs,
+}
+
+# Tiempo máximo de una solicitud completa (LLM + SQL) antes de cancelarla
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "180"))
+
+# Registro de grafos compilados (uno por especialista y por proceso).
+# AnalystIAGraph no guarda estado por petición: cada run crea su propio FlowState,
+# por lo que la misma instancia se reutiliza entre peticiones concurrentes.
+_graph_registry: Dict[str, AnalystIAGraph] = {}
+_graph_registry_lock = threading.Lock()
+
+
+def get_graph(specialist: str) -> AnalystIAGraph:
+    """Devuelve el grafo compilado del especialista, construyéndolo solo la primera vez"""
+    engine = _graph_registry.get(specialist)
+    if engine is not None:
+        return engine
+    with _graph_registry_lock:
+        engine = _graph_registry.get(specialist)
+        if engine is None:
+            engine = AnalystIAGraph(agent_prompt=SPECIALIST_PROMPTS[specialist], name=specialist)
+            _graph_registry[specialist] = engine
+    return engine
+
+
+def build_graph_registry() -> Dict[str, AnalystIAGraph]:
+    """Compila por adelantado los grafos de todos los especialistas"""
+    for specialist in SPECIALIST_PROMPTS:
+        get_graph(specialist)
+    return dict(_graph_registry)
+
+
+def _parse_messages(messages: Any) -> List[Dict[str, str]]:
+    """Mensajes de la herramienta: lista JSON de mensajes o texto plano del usuario"""
+    if isinstance(messages, str):
+        try:
+            return json.loads(messages)
+        except json.JSONDecodeError:
+            return [{"role": "user", "content": messages}]
+    return messages
+
+
+def _tool_response(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Respuesta de las herramientas de especialista a partir del resultado del grafo"""
+    safe_result = json.dumps(result, ensure_ascii=False, indent=2)
+
+    return {
+        "success": True,
+        "summary": result.get("summary", "No se pudo generar resumen"),
+        "analysis": safe_result,  # todo el resultado en texto plano JSON
+        "sql_query": result.get("sql_query"),
+        "sql_queries": result.get("sql_queries", []),
+        "clarification_needed": result.get("clarification_needed"),
+        "is_ambiguous": result.get("is_ambiguous", False),
+        "insufficient_data": result.get("insufficient_data", False),
+        "requires_multiple_queries": result.get("requires_multiple_queries", False),
+        # estos dos campos se devuelven como texto plano para evitar conflicto
+        "data_results": json.dumps(result.get("sql_results", None), ensure_ascii=False),
+        "all_sql_results": json.dumps(result.get("all_sql_results", []), ensure_ascii=False)
+    }
+
+
+# Aviso de progreso: (especialista, nodo terminado, estado del grafo tras el nodo)
+ProgressCallback = Callable[[str, str, Dict[str, Any]], Any]
+# Fragmento de texto generado: (especialista, nodo, texto)
+TokenCallback = Callable[[str, str, str], Any]
+
+# Herramientas que esperan detrás del chat interactivo en el control de admisión
+BATCH_TOOLS = ("generate_report", "submit_analysis")
+
+
+async def _run_specialist(specialist: str, messages_list: List[Dict[str, str]],
+                          on_progress: Optional[ProgressCallback] = None,
+                          on_token: Optional[TokenCallback] = None,
+                          tool: Optional[str] = None) -> Dict[str, Any]:
+    """Ejecuta el grafo del especialista con el deadline de la solicitud"""
+    engine = get_graph(specialist)
+    on_node = (lambda node, state: on_progress(specialist, node, state)) if on_progress else None
+    on_text = (lambda node, text: on_token(specialist, node, text)) if on_token else None
+    tool = tool or specialist
+    priority = BATCH if tool in BATCH_TOOLS else INTERACTIVE
+
+    async def execute() -> Dict[str, Any]:
+        async with admission.slot(tool, priority):
+            return await engine.arun(messages_list, on_node=on_node, on_token=on_text)
+
+    # Peticiones idénticas concurrentes comparten una ejecución; los avisos de progreso
+    # son los de la petición que la inició
+    key = (specialist, normalise_messages(messages_list))
+    # Al vencer el deadline se cancela la tarea y, con ella, la consulta en curso en PostgreSQL
+    # (si ninguna otra petición sigue esperando la misma ejecución)
+    try:
+        async with asyncio.timeout(REQUEST_DEADLINE_SECONDS):
+            result = await single_flight.run(key, execute)
+    except Overloaded as e:
+        return {"error": str(e), "error_type": "overloaded", "retry_after_seconds": e.retry_after}
+    except TimeoutError:
+        return {"error": f"La solicitud superó el tiempo máximo de {REQUEST_DEADLINE_SECONDS:g} s", "error_type": "deadline"}
+    return _tool_response(result)
+
+
+async def get_analystIAGraph(messages: str, specialist: str, ctx: Optional[Context] = None) -> Dict[str, Any]:
     """Generico: Genera un resumen y análisis inteligente de consultas sobre empleados"""
-    import os, json
     try:
-        if isinstance(messages, str):
-            try:
-                messages_list = json.loads(messages)
-            except json.JSONDecodeError:
-                messages_list = [{"role": "user", "content": messages}]
-        else:
-            messages_list = messages
+        messages_list = _parse_messages(messages)
         if not os.environ.get("OPENAI_API_KEY"):
             return {"error": "OPENAI_API_KEY no está configurada"}
-        engine = AnalystIAGraph(agent_prompt=prompt)
-        result = engine.run(messages_list)
-
-        safe_result = json.dumps(result, ensure_ascii=False, indent=2)
-
-        return {
-            "success": True,
-            "summary": result.get("summary", "No se pudo generar resumen"),
-            "analysis": safe_result,  # todo el resultado en texto plano JSON
-            "sql_query": result.get("sql_query"),
-            "sql_queries": result.get("sql_queries", []),
-            "clarification_needed": result.get("clarification_needed"),
-            "is_ambiguous": result.get("is_ambiguous", False),
-            "insufficient_data": result.get("insufficient_data", False),
-            "requires_multiple_queries": result.get("requires_multiple_queries", False),
-            # estos dos campos se devuelven como texto plano para evitar conflicto
-            "data_results": json.dumps(result.get("sql_results", None), ensure_ascii=False),
-            "all_sql_results": json.dumps(result.get("all_sql_results", []), ensure_ascii=False)
-        }
+        # Con progressToken se avisa de cada nodo y del texto de data_analyst a medida que se genera
+        reporter = ProgressReporter.from_context(ctx)
+        if reporter is None:
+            return await _run_specialist(specialist, messages_list)
+        return await _run_specialist(specialist, messages_list, reporter.node, reporter.token)
 
     except Exception as e:
         return {"error": f"Error al generar resumen: {str(e)}"}
-    
+
+
+async def _warm_catalog() -> None:
+    """Un único reconocimiento de tablas compartido por todos los especialistas del informe"""
+    await asyncio.gather(*(table_catalog.aget_or_load(table) for table in table_catalog.table_definitions))
+
+
+async def _timed_specialist(specialist: str, messages: Any,
+                            on_progress: Optional[ProgressCallback] = None,
+                            on_token: Optional[TokenCallback] = None,
+                            tool: str = "generate_report") -> Tuple[Dict[str, Any], float]:
+    started = time.perf_counter()
+    try:
+        response = await _run_specialist(specialist, _parse_messages(messages), on_progress, on_token, tool)
+    except Exception as e:
+        response = {"error": f"Error al generar resumen: {str(e)}"}
+    return response, (time.perf_counter() - started) * 1000
+
+
+async def run_report(messages: str = "", specialist_messages: Optional[Dict[str, str]] = None,
+                     on_progress: Optional[ProgressCallback] = None,
+                     on_token: Optional[TokenCallback] = None,
+                     tool: str = "generate_report") -> Dict[str, Any]:
+    """
+    Ejecuta los especialistas a la vez dentro del servidor (mismo catálogo, mismo pool de
+    conexiones) y combina sus salidas. `specialist_messages` permite una pregunta distinta
+    por especialista; sin él, todos reciben `messages`.
+    """
+    if not os.environ.get("OPENAI_API_KEY"):
+        return {"error": "OPENAI_API_KEY no está configurada"}
+    requests = specialist_messages or {specialist: messages for specialist in SPECIALIST_PROMPTS}
+    unknown = [s for s in requests if s not in SPECIALIST_PROMPTS]
+    if unknown:
+        return {"error": f"Especialistas desconocidos: {', '.join(unknown)} (opciones: {', '.join(SPECIALIST_PROMPTS)})"}
+
+    started = time.perf_counter()
+    try:
+        await _warm_catalog()
+    except Exception as e:
+        # Cada especialista volverá a intentarlo al validar sus tablas
+        logging.error(f"Error precargando el catálogo para el informe: {str(e)}")
+    outcomes = await asyncio.gather(*(_timed_specialist(s, m, on_progress, on_token, tool) for s, m in requests.items()))
+    specialists = dict(zip(requests, (response for response, _ in outcomes)))
+    timings = {s: round(ms, 1) for s, (_, ms) in zip(requests, outcomes)}
+    errors = {s: r["error"] for s, r in specialists.items() if "error" in r}
+
+    return {
+        "success": len(errors) < len(specialists),
+        "summary": "\n\n".join(
+            f"## {s}\n{r.get('summary') or r.get('error')}" for s, r in specialists.items()
+        ),
+        "specialists": specialists,
+        "errors": errors,
+        "timings_ms": timings,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
 
 @app.tool
-def curador_de_metricas(messages: str) -> Dict[str, Any]:
+async def curador_de_metricas(messages: str, ctx: Context) -> Dict[str, Any]:
    """
    Analista multiagente con conexion a data que hace:
    consultas de filtrado/ranking de KPIs. Entrega una especificación lista para el generador SQL.
    Objetivo: 
    Definir KPI, nivel, tiempo, filtros, orden, límite, baselines y criterios de calidad."""
 
-   return get_analystIAGraph(messages, prompt_curador_de_metricas)
+   return await get_analystIAGraph(messages, "curador_de_metricas", ctx)
 
 @app.tool
-def comparador(messages: str) -> Dict[str, Any]:
+async def comparador(messages: str, ctx: Context) -> Dict[str, Any]:
    """
    Analista multiagente con conexion a data que hace:
    Desmenuza la consulta de comparación A vs B y entrega una especificación.
    Objetivo:
    Definir KPI de comparación, cohortes A/B, controles de mezcla, tiempo, filtros, diferenciales (abs, %) y campos requeridos en la salida."""
 
-   return get_analystIAGraph(messages, prompt_comparador)
+   return await get_analystIAGraph(messages, "comparador", ctx)
 
 @app.tool
-def cronista_temporal(messages: str) -> Dict[str, Any]:
+async def cronista_temporal(messages: str, ctx: Context) -> Dict[str, Any]:
    """
    Analista multiagente con conexion a data que hace:
    Analista para Cronista Temporal. Desmenuza consultas de evolución en el tiempo y entrega una especificación lista.
    Objetivo:
    Definir KPI temporal, granularidad, rango, comparativos entre periodos, detección de quiebres, nivel de análisis, filtros y criterios de calidad."""
-   return get_analystIAGraph(messages, prompt_cronista_temporal)
+   return await get_analystIAGraph(messages, "cronista_temporal", ctx)
 
 @app.tool
-def orquestador_de_agregacion(messages: str) -> Dict[str, Any]:
+async def orquestador_de_agregacion(messages: str, ctx: Context) -> Dict[str, Any]:
    """
    Analista multiagente con conexion a data que hace:
    Analista para Orquestador de Agregaciones. Desmenuza resúmenes por jerarquías y entrega una especificación lista.                
    Objetivo:
    Definir KPI agregado (directo o ponderado), nivel jerárquico, ponderador, cobertura, reconciliación padre–hijo, filtros y criterios de calidad."""
-   return get_analystIAGraph(messages, prompt_orquestador_de_agregacion)
+   return await get_analystIAGraph(messages, "orquestador_de_agregacion", ctx)
 
 @app.tool
-def trade_offs(messages: str) -> Dict[str, Any]:
+async def trade_offs(messages: str, ctx: Context) -> Dict[str, Any]:
    """
    Analista multiagente con conexion a data que hace:
    Analista para Buscador de Trade-offs. Desmenuza cruces “alto X / bajo Y” y entrega una especificación lista.
    Objetivo:
    Definir X y Y, nivel de análisis, umbrales alto/bajo, score de priorización, tiempo, filtros y criterios de calidad."""
-   return get_analystIAGraph(messages, prompt_trade_offs)
+   return await get_analystIAGraph(messages, "trade_offs", ctx)
+
+@app.tool
+async def generate_report(ctx: Context, messages: str = "", specialist_messages: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+   """
+   Informe multiagente: ejecuta a la vez curador_de_metricas, comparador, cronista_temporal,
+   orquestador_de_agregacion y trade_offs y devuelve sus salidas combinadas.
+   Parámetros:
+   messages: pregunta común para todos los especialistas.
+   specialist_messages: pregunta por especialista ({"comparador": "...", ...}); si se indica,
+   solo se ejecutan los especialistas incluidos."""
+   reporter = ProgressReporter.from_context(ctx)
+   if reporter is None:
+       return await run_report(messages, specialist_messages)
+   return await run_report(messages, specialist_messages, reporter.node, reporter.token)
+
+
+# Trabajos asíncronos: el cliente encola, consulta el progreso y recoge el resultado
+REPORT_JOB = "generate_report"
+
+
+async def _run_job(job) -> Dict[str, Any]:
+    if job.kind == REPORT_JOB:
+        return await run_report(job.params["messages"], job.params.get("specialist_messages"), job.record_node,
+                                tool="submit_analysis")
+    return await _run_specialist(job.kind, _parse_messages(job.params["messages"]), job.record_node,
+                                 tool="submit_analysis")
+
+
+def _job_not_found(job_id: str) -> Dict[str, Any]:
+    return {"error": f"Trabajo no encontrado o expirado: {job_id}", "error_type": "not_found"}
+
+@app.tool
+async def submit_analysis(messages: str, specialist: str,
+                          specialist_messages: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+   """
+   Encola un análisis largo y devuelve de inmediato un job_id. Consultar el avance con
+   get_analysis_status y recoger la salida con get_analysis_result.
+   Parámetros:
+   messages: consulta (texto o lista JSON de mensajes).
+   specialist: curador_de_metricas, comparador, cronista_temporal, orquestador_de_agregacion,
+   trade_offs o generate_report (informe con todos los especialistas; admite specialist_messages)."""
+   if specialist not in SPECIALIST_PROMPTS and specialist != REPORT_JOB:
+       return {"error": f"Especialista desconocido: {specialist} (opciones: {', '.join([*SPECIALIST_PROMPTS, REPORT_JOB])})"}
+   if not os.environ.get("OPENAI_API_KEY"):
+       return {"error": "OPENAI_API_KEY no está configurada"}
+   try:
+       job = job_manager.submit(specialist, {"messages": messages, "specialist_messages": specialist_messages}, _run_job)
+   except JobQueueFull as e:
+       return {"error": str(e), "error_type": "queue_full"}
+   return {"job_id": job.id, "status": job.status, "queue_position": job_manager.position(job)}
+
+@app.tool
+async def get_analysis_status(job_id: str) -> Dict[str, Any]:
+   """Estado de un análisis encolado: queued, running, succeeded, failed o cancelled, y último nodo del grafo completado."""
+   job = job_manager.get(job_id)
+   if job is None:
+       return _job_not_found(job_id)
+   return {**job.info(), "queue_position": job_manager.position(job)}
+
+@app.tool
+async def get_analysis_result(job_id: str) -> Dict[str, Any]:
+   """Resultado de un análisis terminado (se conserva JOB_RESULT_TTL_SECONDS); si aún no terminó devuelve su estado."""
+   job = job_manager.get(job_id)
+   if job is None:
+       return _job_not_found(job_id)
+   if job.result is None:
+       return {**job.info(), "queue_position": job_manager.position(job)}
+   return {**job.result, "job_id": job.id, "status": job.status}
+
+@app.tool
+async def cancel_analysis(job_id: str) -> Dict[str, Any]:
+   """Cancela un análisis en cola o en ejecución."""
+   job = job_manager.cancel(job_id)
+   if job is None:
+       return _job_not_found(job_id)
+   # Espera a que el grafo libere la conexión antes de confirmar la cancelación
+   await job_manager.wait(job_id, timeout=5)
+   return job.info()
 
     
+@app.custom_route("/metrics", methods=["GET"])
+async def metrics(request: Request) -> JSONResponse:
+    """Métricas operativas del servidor para dimensionamiento"""
+    return JSONResponse({
+        "db_pool": pool_stats(),
+        "catalog": table_catalog.stats(),
+        "data_versions": data_versions.stats(),
+        "llm_cache": llm_cache.stats(),
+        "semantic_cache": semantic_sql_cache.stats(),
+        "kpi_templates": kpi_templates.stats(),
+        "materialized_views": materialized_views.stats(),
+        "columnar_snapshot": columnar_store.stats(),
+        "jobs": job_manager.stats(),
+        "single_flight": single_flight.stats(),
+        "admission": admission.stats(),
+    })
+
+
 if __name__ == "__main__":
+    if os.environ.get("OPENAI_API_KEY"):
+        build_graph_registry()
+    materialized_views.start()
+    columnar_store.start()
+    table_catalog.start()
     app.run(transport="sse", host="0.0.0.0", port=3000)
\ No newline at end of file
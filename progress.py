@@ -0,0 +1,70 @@
+import json
+import time
+import logging
+from typing import Any, Dict, Optional
+
+from agent import AnalystIAGraph
+
+
+class ProgressReporter:
+    """
+    Avisos de progreso MCP (notifications/progress) de una llamada a herramienta. Cada
+    aviso lleva en `message` un JSON con el evento: "node" al terminar un nodo del grafo
+    (nombre, tiempo transcurrido y resultados parciales nuevos) y "token" con cada
+    fragmento del texto de data_analyst. Solo se activa si el cliente envió progressToken.
+    """
+
+    def __init__(self, ctx: Any):
+        self.ctx = ctx
+        self.started = time.perf_counter()
+        self.sent = 0
+        self._partials: Dict[str, Dict[str, Any]] = {}
+        self._failed = False
+
+    @classmethod
+    def from_context(cls, ctx: Any) -> Optional["ProgressReporter"]:
+        """Reporter para la llamada en curso, o None si el cliente no pidió progreso"""
+        try:
+            meta = ctx.request_context.meta if ctx is not None else None
+        except (AttributeError, LookupError, ValueError):
+            return None
+        if meta is None or getattr(meta, "progressToken", None) is None:
+            return None
+        return cls(ctx)
+
+    def _elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    async def _send(self, event: Dict[str, Any]) -> None:
+        # Un cliente desconectado no debe interrumpir el análisis
+        if self._failed:
+            return
+        self.sent += 1
+        try:
+            await self.ctx.report_progress(self.sent, None, json.dumps(event, ensure_ascii=False, default=str))
+        except Exception as e:
+            self._failed = True
+            logging.error(f"Error enviando avisos de progreso: {str(e)}")
+
+    async def node(self, specialist: str, node: str, state: Dict[str, Any]) -> None:
+        """Nodo terminado: solo se envían los resultados parciales que cambiaron"""
+        payload = AnalystIAGraph.progress_payload(state)
+        previous = self._partials.setdefault(specialist, {})
+        partial = {key: value for key, value in payload.items() if previous.get(key) != value}
+        previous.update(partial)
+        await self._send({
+            "event": "node",
+            "specialist": specialist,
+            "node": node,
+            "elapsed_ms": self._elapsed_ms(),
+            "partial": partial,
+        })
+
+    async def token(self, specialist: str, node: str, text: str) -> None:
+        await self._send({
+            "event": "token",
+            "specialist": specialist,
+            "node": node,
+            "elapsed_ms": self._elapsed_ms(),
+            "text": text,
+        })
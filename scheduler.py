@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# Prioridades de la cola de espera (menor = antes)
+INTERACTIVE, BATCH = 0, 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+
+class Overloaded(Exception):
+    """Servidor saturado: la petición se rechaza con una sugerencia de reintento"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    """"generate_report=2,submit_analysis=4" -> {"generate_report": 2, "submit_analysis": 4}"""
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            tool, limit = item.split("=", 1)
+            limits[tool.strip()] = int(limit)
+    return limits
+
+
+class _Waiter:
+    def __init__(self, tool: str, priority: int):
+        self.tool = tool
+        self.priority = priority
+        self.enqueued_at = time.perf_counter()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.granted = False
+
+
+class AdmissionController:
+    """
+    Control de admisión de las ejecuciones del grafo: límite global (MAX_CONCURRENT_RUNS)
+    y por herramienta (TOOL_CONCURRENCY), cola de espera acotada (ADMISSION_QUEUE_SIZE)
+    ordenada por prioridad, de modo que el chat interactivo pasa antes que informes y
+    trabajos. Con la cola llena o tras ADMISSION_MAX_WAIT_SECONDS en espera se rechaza
+    con Overloaded y un retry_after estimado, en lugar de agotar a la vez los límites de
+    OpenAI y las conexiones de PostgreSQL.
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, tool_limits: Optional[Dict[str, int]] = None,
+                 queue_size: Optional[int] = None, max_wait_seconds: Optional[float] = None):
+        self.max_concurrent = max_concurrent if max_concurrent is not None else max(1, int(os.environ.get("MAX_CONCURRENT_RUNS", "8")))
+        self.tool_limits = tool_limits if tool_limits is not None else _parse_limits(os.environ.get("TOOL_CONCURRENCY", ""))
+        self.queue_size = queue_size if queue_size is not None else int(os.environ.get("ADMISSION_QUEUE_SIZE", "50"))
+        self.max_wait_seconds = max_wait_seconds if max_wait_seconds is not None else float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "30"))
+        self._running: Dict[str, int] = {}
+        self._running_total = 0
+        self._waiting: List[Any] = []  # heap de (prioridad, orden de llegada, _Waiter)
+        self._sequence = itertools.count()
+        self._waits_ms: deque = deque(maxlen=1000)
+        self._run_seconds = 10.0  # media móvil de la duración de una ejecución, para retry_after
+        self.counts = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_wait_timeout": 0}
+
+    def _has_capacity(self, tool: str) -> bool:
+        limit = self.tool_limits.get(tool)
+        return self._running_total < self.max_concurrent and (limit is None or self._running.get(tool, 0) < limit)
+
+    def _start(self, tool: str) -> None:
+        self._running_total += 1
+        self._running[tool] = self._running.get(tool, 0) + 1
+        self.counts["admitted"] += 1
+
+    def _dispatch(self) -> None:
+        """Da plaza a los que esperan, por prioridad; un límite por herramienta no bloquea a las demás"""
+        for entry in sorted(self._waiting):
+            if self._running_total >= self.max_concurrent:
+                break
+            waiter = entry[2]
+            if self._has_capacity(waiter.tool):
+                self._waiting.remove(entry)
+                self._start(waiter.tool)
+                waiter.granted = True
+                waiter.future.set_result(None)
+        heapq.heapify(self._waiting)
+
+    def _release(self, tool: str, run_seconds: Optional[float] = None) -> None:
+        self._running_total -= 1
+        self._running[tool] -= 1
+        if run_seconds is not None:
+            self._run_seconds = 0.8 * self._run_seconds + 0.2 * run_seconds
+        self._dispatch()
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que haya plaza: turnos de espera por la duración media"""
+        turns = (len(self._waiting) + 1) / self.max_concurrent
+        return max(1, math.ceil(turns * self._run_seconds))
+
+    def _remove(self, waiter: _Waiter) -> None:
+        self._waiting = [entry for entry in self._waiting if entry[2] is not waiter]
+        heapq.heapify(self._waiting)
+
+    async def _acquire(self, tool: str, priority: int) -> None:
+        if not self._waiting and self._has_capacity(tool):
+            self._start(tool)
+            self._waits_ms.append(0.0)
+            return
+        if len(self._waiting) >= self.queue_size:
+            self.counts["rejected_queue_full"] += 1
+            raise Overloaded(f"Servidor saturado: {len(self._waiting)} peticiones en espera", self.retry_after())
+        waiter = _Waiter(tool, priority)
+        heapq.heappush(self._waiting, (priority, next(self._sequence), waiter))
+        self.counts["queued"] += 1
+        self._dispatch()
+        try:
+            async with asyncio.timeout(self.max_wait_seconds):
+                await waiter.future
+        except BaseException as e:
+            if waiter.granted:
+                self._release(tool)
+            else:
+                self._remove(waiter)
+            if isinstance(e, TimeoutError):
+                self.counts["rejected_wait_timeout"] += 1
+                raise Overloaded(f"Servidor saturado: sin plaza tras {self.max_wait_seconds:g} s en espera", self.retry_after())
+            raise
+        self._waits_ms.append((time.perf_counter() - waiter.enqueued_at) * 1000)
+
+    @asynccontextmanager
+    async def slot(self, tool: str, priority: int = INTERACTIVE) -> AsyncIterator[None]:
+        """Ocupa una plaza de ejecución durante el bloque; lanza Overloaded si no la obtiene"""
+        await self._acquire(tool, priority)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(tool, time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits_ms)
+        waiting: Dict[str, int] = {}
+        for priority, _, _ in self._waiting:
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            waiting[name] = waiting.get(name, 0) + 1
+        return {
+            "max_concurrent": self.max_concurrent,
+            "tool_limits": self.tool_limits,
+            "queue_size": self.queue_size,
+            "max_wait_seconds": self.max_wait_seconds,
+            "running": self._running_total,
+            "running_by_tool": {tool: n for tool, n in self._running.items() if n},
+            "queue_depth": len(self._waiting),
+            "queue_depth_by_priority": waiting,
+            "wait_ms": {
+                "avg": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 1) if waits else 0.0,
+                "max": round(waits[-1], 1) if waits else 0.0,
+            },
+            "avg_run_seconds": round(self._run_seconds, 2),
+            **self.counts,
+        }
+
+
+# Control de admisión compartido por todas las herramientas del proceso
+admission = AdmissionController()
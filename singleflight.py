@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from usage import count_calls
+
+
+def normalise_messages(messages: List[Dict[str, str]]) -> str:
+    """Mensajes en forma canónica: mismos textos salvo espacios dan la misma clave"""
+    canonical = [
+        {key: " ".join(value.split()) if isinstance(value, str) else value for key, value in message.items()}
+        if isinstance(message, dict) else message
+        for message in messages
+    ]
+    return json.dumps(canonical, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalescencia de peticiones idénticas concurrentes (SINGLE_FLIGHT=true): mientras una
+    ejecución con la misma clave está en curso, las demás la esperan y comparten su
+    resultado en lugar de repetir el grafo. La ejecución solo se cancela cuando no queda
+    nadie esperándola, y las llamadas al LLM y a la base que hizo se cuentan como
+    ahorradas por cada petición que se unió.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = enabled if enabled is not None else os.environ.get("SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.counts = {"executions": 0, "coalesced": 0, "saved_llm_calls": 0, "saved_db_calls": 0}
+
+    @staticmethod
+    async def _execute(factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, Dict[str, int]]:
+        with count_calls() as counter:
+            result = await factory()
+        return result, counter.counts()
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Ejecuta `factory()` o se une a la ejecución en curso con la misma clave"""
+        if not self.enabled:
+            return await factory()
+        flight = self._flights.get(key)
+        joined = flight is not None
+        if joined:
+            self.counts["coalesced"] += 1
+        else:
+            flight = _Flight(asyncio.create_task(self._execute(factory)))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._flights.pop(key, None) if self._flights.get(key) is flight else None)
+            self.counts["executions"] += 1
+        flight.waiters += 1
+        try:
+            result, calls = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+        if joined:
+            self.counts["saved_llm_calls"] += calls["llm_calls"]
+            self.counts["saved_db_calls"] += calls["db_calls"]
+        # Copia superficial: cada petición recibe su propio diccionario
+        return dict(result) if isinstance(result, dict) else result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "in_flight": len(self._flights), **self.counts}
+
+
+# Coalescencia compartida por todas las herramientas del proceso
+single_flight = SingleFlight()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from analytics import budget_result, level_shift, series_trend
+
+
+def test_level_shift_finds_new_level():
+    shift = level_shift(np.array([1, 1, 1, 1, 5, 5, 5, 5], dtype=float))
+    assert shift == {"week_offset": 3, "mean_before": 1.0, "mean_after": 5.0, "variance_explained": 1.0}
+
+
+def test_level_shift_skips_missing_weeks():
+    shift = level_shift(np.array([np.nan, 1, 1, 1, 5, 5, 5, np.nan]))
+    # La semana más reciente falta: el nuevo nivel empieza tres semanas atrás
+    assert shift["week_offset"] == 3
+    assert shift["mean_after"] == 5.0
+
+
+@pytest.mark.parametrize("series", [
+    [1, 2, 1, 2, 1, 2, 1, 2],  # oscila sin cambiar de nivel
+    [3, 3, 3, 3],              # constante
+    [1, 1, 5],                 # demasiado corta
+])
+def test_level_shift_none(series):
+    assert level_shift(np.array(series, dtype=float)) is None
+
+
+def test_series_trend_reports_level_shift_as_breakpoint():
+    trend = series_trend(np.array([1, 1, 1, 1, 5, 5, 5, 5], dtype=float))
+    assert trend["breakpoint"]["week_offset"] == 3
+    assert trend["wow_delta"] == 0.0
+
+
+def _rows(n):
+    return [{"country": "CO", "zone": f"Z{i}", "l0w": float(i), "l1w": i / 2, "l2w": i / 3} for i in range(n)]
+
+
+def test_budget_result_keeps_everything_that_fits():
+    result = budget_result(_rows(3), 10000, total_rows=8)
+    assert len(result["rows"]) == 3
+    assert result["constant_columns"] == {"country": "CO"}
+    assert result["columns"] == ["zone", "l0w", "l1w", "l2w"]
+    assert result["dropped"] == {"rows_not_fetched": 5}
+
+
+def test_budget_result_trims_oldest_weeks_and_reports_rows():
+    result = budget_result(_rows(100), 120)
+    assert result["token_estimate"] <= 120
+    assert result["dropped"]["columns"] == ["l2w"]
+    assert len(result["rows"]) + result["dropped"]["rows"] == 100
+    # Se conservan los extremos de la primera métrica
+    values = [row["l0w"] for row in result["rows"]]
+    assert 0.0 in values and 99.0 in values
+
+
+def test_budget_result_without_rows():
+    assert budget_result([], 100, total_rows=5) == {
+        "rows": [], "columns": [], "constant_columns": {}, "token_estimate": 0, "dropped": {"rows_not_fetched": 5},
+    }
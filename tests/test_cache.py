@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+
+from cache import SemanticSQLCache, _key_terms
+
+QUESTION = "¿Cuáles son las 5 peores zonas por Lead Penetration?"
+
+
+@pytest.fixture
+def semantic_cache(tmp_path):
+    cache = SemanticSQLCache(enabled=True, path=str(tmp_path / "semantic.sqlite"), threshold=0.5,
+                             max_entries=10, max_extra_terms=1, flush_seconds=3600)
+    cache.remember("curador_de_metricas", QUESTION, "SELECT 1", [], False, ["raw_input_metrics"], None)
+    return cache
+
+
+def _last_used(cache, question):
+    db = sqlite3.connect(cache.path)
+    try:
+        return db.execute("SELECT last_used FROM semantic_sql WHERE question = ?", (question,)).fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_key_terms_fold_plurals():
+    assert _key_terms("peores zonas ciudades") == _key_terms("peor zona ciudad")
+
+
+def test_lookup_matches_singular_wording(semantic_cache):
+    match = semantic_cache.lookup("curador_de_metricas", "cual es la 5 peor zona por lead penetration")
+    assert match is not None
+    assert match["sql_query"] == "SELECT 1"
+
+
+def test_lookup_tolerates_one_extra_term(semantic_cache):
+    assert semantic_cache.lookup("curador_de_metricas", "5 peores zonas por Lead Penetration hoy") is not None
+
+
+@pytest.mark.parametrize("question", [
+    "¿Cuáles son las 5 mejores zonas por Lead Penetration?",
+    "¿Cuáles son las 10 peores zonas por Lead Penetration?",
+    "5 peores zonas por Lead Penetration esta semana en Colombia",
+])
+def test_lookup_rejects_different_question(semantic_cache, question):
+    assert semantic_cache.lookup("curador_de_metricas", question) is None
+
+
+def test_lookup_is_scoped_by_namespace(semantic_cache):
+    assert semantic_cache.lookup("comparador", QUESTION) is None
+
+
+def test_hits_are_written_in_batches(semantic_cache):
+    match = semantic_cache.lookup("curador_de_metricas", QUESTION)
+    question = match["matched_question"]
+    stored = _last_used(semantic_cache, question)
+    assert stored < match["last_used"]
+    assert semantic_cache.stats()["pending_writes"] == 1
+
+    assert semantic_cache.flush() == 1
+    assert _last_used(semantic_cache, question) > stored
+    assert semantic_cache.stats()["pending_writes"] == 0
+
+
+def test_entries_are_reloaded_from_disk(semantic_cache):
+    reloaded = SemanticSQLCache(enabled=True, path=semantic_cache.path, threshold=0.5)
+    assert reloaded.lookup("curador_de_metricas", QUESTION)["sql_query"] == "SELECT 1"
@@ -0,0 +1,80 @@
+import asyncio
+
+import catalog
+from catalog import TableCatalog, numeric_columns, parse_table_stats, table_stats_query
+
+DEFINITION = {
+    "name": "raw_orders",
+    "columns": [
+        {"name": "zone", "type": "text"},
+        {"name": "l1w", "type": "integer"},
+        {"name": "l0w", "type": "integer"},
+    ],
+}
+
+
+def test_numeric_columns_uses_definition_types():
+    assert numeric_columns(DEFINITION) == ["l1w", "l0w"]
+
+
+def test_table_stats_query_scans_once():
+    query = table_stats_query("raw_orders", ["l0w"])
+    assert query.count("FROM raw_orders") == 1
+    assert 'AVG(l0w) AS "l0w.avg"' in query
+
+
+def test_parse_table_stats():
+    row = {"total_rows": 4, "l0w.null_count": 1, "l0w.avg": 2.5, "l0w.min": 1, "l0w.max": 4}
+    total_rows, stats = parse_table_stats(row, ["l0w"])
+    assert total_rows == 4
+    assert stats == {"l0w": {"count": 4, "null_count": 1, "avg": 2.5, "min": 1, "max": 4}}
+
+
+def test_parse_table_stats_without_row():
+    assert parse_table_stats(None, ["l0w"]) == (0, {})
+
+
+def _probe(table_name, table_definition):
+    return {"exists": True, "definition": table_definition, "total_rows": 1, "column_stats": {}}, [{"zone": "Z1"}]
+
+
+def test_refresh_stale_only_reloads_changed_tables(monkeypatch):
+    monkeypatch.setattr(catalog, "probe_table", _probe)
+    versions = {"raw_orders": "v1"}
+    table_catalog = TableCatalog([DEFINITION], ttl_seconds=3600, version_probe=lambda tables: dict(versions))
+
+    assert table_catalog.refresh_stale() == ["raw_orders"]
+    assert table_catalog.refresh_stale() == []
+    versions["raw_orders"] = "v2"
+    assert table_catalog.refresh_stale() == ["raw_orders"]
+    assert table_catalog.get("raw_orders").data_version == "v2"
+
+
+def test_async_refresh_records_data_version(monkeypatch):
+    async def aprobe(table_name, table_definition):
+        return _probe(table_name, table_definition)
+
+    async def aversions(tables):
+        return {"raw_orders": "v1"}
+
+    monkeypatch.setattr(catalog, "aprobe_table", aprobe)
+    table_catalog = TableCatalog([DEFINITION], ttl_seconds=3600, version_probe=lambda tables: {"raw_orders": "v1"},
+                                 aversion_probe=aversions)
+
+    entry = asyncio.run(table_catalog.arefresh_table("raw_orders"))
+    assert entry.data_version == "v1"
+    assert table_catalog.refresh_stale() == []
+
+
+def test_snapshot_probe_skips_database(monkeypatch):
+    def fail(*args):
+        raise AssertionError("no debería consultar PostgreSQL")
+
+    monkeypatch.setattr(catalog, "probe_table", fail)
+    table_catalog = TableCatalog(
+        [DEFINITION], version_probe=lambda tables: {"raw_orders": "v1"},
+        snapshot_probe=lambda table, columns, version: (7, {"l0w": {"count": 7}}, [{"zone": "Z1"}]),
+    )
+    entry = table_catalog.refresh_table("raw_orders")
+    assert entry.validated["total_rows"] == 7
+    assert entry.samples == [{"zone": "Z1"}]
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import kpi_templates
+from columnar import ColumnarStore, ColumnarTable
+from kpi_templates import KPITemplateLibrary
+from utils import data_versions
+
+COLUMNS = ["country", "city", "zone", "metric", "l1w_roll", "l0w_roll"]
+ROWS = [
+    ("CO", "Bogota", "Z1", "Perfect Orders", 0.5, 0.7),
+    ("CO", "Medellin", "Z2", "Perfect Orders", 0.4, None),
+    ("MX", "CDMX", "Z3", "Lead Penetration", 0.2, 0.3),
+]
+
+
+def _store(version="v1"):
+    store = ColumnarStore(tables=["raw_input_metrics"], enabled=True)
+    store._snapshots["raw_input_metrics"] = ColumnarTable(
+        "raw_input_metrics", COLUMNS, ROWS, data_versions.combine({"raw_input_metrics": version})
+    )
+    return store
+
+
+@pytest.fixture
+def versions(monkeypatch):
+    current = {"raw_input_metrics": "v1"}
+    monkeypatch.setattr(data_versions, "versions", lambda tables: {t: current[t] for t in tables})
+    return current
+
+
+def test_week_matrix_and_nulls():
+    table = ColumnarTable("raw_input_metrics", COLUMNS, ROWS, None)
+    assert table.week_columns == ["l0w_roll", "l1w_roll"]
+    assert np.isnan(table.weeks[1, 0])
+    assert table.rows(np.array([1]), ["zone", "l0w_roll"]) == [{"zone": "Z2", "l0w_roll": None}]
+
+
+def test_mask_filters_text_columns():
+    table = ColumnarTable("raw_input_metrics", COLUMNS, ROWS, None)
+    assert table.mask({"country": "CO", "city": None}).tolist() == [True, True, False]
+    assert not table.mask({"country": "AR"}).any()
+
+
+def test_get_accepts_table_version(versions):
+    store = _store()
+    assert store.get("raw_input_metrics", "v1") is not None
+    assert store.get("raw_input_metrics") is not None
+    versions["raw_input_metrics"] = "v2"
+    assert store.get("raw_input_metrics") is None
+    assert store.stats()["hits"] == 2 and store.stats()["misses"] == 1
+
+
+def test_fresh_snapshot_serves_vocabulary(monkeypatch, versions):
+    def fail():
+        raise AssertionError("el vocabulario no debería consultar PostgreSQL")
+
+    store = _store()
+    monkeypatch.setattr(kpi_templates, "columnar_store", store)
+    monkeypatch.setattr(kpi_templates, "db_connection", fail)
+    library = KPITemplateLibrary(enabled=True, use_cube=False)
+    library._load_vocabulary()
+    assert library._vocabulary["metrics"] == ["Lead Penetration", "Perfect Orders"]
+    assert library._vocabulary["countries"] == {"CO", "MX"}
+    assert store.stats()["misses"] == 0
+
+
+def test_all_null_text_column_stays_text():
+    rows = [(None, 1.0), (None, 2.0)]
+    typed = ColumnarTable("t", ["city", "l0w"], rows, None, numeric=["l0w"])
+    inferred = ColumnarTable("t", ["city", "l0w"], rows, None)
+    for table in (typed, inferred):
+        assert "city" in table.codes and "l0w" in table.numeric
+        assert not table.mask({"city": "Bogota"}).any()
+        assert table.distinct("city") == []
+
+
+def test_store_types_columns_from_definitions():
+    store = ColumnarStore(tables=["t"], enabled=True)
+    store.set_table_definitions([{"name": "t", "columns": [{"name": "code", "type": "text"}, {"name": "l0w", "type": "integer"}]}])
+    numeric = store._numeric_columns("t")
+    # "code" tiene valores numéricos pero la definición lo declara texto
+    table = ColumnarTable("t", ["code", "l0w"], [(1, 5), (2, None)], None, numeric=numeric)
+    assert "code" in table.codes and table.week_columns == ["l0w"]
+    assert store._numeric_columns("missing") is None
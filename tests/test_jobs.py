@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from jobs import CANCELLED, FAILED, QUEUED, SUCCEEDED, JobManager, JobQueueFull
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_job_succeeds():
+    async def scenario():
+        manager = JobManager(workers=1, queue_size=5, result_ttl_seconds=60)
+
+        async def runner(job):
+            job.record_node("comparador", "sql_agent")
+            return {"data_analysis": "ok"}
+
+        job = manager.submit("comparador", {}, runner)
+        await manager.wait(job.id, timeout=1)
+        return job
+
+    job = _run(scenario())
+    assert job.status == SUCCEEDED
+    assert job.result == {"data_analysis": "ok"}
+    assert job.info()["last_completed_node"] == {"comparador": "sql_agent"}
+
+
+def test_error_result_marks_job_failed():
+    async def scenario():
+        manager = JobManager(workers=1, queue_size=5, result_ttl_seconds=60)
+
+        async def runner(job):
+            return {"error": "sin datos"}
+
+        job = manager.submit("comparador", {}, runner)
+        return await manager.wait(job.id, timeout=1)
+
+    job = _run(scenario())
+    assert job.status == FAILED
+    assert job.error == "sin datos"
+
+
+def test_cancel_running_job_and_wait():
+    async def scenario():
+        manager = JobManager(workers=1, queue_size=5, result_ttl_seconds=60)
+        started = asyncio.Event()
+
+        async def runner(job):
+            started.set()
+            await asyncio.sleep(60)
+
+        job = manager.submit("generate_report", {}, runner)
+        await started.wait()
+        manager.cancel(job.id)
+        await manager.wait(job.id, timeout=1)
+        return manager, job
+
+    manager, job = _run(scenario())
+    assert job.status == CANCELLED
+    assert manager.stats()["totals"][CANCELLED] == 1
+
+
+def test_cancel_queued_job():
+    async def scenario():
+        manager = JobManager(workers=1, queue_size=5, result_ttl_seconds=60)
+        release = asyncio.Event()
+
+        async def blocking(job):
+            await release.wait()
+            return {}
+
+        first = manager.submit("comparador", {}, blocking)
+        second = manager.submit("comparador", {}, blocking)
+        await asyncio.sleep(0)
+        position = manager.position(second)
+        manager.cancel(second.id)
+        release.set()
+        await manager.wait(first.id, timeout=1)
+        return position, first, second
+
+    position, first, second = _run(scenario())
+    assert position == 0
+    assert second.status == CANCELLED
+    assert first.status == SUCCEEDED
+
+
+def test_wait_times_out_while_running():
+    async def scenario():
+        manager = JobManager(workers=1, queue_size=5, result_ttl_seconds=60)
+
+        async def runner(job):
+            await asyncio.sleep(60)
+
+        job = manager.submit("comparador", {}, runner)
+        waited = await manager.wait(job.id, timeout=0.05)
+        return waited.status
+
+    assert _run(scenario()) != SUCCEEDED
+
+
+def test_queue_full_is_rejected():
+    async def scenario():
+        manager = JobManager(workers=1, queue_size=1, result_ttl_seconds=60)
+
+        async def runner(job):
+            return {}
+
+        manager.submit("comparador", {}, runner)
+        with pytest.raises(JobQueueFull):
+            manager.submit("comparador", {}, runner)
+        return manager.stats()
+
+    stats = _run(scenario())
+    assert stats["totals"]["rejected"] == 1
+    assert stats["jobs"] == {QUEUED: 1}
+
+
+def test_wait_unknown_job():
+    manager = JobManager(workers=1, queue_size=1, result_ttl_seconds=60)
+    assert _run(manager.wait("missing", timeout=0)) is None
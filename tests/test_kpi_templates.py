@@ -0,0 +1,61 @@
+import pytest
+
+from kpi_templates import KPITemplateLibrary
+
+VOCABULARY = {
+    "metrics": sorted(["Perfect Orders", "Orders", "Lead Penetration", "Gross Profit UE"], key=len, reverse=True),
+    "countries": {"CO", "MX"},
+    "cities": ["Bogota", "Medellin"],
+}
+
+
+@pytest.fixture
+def library(monkeypatch):
+    library = KPITemplateLibrary(enabled=True, use_cube=False)
+    monkeypatch.setattr(library, "_load_vocabulary", lambda: None)
+    library._vocabulary = VOCABULARY
+    return library
+
+
+def test_ranking_question_matches(library):
+    match = library.match("Top 5 zonas con mayor Perfect Orders en Colombia")
+    assert match.template == "metric_ranking"
+    assert match.params["metric"] == "Perfect Orders"
+    assert match.params["country"] == "CO"
+    assert match.params["limit"] == 5
+    assert match.params["direction"] == "DESC"
+    assert match.statement_params()["metric"] == "Perfect Orders"
+
+
+def test_longest_metric_does_not_count_twice(library):
+    match = library.match("¿Cuáles son las peores zonas en Perfect Orders?")
+    assert match.params["metric"] == "Perfect Orders"
+    assert match.params["direction"] == "ASC"
+
+
+def test_two_metric_question_is_not_matched(library):
+    assert library.match("¿Cuáles zonas tienen mayor Gross Profit UE pero menor Lead Penetration?") is None
+    assert library.match("Zonas con mayor Gross Profit UE y menor Lead Penetration") is None
+
+
+def test_conjunctive_question_is_not_matched(library):
+    assert library.match("Top zonas con mayor Perfect Orders en Bogota y Medellin") is None
+    assert library.match("Ranking de zonas con mayor Perfect Orders pero solo las priorizadas") is None
+
+
+def test_cohort_comparison_keeps_vs(library):
+    match = library.match("Compara Perfect Orders entre zonas Wealthy vs Non Wealthy en MX")
+    assert match.template == "cohort_comparison"
+    assert match.params["cohort"] == "zone_type"
+
+
+def test_trend_question(library):
+    match = library.match("Evolución de Lead Penetration en las últimas 4 semanas en Medellin")
+    assert match.template == "metric_trend"
+    assert match.params["weeks"] == 4
+    assert match.params["city"] == "Medellin"
+
+
+def test_unmatched_question_counts_miss(library):
+    assert library.match("¿Qué explica el crecimiento de la empresa?") is None
+    assert library.stats()["misses"] == 1
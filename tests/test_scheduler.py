@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from scheduler import BATCH, INTERACTIVE, AdmissionController, Overloaded, _parse_limits
+
+
+def test_parse_limits():
+    assert _parse_limits("generate_report=2, submit_analysis=4,") == {"generate_report": 2, "submit_analysis": 4}
+
+
+def test_interactive_requests_go_first():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=1, tool_limits={}, queue_size=10, max_wait_seconds=1)
+        order = []
+        release = asyncio.Event()
+
+        async def run(tool, priority):
+            async with admission.slot(tool, priority):
+                order.append(tool)
+                await release.wait()
+
+        holder = asyncio.create_task(run("holder", INTERACTIVE))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(run("generate_report", BATCH)),
+                   asyncio.create_task(run("comparador", INTERACTIVE))]
+        await asyncio.sleep(0)
+        assert admission.stats()["queue_depth_by_priority"] == {"batch": 1, "interactive": 1}
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        return order, admission.stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order == ["holder", "comparador", "generate_report"]
+    assert stats["running"] == 0 and stats["admitted"] == 3 and stats["queued"] == 2
+
+
+def test_tool_limit_does_not_block_other_tools():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=3, tool_limits={"generate_report": 1}, queue_size=10, max_wait_seconds=1)
+        release = asyncio.Event()
+
+        async def run(tool):
+            async with admission.slot(tool, BATCH):
+                await release.wait()
+
+        tasks = [asyncio.create_task(run(tool)) for tool in ("generate_report", "generate_report", "comparador")]
+        await asyncio.sleep(0)
+        running = admission.stats()["running_by_tool"]
+        release.set()
+        await asyncio.gather(*tasks)
+        return running
+
+    assert asyncio.run(scenario()) == {"generate_report": 1, "comparador": 1}
+
+
+def test_full_queue_is_rejected():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=1, tool_limits={}, queue_size=0, max_wait_seconds=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with admission.slot("comparador"):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as overloaded:
+            async with admission.slot("comparador"):
+                pass
+        release.set()
+        await holder
+        return overloaded.value, admission.counts
+
+    error, counts = asyncio.run(scenario())
+    assert error.retry_after >= 1
+    assert counts["rejected_queue_full"] == 1
+
+
+def test_wait_timeout_is_rejected_and_leaves_queue():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=1, tool_limits={}, queue_size=5, max_wait_seconds=0.05)
+        release = asyncio.Event()
+
+        async def hold():
+            async with admission.slot("comparador"):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            async with admission.slot("trade_offs"):
+                pass
+        depth = admission.stats()["queue_depth"]
+        release.set()
+        await holder
+        return depth, admission.stats()
+
+    depth, stats = asyncio.run(scenario())
+    assert depth == 0
+    assert stats["rejected_wait_timeout"] == 1
+    assert stats["running"] == 0
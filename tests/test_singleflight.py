@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight, normalise_messages
+from usage import record_db_call
+
+
+def test_normalise_messages_ignores_whitespace():
+    assert normalise_messages([{"role": "user", "content": "peores  zonas\n"}]) == \
+        normalise_messages([{"role": "user", "content": "peores zonas"}])
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+        executions = 0
+
+        async def factory():
+            nonlocal executions
+            executions += 1
+            record_db_call()
+            await asyncio.sleep(0.01)
+            return {"data_analysis": "ok"}
+
+        results = await asyncio.gather(*(flight.run("key", factory) for _ in range(3)))
+        return flight, executions, results
+
+    flight, executions, results = asyncio.run(scenario())
+    assert executions == 1
+    assert results == [{"data_analysis": "ok"}] * 3
+    # Cada petición recibe su propio diccionario
+    assert results[0] is not results[1]
+    assert flight.stats() == {"enabled": True, "in_flight": 0, "executions": 1, "coalesced": 2,
+                              "saved_llm_calls": 0, "saved_db_calls": 2}
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+
+        async def factory():
+            await asyncio.sleep(0)
+            return 1
+
+        await asyncio.gather(flight.run("a", factory), flight.run("b", factory))
+        return flight.counts
+
+    assert asyncio.run(scenario())["executions"] == 2
+
+
+def test_execution_survives_while_someone_waits():
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(flight.run("key", factory))
+        second = asyncio.create_task(flight.run("key", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await second, first.cancelled()
+
+    assert asyncio.run(scenario()) == ("done", True)
+
+
+def test_last_waiter_cancels_execution():
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+        cancelled = asyncio.Event()
+
+        async def factory():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.create_task(flight.run("key", factory))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0.01)  # el callback de fin de la ejecución retira la clave
+        return flight.stats()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_disabled_runs_every_call():
+    async def scenario():
+        flight = SingleFlight(enabled=False)
+        executions = 0
+
+        async def factory():
+            nonlocal executions
+            executions += 1
+            return executions
+
+        await asyncio.gather(flight.run("key", factory), flight.run("key", factory))
+        return executions
+
+    assert asyncio.run(scenario()) == 2
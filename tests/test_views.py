@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+
+import views
+from utils import data_versions
+from views import VIEWS, MaterializedViewManager
+
+
+class _Result:
+    def __init__(self, row=None):
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+class _Connection:
+    """Conexión simulada: recuerda las sentencias y responde con los comentarios guardados"""
+
+    def __init__(self, comments):
+        self.comments = comments
+        self.autocommit = False
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        if isinstance(statement, str):
+            name = params[0]
+            return _Result({"present": name in self.comments, "comment": self.comments.get(name)})
+        self.statements.append(statement.as_string(None))
+        return _Result()
+
+
+def _ensure(monkeypatch, comments):
+    conn = _Connection(comments)
+
+    @contextmanager
+    def db_connection():
+        yield conn
+
+    monkeypatch.setattr(views, "db_connection", db_connection)
+    monkeypatch.setattr(data_versions, "fingerprint", lambda tables: "v1")
+    MaterializedViewManager(VIEWS, enabled=True).ensure()
+    return [statement for statement in conn.statements if statement.startswith("DROP")]
+
+
+def test_definition_hash_is_stable_and_distinct():
+    weekly, cube = VIEWS
+    assert weekly.definition_hash == weekly.definition_hash
+    assert weekly.definition_hash != cube.definition_hash
+
+
+def test_ensure_keeps_views_with_current_definition(monkeypatch):
+    comments = {view.name: view.definition_hash for view in VIEWS}
+    assert _ensure(monkeypatch, comments) == []
+
+
+def test_ensure_recreates_view_with_old_definition(monkeypatch):
+    comments = {view.name: view.definition_hash for view in VIEWS}
+    comments["metrics_weekly"] = "mcp-view:old"
+    assert _ensure(monkeypatch, comments) == ['DROP MATERIALIZED VIEW "metrics_weekly" CASCADE']
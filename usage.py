@@ -0,0 +1,56 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+
+class CallCounter(BaseCallbackHandler):
+    """
+    Cuenta las llamadas al LLM y las conexiones a PostgreSQL de una ejecución. Se
+    propaga por contextvars, así que incluye ramas paralelas y asyncio.to_thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.llm_calls = 0
+        self.db_calls = 0
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, **kwargs: Any) -> None:
+        with self._lock:
+            self.llm_calls += 1
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: Any, **kwargs: Any) -> None:
+        with self._lock:
+            self.llm_calls += 1
+
+    def record_db_call(self) -> None:
+        with self._lock:
+            self.db_calls += 1
+
+    def counts(self) -> Dict[str, int]:
+        return {"llm_calls": self.llm_calls, "db_calls": self.db_calls}
+
+
+_call_counter: ContextVar[Optional[CallCounter]] = ContextVar("call_counter", default=None)
+# LangChain añade el contador activo a los callbacks de cada modelo invocado dentro del contexto
+register_configure_hook(_call_counter, inheritable=True)
+
+
+@contextmanager
+def count_calls() -> Iterator[CallCounter]:
+    """Cuenta las llamadas al LLM y a la base hechas dentro del bloque `with`"""
+    counter = CallCounter()
+    token = _call_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _call_counter.reset(token)
+
+
+def record_db_call() -> None:
+    counter = _call_counter.get()
+    if counter is not None:
+        counter.record_db_call()
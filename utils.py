@@ -1,17 +1,399 @@
-import psycopg2
+import asyncio
+import atexit
+import hashlib
+import threading
+import time
+import uuid
+import psycopg
 from pydantic import BaseModel
-from psycopg2.extras import RealDictCursor
-from typing import Any, Dict, List, Optional, Sequence, Union
+from psycopg import sql
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 import os
 
-def get_db_connection():
-    """Establece conexión con la base de datos PostgreSQL"""
-    conn = psycopg2.connect(
-        host=os.environ.get("DB_HOST"),
-        port=int(os.environ.get("DB_PORT")),
-        user=os.environ.get("DB_USER"),
-        password=os.environ.get("DB_PASSWORD"),
-        database=os.environ.get("DB_DATABASE"),
-        cursor_factory=RealDictCursor
+from usage import record_db_call
+
+def _db_params() -> Dict[str, Any]:
+    """Parámetros de conexión a PostgreSQL tomados del entorno"""
+    return {
+        "host": os.environ.get("DB_HOST"),
+        "port": int(os.environ.get("DB_PORT")),
+        "user": os.environ.get("DB_USER"),
+        "password": os.environ.get("DB_PASSWORD"),
+        "dbname": os.environ.get("DB_DATABASE"),
+    }
+
+def _pool_settings() -> Dict[str, Any]:
+    """Configuración del pool de conexiones (variables DB_POOL_*)"""
+    return {
+        "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+        "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+        # Tiempo máximo de vida de una conexión antes de reciclarla (segundos)
+        "max_lifetime": float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800")),
+        # Tiempo máximo de espera para obtener una conexión del pool (segundos)
+        "timeout": float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+    }
+
+# Pools por proceso: uno para el camino síncrono y otro para el asíncrono.
+# Ambos verifican la conexión al entregarla (check) y reciclan por max_lifetime.
+_pool: Optional[ConnectionPool] = None
+_async_pool: Optional[AsyncConnectionPool] = None
+_async_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    kwargs={**_db_params(), "row_factory": dict_row},
+                    check=ConnectionPool.check_connection,
+                    name="mcp-db-sync",
+                    open=True,
+                    **_pool_settings(),
+                )
+    return _pool
+
+async def _get_async_pool() -> AsyncConnectionPool:
+    global _async_pool, _async_pool_loop
+    loop = asyncio.get_running_loop()
+    # El pool asíncrono queda ligado al event loop en el que se abrió
+    if _async_pool is None or _async_pool_loop is not loop:
+        pool = AsyncConnectionPool(
+            kwargs={**_db_params(), "row_factory": dict_row},
+            check=AsyncConnectionPool.check_connection,
+            name="mcp-db-async",
+            open=False,
+            **_pool_settings(),
+        )
+        await pool.open()
+        # Otra corrutina pudo abrir un pool mientras tanto: conservar solo uno
+        if _async_pool is None or _async_pool_loop is not loop:
+            _async_pool, _async_pool_loop = pool, loop
+        else:
+            await pool.close()
+    return _async_pool
+
+@contextmanager
+def db_connection() -> Iterator[psycopg.Connection]:
+    """
+    Toma una conexión del pool durante el bloque `with`.
+    Al salir se hace commit (o rollback si hubo excepción) y la conexión vuelve al pool.
+    """
+    record_db_call()
+    with _get_pool().connection() as conn:
+        yield conn
+
+@asynccontextmanager
+async def async_db_connection() -> AsyncIterator[psycopg.AsyncConnection]:
+    """Versión asíncrona de db_connection"""
+    record_db_call()
+    pool = await _get_async_pool()
+    async with pool.connection() as conn:
+        yield conn
+
+def _sql_guard_settings() -> Dict[str, int]:
+    """Límites para el SQL generado por el LLM (milisegundos)"""
+    return {
+        "statement_timeout_ms": int(os.environ.get("SQL_STATEMENT_TIMEOUT_MS", "15000")),
+        "lock_timeout_ms": int(os.environ.get("SQL_LOCK_TIMEOUT_MS", "2000")),
+    }
+
+def _guard_statement() -> sql.Composed:
+    settings = _sql_guard_settings()
+    return sql.SQL("SET TRANSACTION READ ONLY; SET LOCAL statement_timeout = {}; SET LOCAL lock_timeout = {}").format(
+        sql.Literal(settings["statement_timeout_ms"]), sql.Literal(settings["lock_timeout_ms"])
     )
-    return conn
\ No newline at end of file
+
+@contextmanager
+def readonly_connection() -> Iterator[psycopg.Connection]:
+    """
+    Conexión del pool para ejecutar SQL generado: transacción de solo lectura con
+    statement_timeout y lock_timeout locales (se revierten al devolverla al pool).
+    """
+    with db_connection() as conn:
+        conn.execute(_guard_statement())
+        yield conn
+
+@asynccontextmanager
+async def async_readonly_connection() -> AsyncIterator[psycopg.AsyncConnection]:
+    """
+    Versión asíncrona de readonly_connection. Si la tarea se cancela (cliente MCP
+    desconectado o deadline de la petición), psycopg cancela la consulta en el servidor.
+    """
+    async with async_db_connection() as conn:
+        await conn.execute(_guard_statement())
+        yield conn
+
+def cost_guard_settings() -> Dict[str, Any]:
+    """Umbrales del pre-chequeo EXPLAIN del SQL generado (0 = sin umbral)"""
+    return {
+        "enabled": os.environ.get("SQL_COST_GUARD", "true").lower() in ("1", "true", "yes"),
+        "max_cost": float(os.environ.get("SQL_MAX_PLAN_COST", "0")),
+        "max_rows": float(os.environ.get("SQL_MAX_PLAN_ROWS", "0")),
+        # reject: devolver el error a sql_agent | limit: reescribir con LIMIT si solo sobran filas
+        "action": os.environ.get("SQL_COST_GUARD_ACTION", "reject").lower(),
+    }
+
+class QueryTooExpensive(Exception):
+    """El plan estimado del SQL generado supera los umbrales del cost guard"""
+
+    def __init__(self, plan: Dict[str, Any]):
+        self.plan = plan
+        super().__init__(
+            f"Plan estimado demasiado costoso: costo {plan['total_cost']} (máx. {plan['max_cost'] or 'sin límite'}), "
+            f"filas {plan['plan_rows']} (máx. {plan['max_rows'] or 'sin límite'})"
+        )
+
+def _explain_statement(query: str) -> sql.Composed:
+    return sql.SQL("EXPLAIN (FORMAT JSON) {}").format(sql.SQL(query))
+
+def _plan_estimates(row: Dict[str, Any]) -> Dict[str, Any]:
+    plan = row["QUERY PLAN"][0]["Plan"]
+    return {"total_cost": plan.get("Total Cost"), "plan_rows": plan.get("Plan Rows"), "node_type": plan.get("Node Type")}
+
+def explain_query(conn: psycopg.Connection, query: str) -> Dict[str, Any]:
+    """Costo y filas estimadas por el planificador (los errores de sintaxis/columnas se lanzan aquí)"""
+    return _plan_estimates(conn.execute(_explain_statement(query)).fetchone())
+
+async def aexplain_query(conn: psycopg.AsyncConnection, query: str) -> Dict[str, Any]:
+    """Versión asíncrona de explain_query"""
+    return _plan_estimates(await (await conn.execute(_explain_statement(query))).fetchone())
+
+def _apply_cost_guard(query: str, plan: Dict[str, Any], settings: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    plan.update(max_cost=settings["max_cost"], max_rows=settings["max_rows"])
+    over_cost = settings["max_cost"] > 0 and plan["total_cost"] > settings["max_cost"]
+    over_rows = settings["max_rows"] > 0 and plan["plan_rows"] > settings["max_rows"]
+    if over_rows and not over_cost and settings["action"] == "limit":
+        plan["action"] = "limited"
+        limited_query = f"SELECT * FROM ({query.strip().rstrip(';')}) AS limited_query LIMIT {int(settings['max_rows'])}"
+        return limited_query, plan
+    if over_cost or over_rows:
+        plan["action"] = "rejected"
+        raise QueryTooExpensive(plan)
+    plan["action"] = "accepted"
+    return query, plan
+
+def guard_query_cost(conn: psycopg.Connection, query: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Pre-chequeo con EXPLAIN antes de ejecutar el SQL generado. Devuelve la consulta
+    a ejecutar (posiblemente reescrita con LIMIT) y las estimaciones del plan, o lanza
+    QueryTooExpensive si supera los umbrales.
+    """
+    settings = cost_guard_settings()
+    if not settings["enabled"]:
+        return query, None
+    return _apply_cost_guard(query, explain_query(conn, query), settings)
+
+async def aguard_query_cost(conn: psycopg.AsyncConnection, query: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Versión asíncrona de guard_query_cost"""
+    settings = cost_guard_settings()
+    if not settings["enabled"]:
+        return query, None
+    return _apply_cost_guard(query, await aexplain_query(conn, query), settings)
+
+def describe_db_error(error: Exception) -> Dict[str, Any]:
+    """Clasifica un error de PostgreSQL en un tipo estructurado para el evaluador"""
+    settings = _sql_guard_settings()
+    if isinstance(error, QueryTooExpensive):
+        return {"error_type": "too_expensive", "plan": error.plan}
+    if isinstance(error, psycopg.errors.QueryCanceled):
+        return {"error_type": "timeout", "timeout_ms": settings["statement_timeout_ms"]}
+    if isinstance(error, psycopg.errors.LockNotAvailable):
+        return {"error_type": "lock_timeout", "timeout_ms": settings["lock_timeout_ms"]}
+    if isinstance(error, psycopg.errors.ReadOnlySqlTransaction):
+        return {"error_type": "read_only"}
+    if isinstance(error, psycopg.Error):
+        return {"error_type": "database", "sqlstate": error.sqlstate}
+    return {"error_type": "unknown"}
+
+def _count_cap() -> int:
+    """Máximo de filas a contar más allá del presupuesto (SQL_COUNT_CAP, 0 = sin límite)"""
+    return int(os.environ.get("SQL_COUNT_CAP", "100000"))
+
+def _move_statement(cursor_name: str, count_cap: int) -> sql.Composed:
+    amount = sql.SQL("ALL") if count_cap <= 0 else sql.Literal(count_cap)
+    return sql.SQL("MOVE FORWARD {} IN {}").format(amount, sql.Identifier(cursor_name))
+
+def fetch_bounded(conn: psycopg.Connection, query: str, row_limit: int,
+                  count_cap: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """
+    Ejecuta `query` con un cursor de servidor y trae al cliente solo `row_limit` filas.
+    El resto se cuenta con MOVE (sin transferir filas) hasta `count_cap`.
+
+    Returns:
+        (filas, total_rows, total_exacto) — total_exacto es False si el conteo llegó al tope
+    """
+    count_cap = _count_cap() if count_cap is None else count_cap
+    with conn.cursor(name=f"mcp_{uuid.uuid4().hex}") as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchmany(row_limit)
+        total_rows, exact = len(rows), True
+        if len(rows) == row_limit:
+            moved = conn.execute(_move_statement(cursor.name, count_cap)).rowcount
+            total_rows += moved
+            exact = count_cap <= 0 or moved < count_cap
+    return [dict(row) for row in rows], total_rows, exact
+
+async def afetch_bounded(conn: psycopg.AsyncConnection, query: str, row_limit: int,
+                         count_cap: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """Versión asíncrona de fetch_bounded"""
+    count_cap = _count_cap() if count_cap is None else count_cap
+    async with conn.cursor(name=f"mcp_{uuid.uuid4().hex}") as cursor:
+        await cursor.execute(query)
+        rows = await cursor.fetchmany(row_limit)
+        total_rows, exact = len(rows), True
+        if len(rows) == row_limit:
+            moved = (await conn.execute(_move_statement(cursor.name, count_cap))).rowcount
+            total_rows += moved
+            exact = count_cap <= 0 or moved < count_cap
+    return [dict(row) for row in rows], total_rows, exact
+
+def _summarise_pool(pool: Optional[Union[ConnectionPool, AsyncConnectionPool]]) -> Optional[Dict[str, Any]]:
+    if pool is None:
+        return None
+    stats = pool.get_stats()
+    in_use = stats.get("pool_size", 0) - stats.get("pool_available", 0)
+    requests = stats.get("requests_num", 0)
+    return {
+        **stats,
+        "in_use": in_use,
+        "utilisation": in_use / pool.max_size if pool.max_size else 0.0,
+        "avg_wait_ms": stats.get("requests_wait_ms", 0) / requests if requests else 0.0,
+    }
+
+def pool_stats() -> Dict[str, Any]:
+    """Métricas de los pools (tiempo de espera y utilización) para dimensionarlos"""
+    return {
+        "sync": _summarise_pool(_pool),
+        "async": _summarise_pool(_async_pool),
+        "settings": _pool_settings(),
+    }
+
+# Contadores de pg_stat_user_tables + relfilenode (cambia con TRUNCATE / VACUUM FULL).
+# to_regclass resuelve cada nombre con el search_path de la conexión.
+_TABLE_VERSION_QUERY = """
+SELECT t.name AS table_name,
+       c.relfilenode,
+       COALESCE(s.n_tup_ins, 0) AS n_tup_ins,
+       COALESCE(s.n_tup_upd, 0) AS n_tup_upd,
+       COALESCE(s.n_tup_del, 0) AS n_tup_del
+FROM unnest(%s::text[]) AS t(name)
+LEFT JOIN pg_class c ON c.oid = to_regclass(t.name)
+LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+"""
+
+def _fingerprint(*parts: Any) -> str:
+    return hashlib.sha1(":".join(str(p) for p in parts).encode()).hexdigest()[:16]
+
+class DataVersionTracker:
+    """
+    Huella de versión de datos por tabla para invalidar cachés (catálogo, resultados, LLM).
+
+    La huella combina relfilenode y los contadores de inserción/actualización/borrado de
+    pg_stat_user_tables y, si DATA_VERSION_TABLE está definida, la versión que mantenga
+    el proceso de carga en esa tabla (columnas table_name, version). La consulta se
+    reutiliza durante DATA_VERSION_MIN_INTERVAL segundos, así que las lecturas
+    repetidas se resuelven en memoria.
+
+    PostgreSQL publica los contadores de pg_stat con unos segundos de retraso; si se
+    necesita invalidación inmediata tras una carga, usar DATA_VERSION_TABLE.
+    """
+
+    def __init__(self, min_interval: Optional[float] = None, version_table: Optional[str] = None):
+        self.min_interval = min_interval if min_interval is not None else float(os.environ.get("DATA_VERSION_MIN_INTERVAL", "1"))
+        self.version_table = version_table if version_table is not None else os.environ.get("DATA_VERSION_TABLE")
+        self._versions: Dict[str, str] = {}
+        self._probed_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.probes = 0
+
+    def _user_version_query(self) -> Optional[str]:
+        if not self.version_table:
+            return None
+        return f"SELECT table_name, version::text AS version FROM {self.version_table} WHERE table_name = ANY(%s)"
+
+    def _stale(self, tables: List[str]) -> List[str]:
+        now = time.monotonic()
+        return [t for t in tables if now - self._probed_at.get(t, float("-inf")) >= self.min_interval]
+
+    def _store(self, tables: List[str], stat_rows: List[Dict[str, Any]], user_rows: List[Dict[str, Any]]) -> None:
+        user_versions = {row["table_name"]: row["version"] for row in user_rows}
+        now = time.monotonic()
+        with self._lock:
+            for row in stat_rows:
+                name = row["table_name"]
+                if row["relfilenode"] is None:
+                    self._versions[name] = "missing"
+                else:
+                    self._versions[name] = _fingerprint(
+                        row["relfilenode"], row["n_tup_ins"], row["n_tup_upd"], row["n_tup_del"],
+                        user_versions.get(name, ""),
+                    )
+            for name in tables:
+                self._probed_at[name] = now
+            self.probes += 1
+
+    def versions(self, tables: List[str]) -> Dict[str, str]:
+        """Huella actual de cada tabla (consulta PostgreSQL solo si venció el intervalo)"""
+        stale = self._stale(tables)
+        if stale:
+            user_query = self._user_version_query()
+            with db_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(_TABLE_VERSION_QUERY, (stale,))
+                stat_rows = cursor.fetchall()
+                user_rows = []
+                if user_query:
+                    cursor.execute(user_query, (stale,))
+                    user_rows = cursor.fetchall()
+            self._store(stale, stat_rows, user_rows)
+        return {t: self._versions.get(t, "missing") for t in tables}
+
+    async def aversions(self, tables: List[str]) -> Dict[str, str]:
+        """Versión asíncrona de versions"""
+        stale = self._stale(tables)
+        if stale:
+            user_query = self._user_version_query()
+            async with async_db_connection() as conn, conn.cursor() as cursor:
+                await cursor.execute(_TABLE_VERSION_QUERY, (stale,))
+                stat_rows = await cursor.fetchall()
+                user_rows = []
+                if user_query:
+                    await cursor.execute(user_query, (stale,))
+                    user_rows = await cursor.fetchall()
+            self._store(stale, stat_rows, user_rows)
+        return {t: self._versions.get(t, "missing") for t in tables}
+
+    @staticmethod
+    def combine(versions: Dict[str, str]) -> str:
+        """Huella combinada de varias tablas (independiente del orden)"""
+        return _fingerprint(*(f"{t}={v}" for t, v in sorted(versions.items())))
+
+    def fingerprint(self, tables: List[str]) -> str:
+        return self.combine(self.versions(tables))
+
+    async def afingerprint(self, tables: List[str]) -> str:
+        return self.combine(await self.aversions(tables))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "min_interval": self.min_interval,
+            "version_table": self.version_table,
+            "probes": self.probes,
+            "versions": dict(self._versions),
+        }
+
+# Tracker compartido por el proceso
+data_versions = DataVersionTracker()
+
+def close_db_pools() -> None:
+    """Cierra el pool síncrono (el asíncrono se libera con su event loop)"""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+atexit.register(close_db_pools)
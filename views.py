@@ -0,0 +1,338 @@
+"""
+Vistas materializadas gestionadas sobre las tablas crudas.
+
+Uso (por ejemplo al final de un proceso de carga):
+    python views.py ensure    # crea las vistas e índices que falten
+    python views.py refresh   # REFRESH MATERIALIZED VIEW CONCURRENTLY de todas
+
+Cada vista guarda en su comentario (COMMENT ON MATERIALIZED VIEW) la huella de su
+definición; `ensure` elimina y vuelve a crear la que no coincida, con las que dependen de
+ella. Para forzarlo a mano:
+    psql -h $DB_HOST -U $DB_USER -d $DB_DATABASE -c "DROP MATERIALIZED VIEW metrics_weekly CASCADE"
+    python views.py ensure
+"""
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from psycopg import sql
+
+from utils import data_versions, db_connection
+
+WEEKS = 9  # columnas l8w(_roll) .. l0w(_roll)
+
+
+def _unpivot_weeks(alias: str, column_format: str) -> sql.Composed:
+    """VALUES (week_offset, columna) para pasar las columnas semanales a filas"""
+    return sql.SQL(", ").join(
+        sql.SQL("({}, {}.{})").format(sql.Literal(offset), sql.Identifier(alias), sql.Identifier(column_format.format(offset)))
+        for offset in range(WEEKS)
+    )
+
+
+METRICS_WEEKLY_VIEW = "metrics_weekly"
+
+# Formato largo de raw_input_metrics: una fila por zona, métrica y semana, con las órdenes
+# de esa zona y semana (raw_orders). Agrupar garantiza la clave única que exige
+# REFRESH ... CONCURRENTLY aunque haya filas repetidas en las tablas crudas.
+METRICS_WEEKLY_QUERY = sql.SQL("""
+    WITH orders_by_metric AS (
+        SELECT o.country, o.city, o.zone, o.metric, w.week_offset, SUM(w.orders) AS orders
+        FROM raw_orders AS o
+        CROSS JOIN LATERAL (VALUES {order_weeks}) AS w(week_offset, orders)
+        GROUP BY o.country, o.city, o.zone, o.metric, w.week_offset
+    ),
+    -- raw_orders repite el conteo de la zona en cada fila de métrica: se cuenta una sola vez
+    orders_weekly AS (
+        SELECT country, city, zone, week_offset, MAX(orders) AS orders
+        FROM orders_by_metric
+        GROUP BY country, city, zone, week_offset
+    )
+    SELECT m.country, m.city, m.zone, m.zone_type, m.zone_prioritization, m.metric, w.week_offset,
+           AVG(w.value) AS value, MAX(ow.orders) AS orders
+    FROM raw_input_metrics AS m
+    CROSS JOIN LATERAL (VALUES {metric_weeks}) AS w(week_offset, value)
+    LEFT JOIN orders_weekly AS ow
+        ON ow.country = m.country AND ow.city = m.city AND ow.zone = m.zone AND ow.week_offset = w.week_offset
+    GROUP BY m.country, m.city, m.zone, m.zone_type, m.zone_prioritization, m.metric, w.week_offset
+""").format(order_weeks=_unpivot_weeks("o", "l{}w"), metric_weeks=_unpivot_weeks("m", "l{}w_roll"))
+
+METRICS_WEEKLY_DEFINITION = {
+    "name": METRICS_WEEKLY_VIEW,
+    "description": (
+        "Vista en formato largo de raw_input_metrics unida a raw_orders: una fila por zona, métrica y semana. "
+        "week_offset 0 = semana actual (l0w_roll), 8 = hace 8 semanas (l8w_roll); orders = órdenes de la zona "
+        "en esa semana. Preferirla para tendencias y comparaciones entre semanas: filtrar por metric y week_offset."
+    ),
+    "columns": [
+        {"name": "country", "type": "text"},
+        {"name": "city", "type": "text"},
+        {"name": "zone", "type": "text"},
+        {"name": "zone_type", "type": "text"},
+        {"name": "zone_prioritization", "type": "text"},
+        {"name": "metric", "type": "text"},
+        {"name": "week_offset", "type": "integer"},
+        {"name": "value", "type": "double precision"},
+        {"name": "orders", "type": "numeric"},
+    ],
+}
+
+
+METRICS_CUBE_VIEW = "metrics_cube"
+
+# Cubo de agregados sobre metrics_weekly: ROLLUP de la jerarquía país → ciudad → zona por
+# métrica y semana. GROUPING() da el nivel de cada fila (las columnas agregadas quedan a NULL).
+# Se refresca entero (REFRESH ... CONCURRENTLY), no por deltas: l8w..l0w son semanas relativas,
+# cada carga las desplaza todas y casi todos los grupos (métrica, semana) cambian; además el
+# cubo se calcula sobre metrics_weekly, no sobre las filas crudas
+METRICS_CUBE_QUERY = sql.SQL("""
+    SELECT CASE GROUPING(w.country, w.city, w.zone)
+               WHEN 7 THEN 'global' WHEN 3 THEN 'country' WHEN 1 THEN 'city' ELSE 'zone'
+           END AS level,
+           w.country, w.city, w.zone, w.metric, w.week_offset,
+           COUNT(w.value) AS zones,
+           AVG(w.value) AS avg_value,
+           MIN(w.value) AS min_value,
+           MAX(w.value) AS max_value,
+           SUM(w.value * w.orders) / NULLIF(SUM(w.orders) FILTER (WHERE w.value IS NOT NULL), 0) AS weighted_avg_value,
+           SUM(w.orders) AS orders
+    FROM {weekly} AS w
+    GROUP BY w.metric, w.week_offset, ROLLUP (w.country, w.city, w.zone)
+""").format(weekly=sql.Identifier(METRICS_WEEKLY_VIEW))
+
+METRICS_CUBE_DEFINITION = {
+    "name": METRICS_CUBE_VIEW,
+    "description": (
+        "Cubo precalculado de metrics_weekly por métrica, semana (week_offset) y nivel jerárquico. "
+        "level = 'global' | 'country' | 'city' | 'zone'; las columnas por encima del nivel quedan a NULL "
+        "(p. ej. level='country' tiene city y zone NULL). avg_value es la media simple entre zonas y "
+        "weighted_avg_value la media ponderada por órdenes. Usarla siempre que la pregunta agregue por "
+        "país, ciudad o total: filtrar por level, metric y week_offset en lugar de agrupar raw_input_metrics."
+    ),
+    "columns": [
+        {"name": "level", "type": "text"},
+        {"name": "country", "type": "text"},
+        {"name": "city", "type": "text"},
+        {"name": "zone", "type": "text"},
+        {"name": "metric", "type": "text"},
+        {"name": "week_offset", "type": "integer"},
+        {"name": "zones", "type": "bigint"},
+        {"name": "avg_value", "type": "double precision"},
+        {"name": "min_value", "type": "double precision"},
+        {"name": "max_value", "type": "double precision"},
+        {"name": "weighted_avg_value", "type": "double precision"},
+        {"name": "orders", "type": "numeric"},
+    ],
+}
+
+
+class MaterializedView:
+    """Definición de una vista materializada gestionada y de sus índices"""
+
+    def __init__(self, name: str, query: sql.Composable, unique_key: List[str], indexes: List[List[str]],
+                 source_tables: List[str], definition: Dict[str, Any], depends_on: Optional[List[str]] = None):
+        self.name = name
+        self.query = query
+        self.unique_key = unique_key
+        self.indexes = indexes
+        self.source_tables = source_tables
+        self.definition = definition
+        # Vistas gestionadas de las que se alimenta (deben ir antes en VIEWS)
+        self.depends_on = depends_on or []
+
+    def _index(self, columns: List[str], unique: bool = False) -> sql.Composed:
+        index_name = f"{self.name}_key" if unique else f"{self.name}_{'_'.join(columns)}_idx"
+        return sql.SQL("CREATE {unique}INDEX IF NOT EXISTS {index} ON {view} ({columns})").format(
+            unique=sql.SQL("UNIQUE " if unique else ""),
+            index=sql.Identifier(index_name[:63]),
+            view=sql.Identifier(self.name),
+            columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+        )
+
+    @property
+    def definition_hash(self) -> str:
+        """Huella de la consulta y los índices; se guarda como comentario de la vista"""
+        definition = "\n".join([self.query.as_string(None), repr(self.unique_key), repr(self.indexes)])
+        return "mcp-view:" + hashlib.sha256(definition.encode()).hexdigest()[:16]
+
+    def create_statements(self) -> List[sql.Composed]:
+        statements = [
+            sql.SQL("CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS {} WITH DATA").format(sql.Identifier(self.name), self.query),
+            # REFRESH ... CONCURRENTLY requiere un índice único sobre columnas
+            self._index(self.unique_key, unique=True),
+        ]
+        statements += [self._index(columns) for columns in self.indexes]
+        statements.append(sql.SQL("COMMENT ON MATERIALIZED VIEW {} IS {}").format(
+            sql.Identifier(self.name), sql.Literal(self.definition_hash)
+        ))
+        statements.append(sql.SQL("ANALYZE {}").format(sql.Identifier(self.name)))
+        return statements
+
+
+VIEWS = [
+    MaterializedView(
+        METRICS_WEEKLY_VIEW,
+        METRICS_WEEKLY_QUERY,
+        unique_key=["metric", "country", "city", "zone", "zone_type", "zone_prioritization", "week_offset"],
+        indexes=[["metric", "week_offset"], ["country", "city", "zone"]],
+        source_tables=["raw_input_metrics", "raw_orders"],
+        definition=METRICS_WEEKLY_DEFINITION,
+    ),
+    MaterializedView(
+        METRICS_CUBE_VIEW,
+        METRICS_CUBE_QUERY,
+        # Las filas agregadas tienen NULL en la jerarquía: REFRESH CONCURRENTLY las reescribe
+        # siempre, pero las filas de zona (la mayoría) solo cambian si cambian sus datos
+        unique_key=["level", "metric", "week_offset", "country", "city", "zone"],
+        indexes=[["metric", "level", "week_offset"]],
+        source_tables=["raw_input_metrics", "raw_orders"],
+        definition=METRICS_CUBE_DEFINITION,
+        depends_on=[METRICS_WEEKLY_VIEW],
+    ),
+]
+
+
+class MaterializedViewManager:
+    """
+    Crea las vistas materializadas y las refresca (CONCURRENTLY, sin bloquear lecturas)
+    cuando cambia la huella de datos de sus tablas de origen, es decir, tras cada carga.
+    """
+
+    def __init__(self, views: List[MaterializedView], enabled: Optional[bool] = None,
+                 check_interval: Optional[float] = None):
+        self.views = {view.name: view for view in views}
+        self.enabled = enabled if enabled is not None else os.environ.get("MATERIALIZED_VIEWS", "false").lower() in ("1", "true", "yes")
+        self.check_interval = check_interval if check_interval is not None else float(os.environ.get("MATERIALIZED_VIEWS_CHECK_INTERVAL", "60"))
+        self._source_versions: Dict[str, str] = {}
+        self._refreshed: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def table_definitions(self) -> List[Dict[str, Any]]:
+        """Definiciones para dict_tables (vacío si las vistas están desactivadas)"""
+        return [view.definition for view in self.views.values()] if self.enabled else []
+
+    def ensure(self) -> None:
+        """
+        Crea las vistas e índices que falten (idempotente). Una vista creada con otra
+        definición (comentario distinto de definition_hash) se elimina y se vuelve a crear,
+        junto con las vistas que dependen de ella.
+        """
+        with db_connection() as conn:
+            conn.autocommit = True
+            try:
+                for view in self.views.values():
+                    row = conn.execute(
+                        "SELECT to_regclass(%s) IS NOT NULL AS present, obj_description(to_regclass(%s), 'pg_class') AS comment",
+                        (view.name, view.name),
+                    ).fetchone()
+                    if row["present"] and row["comment"] != view.definition_hash:
+                        logging.warning(f"La vista '{view.name}' tiene otra definición: se vuelve a crear")
+                        conn.execute(sql.SQL("DROP MATERIALIZED VIEW {} CASCADE").format(sql.Identifier(view.name)))
+                    for statement in view.create_statements():
+                        conn.execute(statement)
+            finally:
+                conn.autocommit = False
+        for view in self.views.values():
+            self._source_versions[view.name] = data_versions.fingerprint(view.source_tables)
+
+    def refresh(self, name: Optional[str] = None, concurrently: bool = True) -> List[str]:
+        """Refresca una vista (o todas). CONCURRENTLY mantiene la vista legible durante el refresco"""
+        names = [name] if name else list(self.views)  # VIEWS está en orden de dependencias
+        with self._lock, db_connection() as conn:
+            conn.autocommit = True
+            try:
+                for view_name in names:
+                    view = self.views[view_name]
+                    version = data_versions.fingerprint(view.source_tables)
+                    started = time.perf_counter()
+                    conn.execute(sql.SQL("REFRESH MATERIALIZED VIEW {}{}").format(
+                        sql.SQL("CONCURRENTLY " if concurrently else ""), sql.Identifier(view_name)
+                    ))
+                    self._source_versions[view_name] = version
+                    # Las vistas que se alimentan de esta quedan pendientes de refresco
+                    for dependant in self.views.values():
+                        if view_name in dependant.depends_on and dependant.name not in names:
+                            self._source_versions.pop(dependant.name, None)
+                    self._refreshed[view_name] = {
+                        "refreshed_at": time.time(),
+                        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                        "source_version": version,
+                    }
+            finally:
+                conn.autocommit = False
+        return names
+
+    def refresh_stale(self) -> List[str]:
+        """Refresca las vistas cuyas tablas de origen (o vistas de las que dependen) cambiaron"""
+        # Las vistas sin versión (nunca refrescadas o invalidadas por una dependencia) se
+        # refrescan siempre; las demás si cambió la huella de sus tablas de origen
+        stale = set()
+        for view in self.views.values():
+            if view.name not in self._source_versions:
+                continue
+            try:
+                if data_versions.fingerprint(view.source_tables) != self._source_versions[view.name]:
+                    stale.add(view.name)
+            except Exception as e:
+                logging.error(f"Error consultando la versión de la vista '{view.name}': {str(e)}")
+        # Un cubo no puede estar al día si la vista de la que se alimenta no lo está
+        for view in reversed(list(self.views.values())):
+            if view.name in stale:
+                stale.update(view.depends_on)
+        refreshed = []
+        for view in self.views.values():
+            if view.name not in stale and view.name in self._source_versions:
+                continue
+            try:
+                refreshed += self.refresh(view.name)
+            except Exception as e:
+                logging.error(f"Error refrescando la vista '{view.name}': {str(e)}")
+        return refreshed
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            self.refresh_stale()
+
+    def start(self) -> None:
+        """Crea las vistas y arranca el refresco en segundo plano (no hace nada si están desactivadas)"""
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self.ensure()
+        self._thread = threading.Thread(target=self._refresh_loop, name="materialized-views-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "check_interval": self.check_interval,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "views": {name: self._refreshed.get(name) for name in self.views},
+        }
+
+
+# Gestor compartido por el proceso
+materialized_views = MaterializedViewManager(VIEWS)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    command = sys.argv[1] if len(sys.argv) > 1 else "refresh"
+    if command == "ensure":
+        materialized_views.ensure()
+    elif command == "refresh":
+        materialized_views.ensure()
+        print(f"Vistas refrescadas: {', '.join(materialized_views.refresh())}")
+    else:
+        sys.exit(f"Comando desconocido: {command} (ensure | refresh)")